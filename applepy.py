@@ -6,15 +6,19 @@
 
 
 import numpy
+import os
 import pygame
 import select
 import socket
-import struct
 import subprocess
 import sys
+import tempfile
 import time
 import wave
 
+from cpu6502 import Memory, CPU, FRAME_CYCLES, CONTROL_PORT
+from cpu6502 import BusReader, BUS_MESSAGE, BUS_READ, BUS_WRITE, bus_frame, SharedVideo, VIDEO_SIZE, TRAPS
+
 
 class Display:
 
@@ -114,6 +118,7 @@ class Display:
 
         self.page = 1
         self.text = True
+        self.high_res = False
         self.colour = False
 
         self.chargen = []
@@ -260,12 +265,15 @@ class Display:
 
     def flash(self):
         if time.time() - self.flash_time >= 0.5:
-            self.flash_on = not self.flash_on
-            for offset, char in enumerate(self.flash_chars[self.page - 1]):
-                if (char & 0xC0) == 0x40:
-                    self.update(0x400 + offset, char)
+            self.toggle_flash()
             self.flash_time = time.time()
 
+    def toggle_flash(self):
+        self.flash_on = not self.flash_on
+        for offset, char in enumerate(self.flash_chars[self.page - 1]):
+            if (char & 0xC0) == 0x40:
+                self.update(0x400 + offset, char)
+
 
 class Speaker:
 
@@ -324,18 +332,15 @@ class Cassette:
 class SoftSwitches:
 
     def __init__(self, display, speaker, cassette):
-        self.kbd = 0x00
         self.display = display
         self.speaker = speaker
         self.cassette = cassette
 
     def read_byte(self, cycle, address):
+        # the keyboard latch lives in the core, which also reports
+        # $C050-$C057 here as writes rather than reads
         assert 0xC000 <= address <= 0xCFFF
-        if address == 0xC000:
-            return self.kbd
-        elif address == 0xC010:
-            self.kbd = self.kbd & 0x7F
-        elif address == 0xC030:
+        if address == 0xC030:
             if self.speaker:
                 self.speaker.toggle(cycle)
         elif address == 0xC050:
@@ -362,13 +367,60 @@ class SoftSwitches:
         return 0x00
 
 
+class LocalBus:
+    """
+    The devices as the core sees them, with the interface of cpu6502.Bus:
+    called directly by an in-process core, or from the message loop when
+    the core is a subprocess.
+    """
+
+    def __init__(self, softswitches, display):
+        self.softswitches = softswitches
+        self.display = display
+
+    def read(self, cycle, address):
+        return self.softswitches.read_byte(cycle, address)
+
+    def write(self, cycle, address, value):
+        if address >= 0xC000:
+            self.softswitches.read_byte(cycle, address)  # switch notification
+        else:
+            self.display.update(address, value)
+
+    def flush(self):
+        pass
+
+    def poll(self):
+        pass
+
+
 class Apple2:
 
+    FRAME_TIME = 1 / 60.0
+    FLASH_CYCLES = 511500  # half a second at 1.023 MHz
+
     def __init__(self, options, display, speaker, cassette):
         self.display = display
         self.speaker = speaker
         self.softswitches = SoftSwitches(display, speaker, cassette)
+        self.bus = LocalBus(self.softswitches, display)
+        self.video = None
+        self.control_port = None  # as reported by the core
+        self.in_process = options.in_process
+        if self.in_process:
+            self.start_in_process(options)
+        else:
+            self.start_subprocess(options)
+
+    def start_in_process(self, options):
+        memory = Memory()
+        memory.rom.load_file(0xD000, options.rom)
+        if options.ram:
+            memory.ram.load_file(0x0000, options.ram)
+        memory.bus = self.bus
+        self.core = CPU(options, memory)
 
+    def start_subprocess(self, options):
         listener = socket.socket()
         listener.bind(("127.0.0.1", 0))
         listener.listen(0)
@@ -378,6 +430,7 @@ class Apple2:
             "cpu6502.py",
             "--bus", str(listener.getsockname()[1]),
             "--rom", options.rom,
+            "--control", str(options.control),
         ]
         if options.ram:
             args.extend([
@@ -387,6 +440,48 @@ class Apple2:
             args.extend([
                 "--pc", str(options.pc),
             ])
+        if options.translate:
+            args.append("--translate")
+        if options.exact:
+            args.append("--exact")
+        if options.profile:
+            args.append("--profile")
+        if options.record:
+            args.extend([
+                "--record", options.record,
+            ])
+        if options.replay:
+            args.extend([
+                "--replay", options.replay,
+            ])
+        if options.restore:
+            args.extend([
+                "--restore", options.restore,
+            ])
+        if options.snapshot:
+            args.extend([
+                "--snapshot", options.snapshot,
+            ])
+        if options.speed is None:
+            args.append("--turbo")
+        else:
+            args.extend([
+                "--speed", str(options.speed),
+            ])
+        if options.report:
+            args.append("--mhz")
+        for name in options.traps:
+            args.extend([
+                "--native", name,
+            ])
+        if options.shared_video:
+            fd, path = tempfile.mkstemp(prefix="applepy-video-")
+            os.close(fd)
+            self.video = SharedVideo(path, create=True)
+            self.shadow = bytearray(VIDEO_SIZE)
+            args.extend([
+                "--video", path,
+            ])
         self.core = subprocess.Popen(args)
 
         rs, _, _ = select.select([listener], [], [], 2)
@@ -394,44 +489,104 @@ class Apple2:
             print >>sys.stderr, "CPU module did not start"
             sys.exit(1)
         self.cpu, _ = listener.accept()
+        if self.video:
+            # the core maps the file before connecting
+            os.unlink(path)
+
+    def refresh_video(self):
+        for page in self.video.dirty_pages():
+            base = page << 8
+            data = bytearray(self.video.read_page(page))
+            shadow = self.shadow
+            for offset, value in enumerate(data):
+                if shadow[base + offset] != value:
+                    shadow[base + offset] = value
+                    self.display.update(base + offset, value)
+
+    def key(self, cycle, value):
+        if self.in_process:
+            self.core.input(cycle, 0xC000, value)
+        else:
+            self.cpu.sendall(bus_frame(BUS_MESSAGE.pack(cycle, BUS_WRITE, 0xC000, value)))
+
+    def handle_events(self, cycle):
+        """Pass key presses to the core; True if the window was closed."""
+        quit = False
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                quit = True
+
+            if event.type == pygame.KEYDOWN:
+                key = ord(event.unicode) if event.unicode else 0
+                if event.key == pygame.K_LEFT:
+                    key = 0x08
+                if event.key == pygame.K_RIGHT:
+                    key = 0x15
+                if key:
+                    if key == 0x7F:
+                        key = 0x08
+                    self.key(cycle, 0x80 + (key & 0x7F))
+        return quit
+
+    def render(self, cycle):
+        pygame.display.flip()
+        if self.speaker:
+            self.speaker.update(cycle)
+
+    def frame(self, cycle):
+        if self.handle_events(cycle):
+            self.core.quit = True
+        self.render(cycle)
 
     def run(self):
-        update_cycle = 0
+        if self.in_process:
+            self.run_in_process()
+        else:
+            self.run_subprocess()
+
+    def run_in_process(self):
+        scheduler = self.core.scheduler
+        scheduler.every(FRAME_CYCLES, self.frame)
+        scheduler.every(self.FLASH_CYCLES, lambda cycle: self.display.toggle_flash())
+        self.core.loop()
+
+    def run_subprocess(self):
+        next_frame = 0
+        frame_time = time.time()
+        cycle = 0
         quit = False
+        reader = BusReader(self.cpu)
         while not quit:
-            op = self.cpu.recv(8)
-            if len(op) == 0:
+            # with shared video RAM the bus may stay quiet for whole frames
+            rs, _, _ = select.select([self.cpu], [], [], self.FRAME_TIME)
+            messages = reader.receive() if rs else []
+            if messages is None:
                 break
-            cycle, rw, addr, val = struct.unpack("<IBHB", op)
-            if rw == 0:
-                self.cpu.send(chr(self.softswitches.read_byte(cycle, addr)))
-            elif rw == 1:
-                self.display.update(addr, val)
-            else:
-                break
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
+            if self.control_port is None and reader.control_port is not None:
+                self.control_port = reader.control_port
+                if self.control_port != CONTROL_PORT:
+                    print >>sys.stderr, "Control port %d" % self.control_port
+            for cycle, rw, addr, val in messages:
+                if rw == BUS_READ:
+                    value = self.bus.read(cycle, addr)
+                    self.cpu.sendall(bus_frame(BUS_MESSAGE.pack(cycle, BUS_READ, addr, value)))
+                elif rw == BUS_WRITE:
+                    self.bus.write(cycle, addr, val)
+                else:
                     quit = True
 
-                if event.type == pygame.KEYDOWN:
-                    key = ord(event.unicode) if event.unicode else 0
-                    if event.key == pygame.K_LEFT:
-                        key = 0x08
-                    if event.key == pygame.K_RIGHT:
-                        key = 0x15
-                    if key:
-                        if key == 0x7F:
-                            key = 0x08
-                        self.softswitches.kbd = 0x80 + (key & 0x7F)
-
-            update_cycle += 1
-            if update_cycle >= 1024:
+            if self.handle_events(cycle):
+                quit = True
+
+            # a frame per FRAME_CYCLES of the core's time, going by the
+            # message stamps, or per FRAME_TIME while the bus is quiet
+            if cycle >= next_frame or time.time() - frame_time >= self.FRAME_TIME:
+                if self.video:
+                    self.refresh_video()
                 self.display.flash()
-                pygame.display.flip()
-                if self.speaker:
-                    self.speaker.update(cycle)
-                update_cycle = 0
+                self.render(cycle)
+                next_frame = cycle + FRAME_CYCLES
+                frame_time = time.time()
 
 
 def usage():
@@ -440,11 +595,25 @@ def usage():
     print >>sys.stderr
     print >>sys.stderr, "Usage: applepy.py [options]"
     print >>sys.stderr
+    print >>sys.stderr, "    -C, --control  Core control port, 0 for any free one (default %d)" % CONTROL_PORT
     print >>sys.stderr, "    -c, --cassette Cassette wav file to load"
+    print >>sys.stderr, "    -e, --exact    Count page crossing cycles (default base cycles only)"
+    print >>sys.stderr, "    -i, --in-process Run the CPU in this process (default subprocess)"
+    print >>sys.stderr, "    -K, --record   File to record key presses to, with their cycles"
+    print >>sys.stderr, "    -k, --replay   File of recorded key presses to replay (ignoring live ones)"
+    print >>sys.stderr, "    -m, --mhz      Report the emulated speed every few seconds"
+    print >>sys.stderr, "    -n, --native   Trap a ROM routine: COUT, RDKEY or HOME (repeatable)"
+    print >>sys.stderr, "    -L, --restore  Snapshot file to start from (default reset)"
     print >>sys.stderr, "    -R, --rom      ROM file to use (default A2ROM.BIN)"
     print >>sys.stderr, "    -r, --ram      RAM file to load (default none)"
     print >>sys.stderr, "    -p, --pc       Initial PC value"
+    print >>sys.stderr, "    -P, --profile  Count instructions and cycles per PC and opcode"
     print >>sys.stderr, "    -q, --quiet    Quiet mode, no sounds (default sounds)"
+    print >>sys.stderr, "    -S, --snapshot Snapshot file to save when the core stops"
+    print >>sys.stderr, "    -s, --shared-video Share video RAM with the core (default bus writes)"
+    print >>sys.stderr, "    -T, --turbo    Run unthrottled"
+    print >>sys.stderr, "    -t, --translate Translate basic blocks (default interpret)"
+    print >>sys.stderr, "    -x, --speed    Speed as a multiple of 1.023 MHz (default 1)"
     sys.exit(1)
 
 
@@ -452,10 +621,23 @@ def get_options():
     class Options:
         def __init__(self):
             self.cassette = None
+            self.control = CONTROL_PORT
+            self.exact = False
+            self.in_process = False
             self.rom = "A2ROM.BIN"
             self.ram = None
             self.pc = None
+            self.profile = False
             self.quiet = False
+            self.record = None
+            self.replay = None
+            self.report = False
+            self.restore = None
+            self.shared_video = False
+            self.snapshot = None
+            self.speed = 1.0
+            self.traps = []
+            self.translate = False
 
     options = Options()
     a = 1
@@ -464,17 +646,54 @@ def get_options():
             if sys.argv[a] in ("-c", "--cassette"):
                 a += 1
                 options.cassette = sys.argv[a]
+            elif sys.argv[a] in ("-C", "--control"):
+                a += 1
+                options.control = int(sys.argv[a])
+            elif sys.argv[a] in ("-i", "--in-process"):
+                options.in_process = True
+            elif sys.argv[a] in ("-K", "--record"):
+                a += 1
+                options.record = sys.argv[a]
+            elif sys.argv[a] in ("-k", "--replay"):
+                a += 1
+                options.replay = sys.argv[a]
             elif sys.argv[a] in ("-R", "--rom"):
                 a += 1
                 options.rom = sys.argv[a]
             elif sys.argv[a] in ("-r", "--ram"):
                 a += 1
                 options.ram = sys.argv[a]
+            elif sys.argv[a] in ("-L", "--restore"):
+                a += 1
+                options.restore = sys.argv[a]
+            elif sys.argv[a] in ("-S", "--snapshot"):
+                a += 1
+                options.snapshot = sys.argv[a]
             elif sys.argv[a] in ("-p", "--pc"):
                 a += 1
                 options.pc = int(sys.argv[a])
+            elif sys.argv[a] in ("-P", "--profile"):
+                options.profile = True
             elif sys.argv[a] in ("-q", "--quiet"):
                 options.quiet = True
+            elif sys.argv[a] in ("-m", "--mhz"):
+                options.report = True
+            elif sys.argv[a] in ("-n", "--native"):
+                a += 1
+                if sys.argv[a].upper() not in TRAPS:
+                    usage()
+                options.traps.append(sys.argv[a].upper())
+            elif sys.argv[a] in ("-x", "--speed"):
+                a += 1
+                options.speed = float(sys.argv[a])
+            elif sys.argv[a] in ("-s", "--shared-video"):
+                options.shared_video = True
+            elif sys.argv[a] in ("-T", "--turbo"):
+                options.speed = None
+            elif sys.argv[a] in ("-t", "--translate"):
+                options.translate = True
+            elif sys.argv[a] in ("-e", "--exact"):
+                options.exact = True
             else:
                 usage()
         else:
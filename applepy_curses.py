@@ -4,13 +4,12 @@
 
 
 import curses
+import select
 import socket
-import struct
 import subprocess
 import sys
 
-
-kbd = 0
+from cpu6502 import BusReader, BUS_MESSAGE, BUS_READ, BUS_WRITE, bus_frame, CONTROL_PORT
 
 
 def write_screen(win, address, value):
@@ -40,23 +39,12 @@ def write_screen(win, address, value):
         pass
 
 
-def read(addr, val):
-    global kbd
-    if addr == 0xC000:
-        return kbd
-    elif addr == 0xC010:
-        kbd = kbd & 0x7F
-    return 0x00
-
-
 def write(win, addr, val):
     if 0x400 <= addr <= 0x800:
         write_screen(win, addr, val)
 
 
 def run(win):
-    global kbd
-
     listener = socket.socket()
     listener.bind(("127.0.0.1", 0))
     listener.listen(0)
@@ -66,6 +54,7 @@ def run(win):
         "cpu6502.py",
         "--bus", str(listener.getsockname()[1]),
         "--rom", options.rom,
+        "--control", str(options.control),
     ]
 
     subprocess.Popen(args)
@@ -74,15 +63,20 @@ def run(win):
     win.clear()
     curses.noecho()
     win.nodelay(True)
+    reader = BusReader(cpu)
+    cycle = 0
     while True:
-        op = cpu.recv(8)
-        cycle, rw, addr, val = struct.unpack("<IBHB", op)
-        if rw == 0:
-            cpu.send(chr(read(addr, val)))
-        elif rw == 1:
-            write(win, addr, val)
-        else:
+        # the core answers the keyboard itself, so the bus is quiet while
+        # it waits for a key
+        rs, _, _ = select.select([cpu], [], [], 0.05)
+        messages = reader.receive() if rs else []
+        if messages is None:
             break
+        for cycle, rw, addr, val in messages:
+            if rw == BUS_READ:
+                cpu.sendall(bus_frame(BUS_MESSAGE.pack(cycle, BUS_READ, addr, 0x00)))
+            elif rw == BUS_WRITE:
+                write(win, addr, val)
         try:
             key = ord(win.getkey())
             if key == 0xA:
@@ -90,7 +84,7 @@ def run(win):
             elif key == 0x7F:
                 key = 0x8
             # win.addstr(15, 50, hex(key))
-            kbd = 0x80 | key
+            cpu.sendall(bus_frame(BUS_MESSAGE.pack(cycle, BUS_WRITE, 0xC000, 0x80 | key)))
         except curses.error:
             pass
         except TypeError:
@@ -103,6 +97,7 @@ def usage():
     print >>sys.stderr
     print >>sys.stderr, "Usage: applepy_curses.py [options]"
     print >>sys.stderr
+    print >>sys.stderr, "    -C, --control  Core control port, 0 for any free one (default %d)" % CONTROL_PORT
     print >>sys.stderr, "    -R, --rom      ROM file to use (default A2ROM.BIN)"
     sys.exit(1)
 
@@ -110,13 +105,17 @@ def usage():
 def get_options():
     class Options:
         def __init__(self):
+            self.control = CONTROL_PORT
             self.rom = "A2ROM.BIN"
 
     options = Options()
     a = 1
     while a < len(sys.argv):
         if sys.argv[a].startswith("-"):
-            if sys.argv[a] in ("-R", "--rom"):
+            if sys.argv[a] in ("-C", "--control"):
+                a += 1
+                options.control = int(sys.argv[a])
+            elif sys.argv[a] in ("-R", "--rom"):
                 a += 1
                 options.rom = sys.argv[a]
             else:
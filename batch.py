@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# ApplePy - an Apple ][ emulator in Python
+# James Tauber / http://jtauber.com/
+# originally written 2001, updated 2011
+
+
+import binascii
+import json
+import multiprocessing
+import sys
+
+import farm
+from cpu6502 import Memory, CPU
+
+
+# Run headless jobs across a pool of processes. Each job is a JSON object
+# on a line of its own:
+#
+#     id        echoed back with the result (default the line number)
+#     data      hex string to load into RAM, or
+#     file      binary file to load into RAM
+#     load      address to load it at (default $0800)
+#     pc        start PC (default the reset vector)
+#     input     keys to type, newlines as RETURN (default none)
+#     cycles    cycles to run for at most (default farm.LIMIT)
+#     stop      PC to stop at (default stop when idle with the input used up)
+#
+# and each result is a line of JSON giving the text page, the registers,
+# the cycles run and why the job stopped (see farm.job), or an error.
+
+LOAD_ADDRESS = 0x0800
+
+rom = None  # ROM image, read once per worker
+translate = False
+
+
+def init(rom_path, translate_blocks):
+    global rom, translate
+    with open(rom_path, "rb") as f:
+        rom = f.read()
+    translate = translate_blocks
+
+
+def run_job(args):
+    number, line = args
+    job = {}
+    try:
+        job = json.loads(line)
+        memory = Memory(use_bus=False)
+        memory.rom.load(0xD000, rom)
+        if "data" in job:
+            memory.load(job.get("load", LOAD_ADDRESS), binascii.unhexlify(job["data"]))
+        elif "file" in job:
+            with open(job["file"], "rb") as f:
+                memory.load(job.get("load", LOAD_ADDRESS), f.read())
+        cpu = CPU(None, memory)
+        if translate:
+            cpu.enable_translation()
+        if "pc" in job:
+            cpu.program_counter = job["pc"]
+        result = farm.job(cpu, job.get("input", ""), job.get("cycles", farm.LIMIT), job.get("stop"))
+    except (AttributeError, IOError, KeyError, TypeError, ValueError) as e:
+        result = {"error": str(e)}
+    result["id"] = job.get("id", number) if isinstance(job, dict) else number
+    return result
+
+
+def read_jobs(f):
+    for number, line in enumerate(f, 1):
+        if line.strip():
+            yield number, line
+
+
+def usage():
+    print >>sys.stderr, "ApplePy - an Apple ][ emulator in Python"
+    print >>sys.stderr, "James Tauber / http://jtauber.com/"
+    print >>sys.stderr
+    print >>sys.stderr, "Usage: batch.py [options] [JOBS]"
+    print >>sys.stderr
+    print >>sys.stderr, "    -j, --jobs     Worker processes (default one per CPU)"
+    print >>sys.stderr, "    -R, --rom      ROM file to use (default A2ROM.BIN)"
+    print >>sys.stderr, "    -t, --translate Translate basic blocks (default interpret)"
+    print >>sys.stderr
+    print >>sys.stderr, "Jobs are read as JSON lines from JOBS (default standard input)."
+    sys.exit(1)
+
+
+def get_options():
+    class Options:
+        def __init__(self):
+            self.jobs = None
+            self.rom = "A2ROM.BIN"
+            self.translate = False
+            self.input = None
+
+    options = Options()
+    a = 1
+    while a < len(sys.argv):
+        if sys.argv[a].startswith("-"):
+            if sys.argv[a] in ("-j", "--jobs"):
+                a += 1
+                options.jobs = int(sys.argv[a])
+            elif sys.argv[a] in ("-R", "--rom"):
+                a += 1
+                options.rom = sys.argv[a]
+            elif sys.argv[a] in ("-t", "--translate"):
+                options.translate = True
+            else:
+                usage()
+        elif options.input is None:
+            options.input = sys.argv[a]
+        else:
+            usage()
+        a += 1
+
+    return options
+
+
+def main():
+    options = get_options()
+    f = open(options.input) if options.input else sys.stdin
+    pool = multiprocessing.Pool(options.jobs, init, (options.rom, options.translate))
+    try:
+        for result in pool.imap(run_job, read_jobs(f), 16):
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+    finally:
+        pool.terminate()
+
+
+if __name__ == "__main__":
+    main()
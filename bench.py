@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+# ApplePy - an Apple ][ emulator in Python
+# James Tauber / http://jtauber.com/
+# originally written 2001, updated 2011
+
+
+import json
+import resource
+import socket
+import struct
+import sys
+import threading
+import time
+
+import romgen
+from cpu6502 import Memory, CPU, Bus, BusReader
+
+
+# WORKLOADS
+#
+# Each workload is a program loaded into a fresh Memory(use_bus=False) and
+# run from start until the PC reaches end.
+
+# $1000: LDX #$00
+#        LDY #$80
+# $1004: CLC
+#        LDA $00
+#        ADC #$07
+#        STA $00
+#        LDA $01
+#        ADC #$00
+#        STA $01
+#        DEX
+#        BNE $1004
+#        DEY
+#        BNE $1004
+# $1017: (end)
+ARITHMETIC = [
+    0xA2, 0x00,
+    0xA0, 0x80,
+    0x18,
+    0xA5, 0x00,
+    0x69, 0x07,
+    0x85, 0x00,
+    0xA5, 0x01,
+    0x69, 0x00,
+    0x85, 0x01,
+    0xCA,
+    0xD0, 0xF0,
+    0x88,
+    0xD0, 0xED,
+]
+
+# copy $2000-$3FFF to $4000-$5FFF eight times
+# $1000: LDA #$08
+#        STA $F9
+# $1004: LDA #$00
+#        STA $FA
+#        STA $FC
+#        LDA #$20
+#        STA $FB
+#        LDA #$40
+#        STA $FD
+#        LDX #$20
+#        LDY #$00
+# $1016: LDA ($FA),Y
+#        STA ($FC),Y
+#        INY
+#        BNE $1016
+#        INC $FB
+#        INC $FD
+#        DEX
+#        BNE $1016
+#        DEC $F9
+#        BNE $1004
+# $1028: (end)
+COPY = [
+    0xA9, 0x08,
+    0x85, 0xF9,
+    0xA9, 0x00,
+    0x85, 0xFA,
+    0x85, 0xFC,
+    0xA9, 0x20,
+    0x85, 0xFB,
+    0xA9, 0x40,
+    0x85, 0xFD,
+    0xA2, 0x20,
+    0xA0, 0x00,
+    0xB1, 0xFA,
+    0x91, 0xFC,
+    0xC8,
+    0xD0, 0xF9,
+    0xE6, 0xFB,
+    0xE6, 0xFD,
+    0xCA,
+    0xD0, 0xF2,
+    0xC6, 0xF9,
+    0xD0, 0xDC,
+]
+
+# fill HIRES page 1 ($2000-$3FFF) eight times, with the pass count
+# $1000: LDA #$08
+#        STA $F9
+# $1004: LDA #$00
+#        STA $FA
+#        LDA #$20
+#        STA $FB
+#        LDX #$20
+#        LDY #$00
+#        LDA $F9
+# $1012: STA ($FA),Y
+#        INY
+#        BNE $1012
+#        INC $FB
+#        DEX
+#        BNE $1012
+#        DEC $F9
+#        BNE $1004
+# $1020: (end)
+HIRES_FILL = [
+    0xA9, 0x08,
+    0x85, 0xF9,
+    0xA9, 0x00,
+    0x85, 0xFA,
+    0xA9, 0x20,
+    0x85, 0xFB,
+    0xA2, 0x20,
+    0xA0, 0x00,
+    0xA5, 0xF9,
+    0x91, 0xFA,
+    0xC8,
+    0xD0, 0xFB,
+    0xE6, 0xFB,
+    0xCA,
+    0xD0, 0xF6,
+    0xC6, 0xF9,
+    0xD0, 0xE4,
+]
+
+
+def load_program(program):
+    def load(memory):
+        memory.load(0x1000, program)
+        return 0x1000, 0x1000 + len(program)
+    return load
+
+
+def load_synthetic_rom(memory):
+    # from reset to the keyboard loop, through the text output and
+    # compute kernels
+    labels = romgen.load(memory)
+    return labels["RESET"], labels["KEYLOOP"]
+
+
+WORKLOADS = [
+    ("arithmetic", load_program(ARITHMETIC)),
+    ("copy", load_program(COPY)),
+    ("hires", load_program(HIRES_FILL)),
+    ("boot", load_synthetic_rom),
+]
+
+ENGINES = ["reference", "fused", "exact", "translate"]
+
+
+def make_cpu(load, engine):
+    memory = Memory(use_bus=False)
+    start, end = load(memory)
+    cpu = CPU(None, memory)
+    if engine == "reference":
+        cpu.setup_reference_ops()
+    elif engine == "exact":
+        cpu.enable_exact_cycles()
+    elif engine == "translate":
+        cpu.enable_translation()
+    return cpu, start, end
+
+
+def count_instructions(load):
+    cpu, start, end = make_cpu(load, "fused")
+    count = 0
+    cpu.program_counter = start
+    while cpu.program_counter != end:
+        cpu.step()
+        count += 1
+    return count
+
+
+def peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_workload(name, load, engine, instructions):
+    cpu, start, end = make_cpu(load, engine)
+    begin = time.time()
+    cpu.test_run(start, end)
+    elapsed = time.time() - begin
+    return {
+        "workload": name,
+        "engine": engine,
+        "instructions": instructions,
+        "cycles": cpu.cycles,
+        "wall_time": elapsed,
+        "instructions_per_sec": instructions / elapsed,
+        "mhz": cpu.cycles / elapsed / 1e6,
+        "peak_rss_kb": peak_rss(),
+    }
+
+
+BUS_MESSAGES = 100000
+
+
+def receive_v1(sock, count):
+    # the version 1 display loop: one recv per 8-byte message
+    while count > 0:
+        sock.recv(8)
+        count -= 1
+
+
+def receive_v2(sock, count):
+    reader = BusReader(sock)
+    while count > 0:
+        count -= len(reader.receive())
+
+
+def bench_bus(version):
+    core, display = socket.socketpair()
+    receiver = threading.Thread(target=[receive_v1, receive_v2][version - 1], args=(display, BUS_MESSAGES))
+    receiver.start()
+    start = time.time()
+    if version == 1:
+        for i in xrange(BUS_MESSAGES):
+            core.send(struct.pack("<IBHB", 4 * i, 1, 0x400 + (i & 0x3FF), 0xA0))
+    else:
+        bus = Bus(core)
+        for i in xrange(BUS_MESSAGES):
+            bus.write(4 * i, 0x400 + (i & 0x3FF), 0xA0)
+        bus.flush()
+    receiver.join()
+    elapsed = time.time() - start
+    core.close()
+    display.close()
+    return {
+        "bus": version,
+        "messages": BUS_MESSAGES,
+        "wall_time": elapsed,
+        "messages_per_sec": BUS_MESSAGES / elapsed,
+    }
+
+
+def usage():
+    print >>sys.stderr, "ApplePy - an Apple ][ emulator in Python"
+    print >>sys.stderr, "James Tauber / http://jtauber.com/"
+    print >>sys.stderr
+    print >>sys.stderr, "Usage: bench.py [options]"
+    print >>sys.stderr
+    print >>sys.stderr, "    -e, --engine   Engine to run (repeatable; default %s)" % ", ".join(ENGINES)
+    print >>sys.stderr, "    -n, --no-bus   Skip the bus benchmarks"
+    print >>sys.stderr, "    -w, --workload Workload to run (repeatable; default %s)" % ", ".join(name for name, load in WORKLOADS)
+    sys.exit(1)
+
+
+def get_options():
+    class Options:
+        def __init__(self):
+            self.engines = []
+            self.workloads = []
+            self.bus = True
+
+    options = Options()
+    a = 1
+    while a < len(sys.argv):
+        if sys.argv[a].startswith("-"):
+            if sys.argv[a] in ("-e", "--engine"):
+                a += 1
+                if sys.argv[a] not in ENGINES:
+                    usage()
+                options.engines.append(sys.argv[a])
+            elif sys.argv[a] in ("-n", "--no-bus"):
+                options.bus = False
+            elif sys.argv[a] in ("-w", "--workload"):
+                a += 1
+                if sys.argv[a] not in dict(WORKLOADS):
+                    usage()
+                options.workloads.append(sys.argv[a])
+            else:
+                usage()
+        else:
+            usage()
+        a += 1
+
+    return options
+
+
+def main():
+    options = get_options()
+    engines = options.engines or ENGINES
+    results = {"workloads": [], "bus": []}
+    for name, load in WORKLOADS:
+        if options.workloads and name not in options.workloads:
+            continue
+        instructions = count_instructions(load)
+        for engine in engines:
+            results["workloads"].append(bench_workload(name, load, engine, instructions))
+    if options.bus:
+        for version in (1, 2):
+            results["bus"].append(bench_bus(version))
+    results["peak_rss_kb"] = peak_rss()
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
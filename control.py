@@ -5,6 +5,14 @@ import urllib
 URL_PREFIX = "http://localhost:6502"
 
 
+def set_target(target):
+    """Talk to the core at PORT or HOST:PORT from now on."""
+    global URL_PREFIX
+    if ":" not in target:
+        target = "localhost:" + target
+    URL_PREFIX = "http://" + target
+
+
 def get(url):
     return json.loads(urllib.urlopen(URL_PREFIX + url).read())
 
@@ -13,6 +21,10 @@ def post(url, data=None):
     return urllib.urlopen(URL_PREFIX + url, json.dumps(data) if data is not None else "")
 
 
+def post_raw(url, data):
+    return urllib.urlopen(URL_PREFIX + url, data)
+
+
 def value(s):
     if s.startswith("$"):
         return int(s[1:], 16)
@@ -112,6 +124,12 @@ def cmd_poke(a):
     post("/memory/%d" % addr, [val])
 
 
+def cmd_save(a):
+    """Save a snapshot file: save FILE"""
+    with open(a[1], "wb") as f:
+        f.write(urllib.urlopen(URL_PREFIX + "/snapshot").read())
+
+
 def cmd_status(a):
     """CPU status"""
     status = get("/status")
@@ -133,6 +151,30 @@ def cmd_status(a):
     print format_disassemble(disasm[0])
 
 
+def cmd_profile(a):
+    """Profile: profile [on|off|clear|N] shows the N hottest addresses and the opcodes"""
+    if len(a) > 1 and a[1] in ("on", "off", "clear"):
+        post("/profile/%s" % a[1])
+        return
+    n = value(a[1]) if len(a) > 1 else 20
+    try:
+        hot = get("/profile/hot/%d" % n)
+    except ValueError:
+        print "Profiling is off"
+        return
+    for d in hot:
+        print "%5.1f%% %10d %10d  %s" % (100 * d["share"], d["count"], d["cycles"], format_disassemble(d))
+    print
+    for d in get("/profile/opcodes"):
+        print "%02X %s %10d %10d" % (d["opcode"], d["mnemonic"], d["count"], d["cycles"])
+
+
+def cmd_load(a):
+    """Restore a snapshot file: load FILE"""
+    with open(a[1], "rb") as f:
+        post_raw("/snapshot", f.read())
+
+
 def cmd_quit(a):
     """Quit"""
     sys.exit(0)
@@ -142,19 +184,62 @@ def cmd_reset(a):
     """Reset"""
     post("/reset")
 
+
+def cmd_target(a):
+    """Show or change the core to control: target [PORT|HOST:PORT]"""
+    if len(a) > 1:
+        set_target(a[1])
+    print URL_PREFIX[len("http://"):]
+
+
+def cmd_traps(a):
+    """List ROM traps, or turn one on or off: traps [NAME on|off]"""
+    if len(a) > 2:
+        post("/traps/%s/%s" % (a[1].upper(), a[2]))
+    traps = get("/traps")
+    for name in sorted(traps):
+        print "%-6s %04X %s" % (name, traps[name]["address"], "on" if traps[name]["enabled"] else "off")
+
 Commands = {
     "disassemble": cmd_disassemble,
     "dump": cmd_dump,
     "help": cmd_help,
+    "load": cmd_load,
     "peek": cmd_peek,
     "poke": cmd_poke,
+    "profile": cmd_profile,
     "status": cmd_status,
+    "target": cmd_target,
     "quit": cmd_quit,
     "reset": cmd_reset,
+    "save": cmd_save,
+    "traps": cmd_traps,
 }
 
 
+def usage():
+    print >>sys.stderr, "ApplePy - an Apple ][ emulator in Python"
+    print >>sys.stderr, "James Tauber / http://jtauber.com/"
+    print >>sys.stderr
+    print >>sys.stderr, "Usage: control.py [options]"
+    print >>sys.stderr
+    print >>sys.stderr, "    -t, --target   Core control PORT or HOST:PORT (default localhost:6502)"
+    sys.exit(1)
+
+
+def get_options():
+    a = 1
+    while a < len(sys.argv):
+        if sys.argv[a] in ("-t", "--target"):
+            a += 1
+            set_target(sys.argv[a])
+        else:
+            usage()
+        a += 1
+
+
 def main():
+    get_options()
     print "ApplePy control console"
     while True:
         s = raw_input("6502> ")
@@ -4,15 +4,238 @@
 
 
 import BaseHTTPServer
+import array
+import ctypes
+import heapq
+import itertools
 import json
+import mmap
 import re
 import select
 import socket
 import struct
 import sys
-
-
-bus = None  # socket for bus I/O
+import time
+
+
+CPU_HZ = 1023000
+FRAME_CYCLES = 17030  # one video frame at 1.023 MHz
+CONTROL_PORT = 6502
+
+
+# Bus protocol version 3: after a hello giving the core's control server
+# port (0 if it has none), each side sends length-prefixed frames, each holding a batch of fixed-size messages. Writes from the core
+# are coalesced and flushed at a cycle or size threshold, or before any
+# synchronous read; a read is answered by a message of the same type
+# carrying the value. Writes from the display (key presses) may arrive at
+# any time and are handed to the core's input handler.
+
+BUS_VERSION = 3
+BUS_HELLO = struct.Struct("<4sBH")  # magic, version, control port
+BUS_FRAME = struct.Struct("<H")  # payload length in bytes
+BUS_MESSAGE = struct.Struct("<QBHB")  # cycle, type, address, value
+
+BUS_READ = 0
+BUS_WRITE = 1
+
+
+def bus_frame(payload):
+    return BUS_FRAME.pack(len(payload)) + payload
+
+
+class BusReader:
+    """Buffered framing for the receiving side of a bus socket."""
+
+    def __init__(self, sock, hello=True):
+        self.sock = sock
+        self.buffer = ""
+        # only the core announces itself; replies to it come unannounced
+        self.version = None if hello else BUS_VERSION
+        self.control_port = None
+
+    def receive(self):
+        """
+        Block until data arrives and return the list of complete messages
+        (possibly empty), or None at end of stream.
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            return None
+        self.buffer += data
+        if self.version is None:
+            if len(self.buffer) < BUS_HELLO.size:
+                return []
+            magic, self.version, self.control_port = BUS_HELLO.unpack_from(self.buffer)
+            if magic != "A2BS" or self.version != BUS_VERSION:
+                raise IOError("unsupported bus protocol")
+            self.buffer = self.buffer[BUS_HELLO.size:]
+        messages = []
+        while len(self.buffer) >= BUS_FRAME.size:
+            length, = BUS_FRAME.unpack_from(self.buffer)
+            end = BUS_FRAME.size + length
+            if len(self.buffer) < end:
+                break
+            for offset in range(BUS_FRAME.size, end, BUS_MESSAGE.size):
+                messages.append(BUS_MESSAGE.unpack_from(self.buffer, offset))
+            self.buffer = self.buffer[end:]
+        return messages
+
+
+class Bus:
+    """The core's side of a bus socket."""
+
+    FLUSH_CYCLES = FRAME_CYCLES
+    FLUSH_SIZE = 512  # messages
+
+    def __init__(self, sock, input=None, control_port=0):
+        self.sock = sock
+        self.reader = BusReader(sock, hello=False)
+        self.input = input  # called with (cycle, address, value) per display write
+        self.pending = []
+        self.first_cycle = 0
+        sock.sendall(BUS_HELLO.pack("A2BS", BUS_VERSION, control_port))
+
+    def write(self, cycle, address, value):
+        if not self.pending:
+            self.first_cycle = cycle
+        self.pending.append(BUS_MESSAGE.pack(cycle, BUS_WRITE, address, value))
+        if len(self.pending) >= self.FLUSH_SIZE or cycle - self.first_cycle >= self.FLUSH_CYCLES:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.sock.sendall(bus_frame("".join(self.pending)))
+            self.pending = []
+
+    def read(self, cycle, address):
+        self.pending.append(BUS_MESSAGE.pack(cycle, BUS_READ, address, 0))
+        self.flush()
+        result = None
+        while result is None:
+            for message in self.receive():
+                if message[1] == BUS_READ:
+                    result = message[3]
+        return result
+
+    def poll(self):
+        """Handle any display writes waiting on the socket without blocking."""
+        while select.select([self.sock], [], [], 0)[0]:
+            self.receive()
+
+    def receive(self):
+        messages = self.reader.receive()
+        if messages is None:
+            raise EOFError
+        for cycle, rw, address, value in messages:
+            if rw == BUS_WRITE and self.input is not None:
+                self.input(cycle, address, value)
+        return messages
+
+
+class Scheduler:
+    """
+    Events keyed on the CPU cycle count. Callbacks take the current cycle
+    and may repeat every period cycles; ties run in the order added.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.sequence = itertools.count()
+
+    def add(self, cycle, callback, period=None):
+        heapq.heappush(self.events, (cycle, next(self.sequence), callback, period))
+
+    def every(self, period, callback, cycle=0):
+        self.add(cycle + period, callback, period)
+
+    def next_deadline(self):
+        return self.events[0][0]
+
+    def run(self, cycle):
+        """Call every event due by cycle, rescheduling periodic ones."""
+        events = self.events
+        while events and events[0][0] <= cycle:
+            due, _, callback, period = heapq.heappop(events)
+            if period is not None:
+                self.add(due + period, callback, period)
+            callback(cycle)
+
+    def shift(self, delta):
+        """Move every event by delta cycles, as when the cycle count jumps."""
+        self.events = [(cycle + delta, sequence, callback, period) for cycle, sequence, callback, period in self.events]
+
+
+class Throttle:
+    """
+    Paces the cycle count against the wall clock at speed times 1.023 MHz,
+    sleeping when ahead; a speed of None runs flat out. If report is set,
+    the achieved speed is printed every REPORT_TIME seconds.
+    """
+
+    REPORT_TIME = 5.0
+    MAX_LAG = 0.1  # seconds behind before giving up on catching up
+
+    def __init__(self, speed=1.0, report=False):
+        self.speed = speed
+        self.report = report
+        self.base_time = None
+        self.report_time = None
+
+    def schedule(self, scheduler):
+        scheduler.every(FRAME_CYCLES, self.pace)
+
+    def restart(self):
+        """Pace afresh from the next frame, as when the cycle count jumps."""
+        self.base_time = None
+
+    def pace(self, cycle):
+        now = time.time()
+        if self.base_time is None:
+            self.base_time = self.report_time = now
+            self.base_cycle = self.report_cycle = cycle
+            return
+        if self.speed is not None:
+            ahead = (cycle - self.base_cycle) / (CPU_HZ * self.speed) - (now - self.base_time)
+            if ahead > 0:
+                time.sleep(ahead)
+            elif ahead < -self.MAX_LAG:
+                # the host stalled; carry on from here rather than race
+                self.base_time = now
+                self.base_cycle = cycle
+        if self.report and now - self.report_time >= self.REPORT_TIME:
+            mhz = (cycle - self.report_cycle) / (now - self.report_time) / 1e6
+            print >>sys.stderr, "%.3f MHz" % mhz
+            self.report_time = now
+            self.report_cycle = cycle
+
+
+class Profile:
+    """
+    Instruction counts and cycles per PC and per opcode, kept in flat
+    arrays indexed by address and by opcode. Cycles spent taking
+    interrupts or skipped over idle loops are not attributed.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.pc_count = array.array("L", [0]) * 0x10000
+        self.pc_cycles = array.array("L", [0]) * 0x10000
+        self.op_count = array.array("L", [0]) * 0x100
+        self.op_cycles = array.array("L", [0]) * 0x100
+
+    def hot(self, n):
+        """The n addresses with most cycles, as (pc, count, cycles)."""
+        pcs = [pc for pc in xrange(0x10000) if self.pc_count[pc]]
+        pcs.sort(key=lambda pc: -self.pc_cycles[pc])
+        return [(pc, self.pc_count[pc], self.pc_cycles[pc]) for pc in pcs[:n]]
+
+    def opcodes(self):
+        """Every opcode executed, as (op, count, cycles), most cycles first."""
+        ops = [op for op in range(0x100) if self.op_count[op]]
+        ops.sort(key=lambda op: -self.op_cycles[op])
+        return [(op, self.op_count[op], self.op_cycles[op]) for op in ops]
 
 
 def signed(x):
@@ -26,21 +249,25 @@ class ROM:
     def __init__(self, start, size):
         self.start = start
         self.end = start + size - 1
-        self._mem = [0x00] * size
+        self._mem = bytearray(size)
 
     def load(self, address, data):
-        for offset, datum in enumerate(data):
-            self._mem[address - self.start + offset] = datum
+        offset = address - self.start
+        self._mem[offset:offset + len(data)] = bytearray(data)
 
     def load_file(self, address, filename):
         with open(filename, "rb") as f:
-            for offset, datum in enumerate(f.read()):
-                self._mem[address - self.start + offset] = ord(datum)
+            self.load(address, f.read())
 
     def read_byte(self, address):
         assert self.start <= address <= self.end
         return self._mem[address - self.start]
 
+    def view(self, start, end):
+        """Zero-copy buffer over start..end inclusive."""
+        assert self.start <= start <= end <= self.end
+        return memoryview(self._mem)[start - self.start:end - self.start + 1]
+
 
 class RAM(ROM):
 
@@ -48,10 +275,58 @@ class RAM(ROM):
         self._mem[address] = value
 
 
+def split_read(outside, inside, lo, hi):
+    return lambda cycle, address: inside(cycle, address) if lo <= address <= hi else outside(cycle, address)
+
+
+def split_write(outside, inside, lo, hi):
+    def write(cycle, address, value):
+        if lo <= address <= hi:
+            inside(cycle, address, value)
+        else:
+            outside(cycle, address, value)
+    return write
+
+
+VIDEO_PAGES = range(0x04, 0x08) + range(0x20, 0x60)
+VIDEO_SIZE = 0x6000  # RAM shared with the display, $0000-$5FFF
+VIDEO_SHM_SIZE = VIDEO_SIZE + (VIDEO_SIZE >> 8)  # then a dirty flag per page
+
+
+class SharedVideo:
+    """
+    Video RAM in a file-backed mmap shared by the core and the display:
+    the RAM image up to $5FFF followed by one dirty flag per page.
+    """
+
+    def __init__(self, path, create=False):
+        with open(path, "w+b" if create else "r+b") as f:
+            if create:
+                f.truncate(VIDEO_SHM_SIZE)
+            self.mmap = mmap.mmap(f.fileno(), VIDEO_SHM_SIZE)
+        self.ram = (ctypes.c_ubyte * VIDEO_SIZE).from_buffer(self.mmap)
+        self.dirty = (ctypes.c_ubyte * (VIDEO_SIZE >> 8)).from_buffer(self.mmap, VIDEO_SIZE)
+
+    def dirty_pages(self):
+        """
+        Return the video pages written since the last call, clearing their
+        flags before the caller reads them so no write is missed.
+        """
+        flags = self.mmap[VIDEO_SIZE:]
+        pages = [page for page in VIDEO_PAGES if flags[page] != "\0"]
+        for page in pages:
+            self.dirty[page] = 0
+        return pages
+
+    def read_page(self, page):
+        return self.mmap[page << 8:(page + 1) << 8]
+
+
 class Memory:
 
     def __init__(self, options=None, use_bus=True):
         self.use_bus = use_bus
+        self.bus = None  # set once connected, unless use_bus is False
         self.rom = ROM(0xD000, 0x3000)
 
         if options:
@@ -62,17 +337,112 @@ class Memory:
         if options and options.ram:
             self.ram.load_file(0x0000, options.ram)
 
+        self.video = None
+
+        # state kept here rather than behind a bus round trip
+        self.kbd = 0x00
+        self.switches = [1, 0, 0, 0]  # TEXT, MIXED, PAGE2, HIRES
+
+        # one read and one write handler per 256-byte page, indexed by the
+        # high byte of the address
+        self.read_map = [None] * 0x100
+        self.write_map = [None] * 0x100
+        for page in range(0x00, 0xC0):
+            self.read_map[page] = self.read_ram
+            self.write_map[page] = self.write_ram
+        for page in VIDEO_PAGES:
+            self.write_map[page] = self.write_video
+        self.read_map[0xC0] = self.read_io
+        self.write_map[0xC0] = self.write_none
+        for page in range(0xC1, 0xD0):
+            self.read_map[page] = self.bus_read
+            self.write_map[page] = self.write_none
+        for page in range(0xD0, 0x100):
+            self.read_map[page] = self.read_rom
+            self.write_map[page] = self.write_none
+
+        if options and options.video:
+            self.share_video(SharedVideo(options.video))
+
+        self.code_written = False
+        self.translator = None
+
+    def share_video(self, video):
+        """
+        Mirror the video pages into a SharedVideo instead of sending each
+        write over the bus; the display polls the dirty flags per frame.
+        """
+        self.video = video
+        ctypes.memmove(video.ram, bytes(self.ram._mem[:VIDEO_SIZE]), VIDEO_SIZE)
+        for page in VIDEO_PAGES:
+            video.dirty[page] = 1
+            self.write_map[page] = self.write_shared_video
+
+    def claim(self, start, end, read=None, write=None):
+        """
+        Route reads and/or writes of start..end to the given handlers,
+        taking (cycle, address) and (cycle, address, value) respectively.
+        Partially covered pages keep their previous handlers for the rest.
+        """
+        for page in range(start >> 8, (end >> 8) + 1):
+            lo = max(start, page << 8)
+            hi = min(end, (page << 8) | 0xFF)
+            whole = lo & 0xFF == 0x00 and hi & 0xFF == 0xFF
+            if read is not None:
+                self.read_map[page] = read if whole else split_read(self.read_map[page], read, lo, hi)
+            if write is not None:
+                self.write_map[page] = write if whole else split_write(self.write_map[page], write, lo, hi)
+
     def load(self, address, data):
         if address < 0xC000:
             self.ram.load(address, data)
 
-    def read_byte(self, cycle, address):
-        if address < 0xC000:
-            return self.ram.read_byte(address)
-        elif address < 0xD000:
-            return self.bus_read(cycle, address)
+    def restore(self, cycle, ram, kbd, switches):
+        """
+        Replace all of RAM and the keyboard latch and display switches in
+        one go, then bring the display up to date: every switch is reported
+        and every video page that changed is rewritten.
+        """
+        mem = self.ram._mem
+        changed = [page for page in VIDEO_PAGES if mem[page << 8:(page + 1) << 8] != ram[page << 8:(page + 1) << 8]]
+        mem[:] = ram
+        self.kbd = kbd
+        for switch, value in enumerate(switches):
+            self.switches[switch] = value
+            self.bus_write(cycle, 0xC050 + 2 * switch + value, 0x00)
+        for page in changed:
+            if self.video is not None:
+                self.video.mmap[page << 8:(page + 1) << 8] = str(mem[page << 8:(page + 1) << 8])
+                self.video.dirty[page] = 1
+            else:
+                for address in range(page << 8, (page + 1) << 8):
+                    self.bus_write(cycle, address, mem[address])
+        self.bus_flush()
+
+    def view(self, start, end):
+        """
+        Zero-copy buffer over start..end inclusive if it lies wholly in RAM
+        or wholly in ROM, otherwise None (reads would hit the I/O space).
+        """
+        for m in (self.ram, self.rom):
+            if m.start <= start <= end <= m.end:
+                return m.view(start, end)
+        return None
+
+    def write_range(self, address, data):
+        """
+        Copy data into memory starting at address; a single bulk copy
+        when every page involved is plain RAM.
+        """
+        end = address + len(data) - 1
+        if end < 0xC000 and all(self.write_map[page] == self.write_ram for page in range(address >> 8, (end >> 8) + 1)):
+            self.ram.load(address, data)
         else:
-            return self.rom.read_byte(address)
+            for offset, datum in enumerate(bytearray(data)):
+                self.write_byte(None, address + offset, datum)
+
+    def read_byte(self, cycle, address):
+        return self.read_map[address >> 8](cycle, address)
 
     def read_word(self, cycle, address):
         return self.read_byte(cycle, address) + (self.read_byte(cycle + 1, address + 1) << 8)
@@ -84,33 +454,81 @@ class Memory:
             return self.read_word(cycle, address)
 
     def write_byte(self, cycle, address, value):
-        if address < 0xC000:
-            self.ram.write_byte(address, value)
-        if 0x400 <= address < 0x800 or 0x2000 <= address < 0x5FFF:
-            self.bus_write(cycle, address, value)
+        self.write_map[address >> 8](cycle, address, value)
+
+    def read_ram(self, cycle, address):
+        return self.ram._mem[address]
+
+    def read_rom(self, cycle, address):
+        return self.rom._mem[address - 0xD000]
+
+    def write_ram(self, cycle, address, value):
+        self.ram._mem[address] = value
+
+    def write_video(self, cycle, address, value):
+        self.ram._mem[address] = value
+        self.bus_write(cycle, address, value)
+
+    def write_shared_video(self, cycle, address, value):
+        self.ram._mem[address] = value
+        self.video.ram[address] = value
+        self.video.dirty[address >> 8] = 1
+
+    def write_none(self, cycle, address, value):
+        pass
+
+    def read_io(self, cycle, address):
+        # the keyboard latch and display switches are answered locally;
+        # switch changes are reported to the display without waiting
+        if address == 0xC000:
+            return self.kbd
+        elif address == 0xC010:
+            self.kbd = self.kbd & 0x7F
+            return 0x00
+        elif 0xC050 <= address <= 0xC057:
+            switch = (address - 0xC050) >> 1
+            if self.switches[switch] != address & 1:
+                self.switches[switch] = address & 1
+                self.bus_write(cycle, address, 0x00)
+            return 0x00
+        return self.bus_read(cycle, address)
+
+    def bus_input(self, cycle, address, value):
+        if address == 0xC000:
+            self.kbd = value
 
     def bus_read(self, cycle, address):
         if not self.use_bus:
             return 0
-        op = struct.pack("<IBHB", cycle, 0, address, 0)
         try:
-            bus.send(op)
-            b = bus.recv(1)
-            if len(b) == 0:
-                sys.exit(0)
-            return ord(b)
-        except socket.error:
+            return self.bus.read(cycle, address)
+        except (socket.error, EOFError):
             sys.exit(0)
 
     def bus_write(self, cycle, address, value):
         if not self.use_bus:
             return
-        op = struct.pack("<IBHB", cycle, 1, address, value)
         try:
-            bus.send(op)
+            self.bus.write(cycle, address, value)
         except IOError:
             sys.exit(0)
 
+    def bus_flush(self):
+        if not self.use_bus:
+            return
+        try:
+            self.bus.flush()
+        except IOError:
+            sys.exit(0)
+
+    def bus_poll(self):
+        if not self.use_bus:
+            return
+        try:
+            self.bus.poll()
+        except (socket.error, EOFError):
+            sys.exit(0)
+
 
 class Disassemble:
     def __init__(self, cpu, memory):
@@ -354,6 +772,8 @@ class Disassemble:
 
     def disasm(self, pc):
         op = self.cpu.read_byte(pc)
+        if pc in self.cpu.traps:
+            op = self.cpu.traps[pc][2]
         info = self.ops[op]
         r = {
             "address": pc,
@@ -375,14 +795,21 @@ class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             r"/disassemble/(\d+)$": self.get_disassemble,
             r"/memory/(\d+)(-(\d+))?$": self.get_memory,
             r"/memory/(\d+)(-(\d+))?/raw$": self.get_memory_raw,
+            r"/profile/hot/(\d+)$": self.get_profile_hot,
+            r"/profile/opcodes$": self.get_profile_opcodes,
+            r"/snapshot$": self.get_snapshot,
             r"/status$": self.get_status,
+            r"/traps$": self.get_traps,
         }
 
         self.post_urls = {
             r"/memory/(\d+)(-(\d+))?$": self.post_memory,
             r"/memory/(\d+)(-(\d+))?/raw$": self.post_memory_raw,
+            r"/profile/(on|off|clear)$": self.post_profile,
             r"/quit$": self.post_quit,
             r"/reset$": self.post_reset,
+            r"/snapshot$": self.post_snapshot,
+            r"/traps/(\w+)/(on|off)$": self.post_trap,
         }
 
         BaseHTTPServer.BaseHTTPRequestHandler.__init__(self, request, client_address, server)
@@ -406,6 +833,13 @@ class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(s)
 
+    def response_raw(self, view):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(view)))
+        self.end_headers()
+        self.wfile.flush()
+        self.connection.sendall(view)
+
     def do_GET(self):
         self.dispatch(self.get_urls)
 
@@ -430,7 +864,11 @@ class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             end = int(e)
         else:
             end = addr
-        self.response("".join([chr(self.cpu.read_byte(x)) for x in range(addr, end + 1)]))
+        view = self.cpu.memory.view(addr, end)
+        if view is not None:
+            self.response_raw(view)
+        else:
+            self.response("".join([chr(self.cpu.read_byte(x)) for x in range(addr, end + 1)]))
 
     def get_memory(self, m):
         addr = int(m.group(1))
@@ -439,7 +877,44 @@ class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             end = int(e)
         else:
             end = addr
-        self.response(json.dumps(list(map(self.cpu.read_byte, range(addr, end + 1)))))
+        view = self.cpu.memory.view(addr, end)
+        if view is not None:
+            self.response(json.dumps(view.tolist()))
+        else:
+            self.response(json.dumps(list(map(self.cpu.read_byte, range(addr, end + 1)))))
+
+    def get_profile_hot(self, m):
+        profile = self.cpu.profile
+        if profile is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        total = sum(profile.pc_cycles)
+        r = []
+        for pc, count, cycles in profile.hot(int(m.group(1))):
+            dis, length = self.disassemble.disasm(pc)
+            dis.update({"count": count, "cycles": cycles, "share": float(cycles) / total})
+            r.append(dis)
+        self.response(json.dumps(r))
+
+    def get_profile_opcodes(self, m):
+        profile = self.cpu.profile
+        if profile is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        r = []
+        for op, count, cycles in profile.opcodes():
+            r.append({
+                "opcode": op,
+                "mnemonic": self.disassemble.ops[op][1],
+                "count": count,
+                "cycles": cycles,
+            })
+        self.response(json.dumps(r))
+
+    def get_snapshot(self, m):
+        self.response(self.cpu.snapshot())
 
     def get_status(self, m):
         self.response(json.dumps(dict((x, getattr(self.cpu, x)) for x in (
@@ -457,6 +932,12 @@ class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             "carry_flag",
         ))))
 
+    def get_traps(self, m):
+        traps = {}
+        for name, (address, handler) in TRAPS.items():
+            traps[name] = {"address": address, "enabled": address in self.cpu.traps}
+        self.response(json.dumps(traps))
+
     def post_memory(self, m):
         addr = int(m.group(1))
         e = m.group(3)
@@ -477,8 +958,16 @@ class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         else:
             end = addr
         data = self.rfile.read(int(self.headers["Content-Length"]))
-        for i, a in enumerate(range(addr, end + 1)):
-            self.cpu.write_byte(a, data[i])
+        self.cpu.memory.write_range(addr, data[:end + 1 - addr])
+        self.response("")
+
+    def post_profile(self, m):
+        if m.group(1) == "on":
+            self.cpu.enable_profile()
+        elif m.group(1) == "off":
+            self.cpu.disable_profile()
+        elif self.cpu.profile is not None:
+            self.cpu.profile.clear()
         self.response("")
 
     def post_quit(self, m):
@@ -490,6 +979,29 @@ class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.cpu.running = True
         self.response("")
 
+    def post_snapshot(self, m):
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        try:
+            self.cpu.restore(data)
+        except IOError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        self.cpu.running = True
+        self.response("")
+
+    def post_trap(self, m):
+        name = m.group(1).upper()
+        if name not in TRAPS:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if m.group(2) == "on":
+            self.cpu.enable_trap(name)
+        else:
+            self.cpu.disable_trap(name)
+        self.response("")
+
 
 class ControlHandlerFactory:
 
@@ -500,40 +1012,101 @@ class ControlHandlerFactory:
         return ControlHandler(request, client_address, server, self.cpu)
 
 
-class CPU:
+# Snapshot version 1: a header, the CPU registers and cycle count, the
+# keyboard latch and display switches, then RAM $0000-$BFFF. The ROM is
+# not included, nor which devices hold the IRQ line.
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sB")  # magic, version
+SNAPSHOT_STATE = struct.Struct("<QBBBBHHBBBBBBB4B")
+SNAPSHOT_SIZE = SNAPSHOT_HEADER.size + SNAPSHOT_STATE.size + 0xC000
+
+
+class CPU(object):
 
     STACK_PAGE = 0x100
+    NMI_VECTOR = 0xFFFA
     RESET_VECTOR = 0xFFFC
+    IRQ_VECTOR = 0xFFFE
+    POLL_CYCLES = 4096  # between checks of the control and bus sockets
+    IDLE_WAIT = float(POLL_CYCLES) / CPU_HZ  # block idle slices to real time
 
     def __init__(self, options, memory):
         self.memory = memory
 
-        self.control_server = BaseHTTPServer.HTTPServer(("127.0.0.1", 6502), ControlHandlerFactory(self))
-
         self.accumulator = 0x00
         self.x_index = 0x00
         self.y_index = 0x00
 
         self.carry_flag = 0
-        self.zero_flag = 0
+        self.nz = 0x01  # N and Z clear; see zero_flag and sign_flag
         self.interrupt_disable_flag = 0
         self.decimal_mode_flag = 0
         self.break_flag = 1
         self.overflow_flag = 0
-        self.sign_flag = 0
 
         self.stack_pointer = 0xFF
 
-        self.cycles = 0
+        self.irq_sources = set()  # devices holding the IRQ line low
+        self.nmi_pending = False
+        self.interrupts = False  # either of the above, tested before each instruction
 
+        self.cycles = 0
+        self.scheduler = Scheduler()
+        self.control_server = None
+        self.bus_socket = None
+
+        self.translator = None
+        self.profile = None
+        self.traps = {}
+        self.exact = options is not None and options.exact
         self.setup_ops()
         self.reset()
-        if options.pc is not None:
+        if options is not None and options.pc is not None:
             self.program_counter = options.pc
+        if options is not None and options.translate:
+            self.enable_translation()
+        if options is not None and options.profile:
+            self.enable_profile()
+        if options is not None:
+            for name in options.traps:
+                self.enable_trap(name)
+        self.throttle = None
+        if options is not None and (options.speed is not None or options.report):
+            self.throttle = Throttle(options.speed, options.report)
+            self.throttle.schedule(self.scheduler)
+        self.restore_path = options.restore if options is not None else None
+        self.snapshot_path = options.snapshot if options is not None else None
+        self.record_file = None
+        if options is not None and options.record is not None:
+            self.record_file = open(options.record, "w", 1)
+        self.replay_path = options.replay if options is not None else None
+        self.replaying = False
         self.running = True
         self.quit = False
 
     def setup_ops(self):
+        self.ops = (build_exact_ops if self.exact else build_fused_ops)(self)
+
+    def enable_translation(self):
+        self.translator = Translator(self)
+
+    def enable_profile(self):
+        if self.profile is None:
+            self.profile = Profile()
+
+    def disable_profile(self):
+        self.profile = None
+
+    def enable_exact_cycles(self):
+        self.exact = True
+        self.setup_ops()
+        if self.translator is not None:
+            self.translator.flush()
+
+    def setup_reference_ops(self):
+        # the original dispatch through the addressing mode and operation
+        # methods; kept as the reference the fused handlers are tested against
         self.ops = [None] * 0x100
         self.ops[0x00] = lambda: self.BRK()
         self.ops[0x01] = lambda: self.ORA(self.indirect_x_mode())
@@ -690,57 +1263,440 @@ class CPU:
     def reset(self):
         self.program_counter = self.read_word(self.RESET_VECTOR)
 
-    def run(self, bus_port):
-        global bus
-        bus = socket.socket()
-        bus.connect(("127.0.0.1", bus_port))
-
-        while not self.quit:
-
-            timeout = 0
-            if not self.running:
-                timeout = 1
-            # Currently this handler blocks from the moment
-            # a connection is accepted until the response
-            # is sent. TODO: use an async HTTP server that
-            # handles input data asynchronously.
-            sockets = [self.control_server]
-            rs, _, _ = select.select(sockets, [], [], timeout)
-            for s in rs:
-                if s is self.control_server:
-                    self.control_server._handle_request_noblock()
+    def run(self, bus_port, control_port=CONTROL_PORT):
+        """
+        Serve the control port (None for none, 0 for any free one), then
+        connect to the display's bus port, report the control port in the
+        hello and run.
+        """
+        if control_port is not None:
+            self.control_server = BaseHTTPServer.HTTPServer(("127.0.0.1", control_port), ControlHandlerFactory(self))
+            control_port = self.control_server.server_address[1]
+
+        self.bus_socket = socket.socket()
+        self.bus_socket.connect(("127.0.0.1", bus_port))
+        self.memory.bus = Bus(self.bus_socket, self.input, control_port or 0)
+
+        self.scheduler.every(self.POLL_CYCLES, lambda cycle: self.poll(0))
+        self.scheduler.every(FRAME_CYCLES, lambda cycle: self.memory.bus_flush())
+        self.loop()
+
+    def loop(self):
+        """
+        Run to each event deadline in turn until told to quit, starting
+        from the restore snapshot and ending with the save one, if given.
+        """
+        if self.restore_path is not None:
+            self.load_snapshot(self.restore_path)
+        if self.replay_path is not None:
+            self.load_replay(self.replay_path)
+        scheduler = self.scheduler
+        try:
+            while not self.quit:
+                if self.running:
+                    until = scheduler.next_deadline()
+                    if self.interrupts and self.interrupt():
+                        self.execute(until)
+                    elif self.skip_idle(until):
+                        if self.throttle is None or self.throttle.speed is None:
+                            # nothing paces us, so wait for input instead
+                            self.poll(self.IDLE_WAIT)
+                    elif not self.skip_countdown(until):
+                        self.execute(until)
+                    scheduler.run(self.cycles)
                 else:
-                    pass
-
-            count = 1000
-            while count > 0 and self.running:
+                    self.poll(1)
+        finally:
+            if self.snapshot_path is not None:
+                self.save_snapshot(self.snapshot_path)
+
+    def poll(self, timeout):
+        # Currently this handler blocks from the moment
+        # a connection is accepted until the response
+        # is sent. TODO: use an async HTTP server that
+        # handles input data asynchronously.
+        sockets = [s for s in (self.control_server, self.bus_socket) if s is not None]
+        rs, _, _ = select.select(sockets, [], [], timeout)
+        for s in rs:
+            if s is self.control_server:
+                self.control_server._handle_request_noblock()
+            elif s is self.bus_socket:
+                self.memory.bus_poll()
+
+    def execute(self, until):
+        """
+        Run until the cycle count reaches until (finishing the block when
+        translating); an unknown opcode stops the CPU instead. Interrupts
+        are taken between instructions, or between blocks when translating.
+        While profiling, every instruction is interpreted and counted.
+        """
+        if self.profile is not None:
+            self.execute_profiled(until)
+        elif self.translator is not None:
+            blocks = self.translator.blocks
+            translate = self.translator.translate
+            while self.cycles < until:
+                if self.interrupts:
+                    self.interrupt()
+                block = blocks.get(self.program_counter) or translate(self.program_counter)
+                if block is None:
+                    if not self.step():
+                        self.running = False
+                        return
+                else:
+                    block()
+        else:
+            ops = self.ops
+            read_byte = self.memory.read_byte
+            while self.cycles < until:
+                if self.interrupts:
+                    self.interrupt()
                 self.cycles += 2  # all instructions take this as a minimum
-                op = self.read_pc_byte()
-                func = self.ops[op]
+                pc = self.program_counter
+                op = read_byte(self.cycles, pc)
+                self.program_counter = pc + 1
+                func = ops[op]
                 if func is None:
-                    print "UNKNOWN OP"
-                    print hex(self.program_counter - 1)
-                    print hex(op)
-                    break
-                else:
-                    self.ops[op]()
-                count -= 1
+                    if self.trap(pc):
+                        continue
+                    self.unknown_op(pc, op)
+                    self.running = False
+                    return
+                func()
+
+    def execute_profiled(self, until):
+        ops = self.ops
+        read_byte = self.memory.read_byte
+        profile = self.profile
+        pc_count = profile.pc_count
+        pc_cycles = profile.pc_cycles
+        op_count = profile.op_count
+        op_cycles = profile.op_cycles
+        while self.cycles < until:
+            if self.interrupts:
+                self.interrupt()
+            start = self.cycles
+            self.cycles += 2  # all instructions take this as a minimum
+            pc = self.program_counter
+            op = read_byte(self.cycles, pc)
+            self.program_counter = pc + 1
+            func = ops[op]
+            if func is None:
+                if not self.trap(pc):
+                    self.unknown_op(pc, op)
+                    self.running = False
+                    return
+            else:
+                func()
+            cycles = self.cycles - start
+            pc_count[pc] += 1
+            pc_cycles[pc] += cycles
+            op_count[op] += 1
+            op_cycles[op] += cycles
+
+    def step(self):
+        """Interpret a single instruction; False on an unknown opcode."""
+        self.cycles += 2  # all instructions take this as a minimum
+        pc = self.program_counter
+        op = self.read_byte(pc)
+        self.program_counter = pc + 1
+        func = self.ops[op]
+        if func is None:
+            if self.trap(pc):
+                return True
+            self.unknown_op(pc, op)
+            return False
+        func()
+        return True
+
+    def input(self, cycle, address, value):
+        """
+        A write from the display, such as a key press: logged against the
+        cycle count it takes effect at when recording, and ignored while
+        replaying.
+        """
+        if self.replaying:
+            return
+        if self.record_file is not None:
+            self.record_file.write("%d %04X %02X\n" % (self.cycles, address, value))
+        self.memory.bus_input(cycle, address, value)
+
+    def load_replay(self, path):
+        """
+        Schedule the writes of a recording at the cycles they were made,
+        so each lands at the same instruction boundary as when recorded
+        (the same block boundary when translating), in place of live input.
+        """
+        with open(path) as f:
+            for line in f:
+                cycle, address, value = line.split()
+                self.scheduler.add(
+                    int(cycle),
+                    lambda cycle, address=int(address, 16), value=int(value, 16): self.memory.bus_input(cycle, address, value))
+        self.replaying = True
+
+    def snapshot(self):
+        """The machine state as a snapshot string."""
+        return "".join([
+            SNAPSHOT_HEADER.pack("A2SS", SNAPSHOT_VERSION),
+            SNAPSHOT_STATE.pack(
+                self.cycles,
+                self.accumulator,
+                self.x_index,
+                self.y_index,
+                self.stack_pointer,
+                self.program_counter,
+                self.nz,
+                self.carry_flag,
+                self.interrupt_disable_flag,
+                self.decimal_mode_flag,
+                self.break_flag,
+                self.overflow_flag,
+                self.nmi_pending,
+                self.memory.kbd,
+                *self.memory.switches),
+            str(self.memory.ram._mem),
+        ])
+
+    def restore(self, data):
+        """
+        Replace the machine state with a snapshot. Scheduled events keep
+        their distance from the cycle count, and IRQ sources are dropped.
+        """
+        if len(data) != SNAPSHOT_SIZE or SNAPSHOT_HEADER.unpack_from(data) != ("A2SS", SNAPSHOT_VERSION):
+            raise IOError("unsupported snapshot")
+        state = SNAPSHOT_STATE.unpack_from(data, SNAPSHOT_HEADER.size)
+        (
+            cycles,
+            self.accumulator,
+            self.x_index,
+            self.y_index,
+            self.stack_pointer,
+            self.program_counter,
+            self.nz,
+            self.carry_flag,
+            self.interrupt_disable_flag,
+            self.decimal_mode_flag,
+            self.break_flag,
+            self.overflow_flag,
+            nmi_pending,
+            kbd,
+        ) = state[:14]
+        self.scheduler.shift(cycles - self.cycles)
+        self.cycles = cycles
+        if self.throttle is not None:
+            self.throttle.restart()
+        self.irq_sources.clear()
+        self.nmi_pending = bool(nmi_pending)
+        self.interrupts = self.nmi_pending
+        self.memory.restore(cycles, buffer(data, SNAPSHOT_SIZE - 0xC000), kbd, state[14:])
+        if self.translator is not None:
+            self.translator.flush()
+
+    def save_snapshot(self, path):
+        with open(path, "wb") as f:
+            f.write(self.snapshot())
+
+    def load_snapshot(self, path):
+        with open(path, "rb") as f:
+            self.restore(f.read())
+
+    def enable_trap(self, name):
+        address, handler = TRAPS[name]
+        if address not in self.traps:
+            original = self.memory.rom._mem[address - self.memory.rom.start]
+            self.traps[address] = (name, handler, original)
+            self.memory.rom._mem[address - self.memory.rom.start] = TRAP_OPCODE
+            if self.translator is not None:
+                self.translator.flush()
+
+    def disable_trap(self, name):
+        address, handler = TRAPS[name]
+        if address in self.traps:
+            self.memory.rom._mem[address - self.memory.rom.start] = self.traps.pop(address)[2]
+            if self.translator is not None:
+                self.translator.flush()
+
+    def trap(self, pc):
+        """Run the trap at pc, if there is one; TRAP_OPCODE has no handler."""
+        entry = self.traps.get(pc)
+        if entry is None:
+            return False
+        name, handler, original = entry
+        if not handler(self):
+            self.ops[original]()
+        return True
+
+    def skip_idle(self, until):
+        """
+        If the CPU is in a polling loop that cannot leave before until,
+        advance the cycle count (and any counter the loop keeps) as if it
+        had run there, stopping at the top of the loop. False otherwise.
+        """
+        loop = find_idle_loop(self.memory, self.program_counter)
+        if loop is None:
+            return False
+        start, end, counter = loop
+        if not self.run_to(start, start, end):
+            return False
+        if counter is not None:
+            low = counter[0]
+            if self.read_byte(low) == 0xFF and not self.run_to(start, start, end):
+                return False  # so the sample pass below does not wrap
+        before = self.idle_state()
+        cycles = self.cycles
+        if not self.run_to(start, start, end) or self.idle_state() != before:
+            return False
+        cost = self.cycles - cycles
+        if counter is None:
+            if self.cycles < until:
+                self.cycles += (until - self.cycles + cost - 1) // cost * cost
+            return True
+        # INC low; BNE +2; INC high: a wrapping pass skips the branch but
+        # takes the second increment
+        wrap_cost = cost - 1 + instruction_cycles(0xE6)
+        low, high = counter
+        rnd_low = self.read_byte(low)
+        rnd_high = self.read_byte(high)
+        while self.cycles < until:
+            passes = 0x100 - rnd_low  # the last of these wraps
+            if self.cycles + (passes - 1) * cost >= until:
+                n = (until - self.cycles + cost - 1) // cost
+                rnd_low += n
+                self.cycles += n * cost
+            else:
+                self.cycles += (passes - 1) * cost + wrap_cost
+                rnd_low = 0x00
+                rnd_high = (rnd_high + 1) & 0xFF
+        self.write_byte(low, rnd_low)
+        self.write_byte(high, rnd_high)
+        return True
+
+    def skip_countdown(self, until):
+        """
+        If the CPU is in a loop that only counts a register down (or up)
+        to zero, apply as many whole passes as end by until in closed form,
+        leaving registers, flags, memory and cycles exactly as running them
+        would. False if there is no such loop or no pass fits.
+        """
+        loop = find_countdown(self.memory, self.program_counter)
+        if loop is None:
+            return False
+        kind, start, end = loop
+        if self.program_counter != start:
+            # at the closing branch: take it to reach the top
+            if not self.step() or self.program_counter != start:
+                return False
+        if kind == "WAIT":
+            return self.skip_wait(until, start, end)
+        taken = instruction_cycles(0xD0) + 1
+        if kind == "SBC":
+            if not self.carry_flag or self.decimal_mode_flag or self.accumulator == 0:
+                return False
+            value = self.accumulator
+            count = value
+            cost = instruction_cycles(0xE9) + taken
+        else:
+            value = self.x_index if kind[2] == "X" else self.y_index
+            count = (-value if kind[0] == "I" else value) & 0xFF or 0x100
+            cost = instruction_cycles(self.read_byte(start)) + taken
+        n = min(count, (until - self.cycles) // cost)
+        if n == 0:
+            return False
+        self.cycles += n * cost
+        if n == count:
+            self.cycles -= 1  # the last branch is not taken
+            self.program_counter = end
+        result = (value + n if kind[0] == "I" else value - n) & 0xFF
+        if kind == "SBC":
+            self.accumulator = result
+            self.overflow_flag = 1 if result == 0x7F else 0  # from $80 - 1
+        elif kind[2] == "X":
+            self.x_index = result
+        else:
+            self.y_index = result
+        self.nz = result
+        return True
+
+    def skip_wait(self, until, start, end):
+        # each pass of the outer loop pushes A, counts it down, pulls it
+        # and takes one off, so pass k costs a known sum
+        if not self.carry_flag or self.decimal_mode_flag or self.accumulator == 0:
+            return False
+        pha, pla, sbc = instruction_cycles(0x48), instruction_cycles(0x68), instruction_cycles(0xE9)
+        branch = instruction_cycles(0xD0)
+        a = self.accumulator
+        cycles = self.cycles
+        pushed = None
+        while a:
+            cost = pha + a * (sbc + branch + 1) - 1 + pla + sbc + branch + (1 if a > 1 else 0)
+            if cycles + cost > until:
+                break
+            cycles += cost
+            pushed = a
+            a -= 1
+        if pushed is None:
+            return False
+        self.cycles = cycles
+        self.write_byte(self.STACK_PAGE + self.stack_pointer, pushed)
+        self.accumulator = a
+        self.overflow_flag = 1 if a == 0x7F else 0
+        self.nz = a
+        self.program_counter = start if a else end
+        return True
+
+    def run_to(self, target, start, end):
+        """Step until the PC is target, staying within start..end."""
+        for i in range(IDLE_LOOP_LENGTH + 1):
+            if not self.step():
+                return False
+            pc = self.program_counter
+            if pc == target:
+                return True
+            if not start <= pc < end:
+                return False
+        return False
+
+    def idle_state(self):
+        return (self.accumulator, self.x_index, self.y_index, self.stack_pointer, self.status_as_byte())
+
+    def unknown_op(self, pc, op):
+        print "UNKNOWN OP"
+        print hex(pc)
+        print hex(op)
 
     def test_run(self, start, end):
         self.program_counter = start
+        if self.translator is not None:
+            self.translator.add_stop(end)
+            blocks = self.translator.blocks
+            translate = self.translator.translate
+            while self.program_counter != end:
+                block = blocks.get(self.program_counter) or translate(self.program_counter)
+                if block is None:
+                    if not self.step():
+                        return
+                else:
+                    block()
+            self.cycles += 2  # as counted by the interpreted loop below
+            return
+        ops = self.ops
+        read_byte = self.memory.read_byte
         while True:
             self.cycles += 2  # all instructions take this as a minimum
-            if self.program_counter == end:
+            pc = self.program_counter
+            if pc == end:
                 break
-            op = self.read_pc_byte()
-            func = self.ops[op]
+            op = read_byte(self.cycles, pc)
+            self.program_counter = pc + 1
+            func = ops[op]
             if func is None:
-                print "UNKNOWN OP"
-                print hex(self.program_counter - 1)
-                print hex(op)
+                if self.trap(pc):
+                    continue
+                self.unknown_op(pc, op)
                 break
             else:
-                self.ops[op]()
+                func()
 
     ####
 
@@ -769,17 +1725,40 @@ class CPU:
 
     ####
 
+    # N and Z are not kept as flags but derived from nz, the last result
+    # that set them: Z is set when its low byte is zero and N when bit 7 or
+    # bit 8 is. Results are bytes, so bit 8 only appears when N and Z were
+    # set together, which BIT, PLP and RTI can do.
+
+    def get_zero_flag(self):
+        return 0 if self.nz & 0xFF else 1
+
+    def set_zero_flag(self, flag):
+        n = 0x80 if self.nz & 0x180 else 0x00
+        self.nz = n << 1 if flag else n | 0x01
+
+    zero_flag = property(get_zero_flag, set_zero_flag)
+
+    def get_sign_flag(self):
+        return 1 if self.nz & 0x180 else 0
+
+    def set_sign_flag(self, flag):
+        n = 0x80 if flag else 0x00
+        self.nz = n | 0x01 if self.nz & 0xFF else n << 1
+
+    sign_flag = property(get_sign_flag, set_sign_flag)
+
     def status_from_byte(self, status):
-        self.carry_flag = [0, 1][0 != status & 1]
-        self.zero_flag = [0, 1][0 != status & 2]
-        self.interrupt_disable_flag = [0, 1][0 != status & 4]
-        self.decimal_mode_flag = [0, 1][0 != status & 8]
-        self.break_flag = [0, 1][0 != status & 16]
-        self.overflow_flag = [0, 1][0 != status & 64]
-        self.sign_flag = [0, 1][0 != status & 128]
+        self.carry_flag = status & 1
+        self.nz = (status & 0x80) << 1 if status & 2 else (status & 0x80) | 0x01
+        self.interrupt_disable_flag = (status >> 2) & 1
+        self.decimal_mode_flag = (status >> 3) & 1
+        self.break_flag = (status >> 4) & 1
+        self.overflow_flag = (status >> 6) & 1
 
     def status_as_byte(self):
-        return self.carry_flag | self.zero_flag << 1 | self.interrupt_disable_flag << 2 | self.decimal_mode_flag << 3 | self.break_flag << 4 | 1 << 5 | self.overflow_flag << 6 | self.sign_flag << 7
+        nz = self.nz
+        return self.carry_flag | (0 if nz & 0xFF else 0x02) | self.interrupt_disable_flag << 2 | self.decimal_mode_flag << 3 | self.break_flag << 4 | 0x20 | self.overflow_flag << 6 | (0x80 if nz & 0x180 else 0x00)
 
     ####
 
@@ -797,9 +1776,9 @@ class CPU:
         self.push_byte(lo)
 
     def pull_word(self):
-        s = self.STACK_PAGE + self.stack_pointer + 1
-        self.stack_pointer += 2
-        return self.read_word(s)
+        lo = self.pull_byte()
+        hi = self.pull_byte()
+        return lo + (hi << 8)
 
     ####
 
@@ -855,8 +1834,7 @@ class CPU:
 
     def update_nz(self, value):
         value = value % 0x100
-        self.zero_flag = [0, 1][(value == 0)]
-        self.sign_flag = [0, 1][((value & 0x80) != 0)]
+        self.nz = value
         return value
 
     def update_nzc(self, value):
@@ -1060,7 +2038,7 @@ class CPU:
 
     def PHP(self):
         self.cycles += 1
-        self.push_byte(self.status_as_byte())
+        self.push_byte(self.status_as_byte() | 0x10)
 
     def PLA(self):
         self.cycles += 2
@@ -1084,8 +2062,10 @@ class CPU:
     # ARITHMETIC
 
     def ADC(self, operand_address):
-        # @@@ doesn't handle BCD yet
-        assert not self.decimal_mode_flag
+        if self.decimal_mode_flag:
+            self.accumulator, self.carry_flag, self.overflow_flag, self.nz = adc(
+                1, self.carry_flag, self.accumulator, self.read_byte(operand_address))
+            return
 
         a2 = self.accumulator
         a1 = signed(a2)
@@ -1104,8 +2084,10 @@ class CPU:
         self.overflow_flag = [0, 1][(result1 > 127) | (result1 < -128)]
 
     def SBC(self, operand_address):
-        # @@@ doesn't handle BCD yet
-        assert not self.decimal_mode_flag
+        if self.decimal_mode_flag:
+            self.accumulator, self.carry_flag, self.overflow_flag, self.nz = sbc(
+                1, self.carry_flag, self.accumulator, self.read_byte(operand_address))
+            return
 
         a2 = self.accumulator
         a1 = signed(a2)
@@ -1157,17 +2139,934 @@ class CPU:
     def BRK(self):
         self.cycles += 5
         self.push_word(self.program_counter + 1)
-        self.push_byte(self.status_as_byte())
-        self.program_counter = self.read_word(0xFFFE)
+        self.push_byte(self.status_as_byte() | 0x10)
+        self.program_counter = self.read_word(self.IRQ_VECTOR)
         self.break_flag = 1
+        self.interrupt_disable_flag = 1
 
     def RTI(self):
         self.cycles += 4
         self.status_from_byte(self.pull_byte())
         self.program_counter = self.pull_word()
 
-    # @@@ IRQ
-    # @@@ NMI
+    # INTERRUPTS
+
+    def raise_irq(self, source):
+        """Hold the IRQ line for source until lower_irq(source)."""
+        self.irq_sources.add(source)
+        self.interrupts = True
+
+    def lower_irq(self, source):
+        self.irq_sources.discard(source)
+        self.interrupts = self.nmi_pending or bool(self.irq_sources)
+
+    def raise_nmi(self):
+        """Signal an NMI; it is edge triggered, so taken once."""
+        self.nmi_pending = True
+        self.interrupts = True
+
+    def schedule_irq(self, cycle, source, period=None):
+        """Raise the IRQ line for source at cycle, and every period after."""
+        self.scheduler.add(cycle, lambda now: self.raise_irq(source), period)
+
+    def schedule_nmi(self, cycle, period=None):
+        self.scheduler.add(cycle, lambda now: self.raise_nmi(), period)
+
+    def interrupt(self):
+        """Take a pending NMI, or an IRQ unless masked; True if one was taken."""
+        if self.nmi_pending:
+            self.nmi_pending = False
+            self.interrupts = bool(self.irq_sources)
+            vector = self.NMI_VECTOR
+        elif not self.interrupt_disable_flag:
+            vector = self.IRQ_VECTOR
+        else:
+            return False
+        self.cycles += 7
+        self.push_word(self.program_counter)
+        self.push_byte(self.status_as_byte() & ~0x10)
+        self.interrupt_disable_flag = 1
+        self.program_counter = self.read_word(vector)
+        return True
+
+
+# FUSED DISPATCH
+#
+# Rather than going through a lambda, an addressing mode method and an
+# operation method for every instruction, we generate the source of one
+# specialized function per opcode (with operand fetch, cycle accounting and
+# the operation all inlined), compile it once at import and bind it to a CPU
+# in build_fused_ops.
+
+INSTRUCTIONS = {
+    0x00: ("BRK", "implied"),
+    0x01: ("ORA", "indirect_x"),
+    0x05: ("ORA", "zero_page"),
+    0x06: ("ASL", "zero_page"),
+    0x08: ("PHP", "implied"),
+    0x09: ("ORA", "immediate"),
+    0x0A: ("ASL", "accumulator"),
+    0x0D: ("ORA", "absolute"),
+    0x0E: ("ASL", "absolute"),
+    0x10: ("BPL", "relative"),
+    0x11: ("ORA", "indirect_y"),
+    0x15: ("ORA", "zero_page_x"),
+    0x16: ("ASL", "zero_page_x"),
+    0x18: ("CLC", "implied"),
+    0x19: ("ORA", "absolute_y"),
+    0x1D: ("ORA", "absolute_x"),
+    0x1E: ("ASL", "absolute_x", True),
+    0x20: ("JSR", "absolute"),
+    0x21: ("AND", "indirect_x"),
+    0x24: ("BIT", "zero_page"),
+    0x25: ("AND", "zero_page"),
+    0x26: ("ROL", "zero_page"),
+    0x28: ("PLP", "implied"),
+    0x29: ("AND", "immediate"),
+    0x2A: ("ROL", "accumulator"),
+    0x2C: ("BIT", "absolute"),
+    0x2D: ("AND", "absolute"),
+    0x2E: ("ROL", "absolute"),
+    0x30: ("BMI", "relative"),
+    0x31: ("AND", "indirect_y"),
+    0x35: ("AND", "zero_page_x"),
+    0x36: ("ROL", "zero_page_x"),
+    0x38: ("SEC", "implied"),
+    0x39: ("AND", "absolute_y"),
+    0x3D: ("AND", "absolute_x"),
+    0x3E: ("ROL", "absolute_x", True),
+    0x40: ("RTI", "implied"),
+    0x41: ("EOR", "indirect_x"),
+    0x45: ("EOR", "zero_page"),
+    0x46: ("LSR", "zero_page"),
+    0x48: ("PHA", "implied"),
+    0x49: ("EOR", "immediate"),
+    0x4A: ("LSR", "accumulator"),
+    0x4C: ("JMP", "absolute"),
+    0x4D: ("EOR", "absolute"),
+    0x4E: ("LSR", "absolute"),
+    0x50: ("BVC", "relative"),
+    0x51: ("EOR", "indirect_y"),
+    0x55: ("EOR", "zero_page_x"),
+    0x56: ("LSR", "zero_page_x"),
+    0x58: ("CLI", "implied"),
+    0x59: ("EOR", "absolute_y"),
+    0x5D: ("EOR", "absolute_x"),
+    0x5E: ("LSR", "absolute_x", True),
+    0x60: ("RTS", "implied"),
+    0x61: ("ADC", "indirect_x"),
+    0x65: ("ADC", "zero_page"),
+    0x66: ("ROR", "zero_page"),
+    0x68: ("PLA", "implied"),
+    0x69: ("ADC", "immediate"),
+    0x6A: ("ROR", "accumulator"),
+    0x6C: ("JMP", "indirect"),
+    0x6D: ("ADC", "absolute"),
+    0x6E: ("ROR", "absolute"),
+    0x70: ("BVS", "relative"),
+    0x71: ("ADC", "indirect_y"),
+    0x75: ("ADC", "zero_page_x"),
+    0x76: ("ROR", "zero_page_x"),
+    0x78: ("SEI", "implied"),
+    0x79: ("ADC", "absolute_y"),
+    0x7D: ("ADC", "absolute_x"),
+    0x7E: ("ROR", "absolute_x", True),
+    0x81: ("STA", "indirect_x"),
+    0x84: ("STY", "zero_page"),
+    0x85: ("STA", "zero_page"),
+    0x86: ("STX", "zero_page"),
+    0x88: ("DEY", "implied"),
+    0x8A: ("TXA", "implied"),
+    0x8C: ("STY", "absolute"),
+    0x8D: ("STA", "absolute"),
+    0x8E: ("STX", "absolute"),
+    0x90: ("BCC", "relative"),
+    0x91: ("STA", "indirect_y", True),
+    0x94: ("STY", "zero_page_x"),
+    0x95: ("STA", "zero_page_x"),
+    0x96: ("STX", "zero_page_y"),
+    0x98: ("TYA", "implied"),
+    0x99: ("STA", "absolute_y", True),
+    0x9A: ("TXS", "implied"),
+    0x9D: ("STA", "absolute_x", True),
+    0xA0: ("LDY", "immediate"),
+    0xA1: ("LDA", "indirect_x"),
+    0xA2: ("LDX", "immediate"),
+    0xA4: ("LDY", "zero_page"),
+    0xA5: ("LDA", "zero_page"),
+    0xA6: ("LDX", "zero_page"),
+    0xA8: ("TAY", "implied"),
+    0xA9: ("LDA", "immediate"),
+    0xAA: ("TAX", "implied"),
+    0xAC: ("LDY", "absolute"),
+    0xAD: ("LDA", "absolute"),
+    0xAE: ("LDX", "absolute"),
+    0xB0: ("BCS", "relative"),
+    0xB1: ("LDA", "indirect_y"),
+    0xB4: ("LDY", "zero_page_x"),
+    0xB5: ("LDA", "zero_page_x"),
+    0xB6: ("LDX", "zero_page_y"),
+    0xB8: ("CLV", "implied"),
+    0xB9: ("LDA", "absolute_y"),
+    0xBA: ("TSX", "implied"),
+    0xBC: ("LDY", "absolute_x"),
+    0xBD: ("LDA", "absolute_x"),
+    0xBE: ("LDX", "absolute_y"),
+    0xC0: ("CPY", "immediate"),
+    0xC1: ("CMP", "indirect_x"),
+    0xC4: ("CPY", "zero_page"),
+    0xC5: ("CMP", "zero_page"),
+    0xC6: ("DEC", "zero_page"),
+    0xC8: ("INY", "implied"),
+    0xC9: ("CMP", "immediate"),
+    0xCA: ("DEX", "implied"),
+    0xCC: ("CPY", "absolute"),
+    0xCD: ("CMP", "absolute"),
+    0xCE: ("DEC", "absolute"),
+    0xD0: ("BNE", "relative"),
+    0xD1: ("CMP", "indirect_y"),
+    0xD5: ("CMP", "zero_page_x"),
+    0xD6: ("DEC", "zero_page_x"),
+    0xD8: ("CLD", "implied"),
+    0xD9: ("CMP", "absolute_y"),
+    0xDD: ("CMP", "absolute_x"),
+    0xDE: ("DEC", "absolute_x", True),
+    0xE0: ("CPX", "immediate"),
+    0xE1: ("SBC", "indirect_x"),
+    0xE4: ("CPX", "zero_page"),
+    0xE5: ("SBC", "zero_page"),
+    0xE6: ("INC", "zero_page"),
+    0xE8: ("INX", "implied"),
+    0xE9: ("SBC", "immediate"),
+    0xEA: ("NOP", "implied"),
+    0xEC: ("CPX", "absolute"),
+    0xED: ("SBC", "absolute"),
+    0xEE: ("INC", "absolute"),
+    0xF0: ("BEQ", "relative"),
+    0xF1: ("SBC", "indirect_y"),
+    0xF5: ("SBC", "zero_page_x"),
+    0xF6: ("INC", "zero_page_x"),
+    0xF8: ("SED", "implied"),
+    0xF9: ("SBC", "absolute_y"),
+    0xFD: ("SBC", "absolute_x"),
+    0xFE: ("INC", "absolute_x", True),
+}
+
+
+# operand length and cycles added by each addressing mode (see cycle_notes.txt)
+ADDRESSING_MODES = {
+    "implied": (0, 0),
+    "accumulator": (0, 0),
+    "immediate": (1, 0),
+    "zero_page": (1, 1),
+    "zero_page_x": (1, 2),
+    "zero_page_y": (1, 2),
+    "absolute": (2, 2),
+    "absolute_x": (2, 2),
+    "absolute_y": (2, 2),
+    "indirect": (2, 4),
+    "indirect_x": (1, 4),
+    "indirect_y": (1, 3),
+    "relative": (1, 0),
+}
+
+
+# cycles added by the operation itself (shifts only when not implied)
+OPERATION_CYCLES = {
+    "ASL": 2, "LSR": 2, "ROL": 2, "ROR": 2,
+    "DEC": 2, "INC": 2,
+    "JMP": -1, "JSR": 2, "RTS": 4, "RTI": 4, "BRK": 5,
+    "PHA": 1, "PHP": 1, "PLA": 2, "PLP": 2,
+}
+
+
+def instruction_cycles(opcode):
+    """Cycles taken by an instruction, not counting taken branches."""
+    info = INSTRUCTIONS[opcode]
+    mnemonic, mode = info[:2]
+    cycles = 2 + ADDRESSING_MODES[mode][1]
+    if len(info) > 2:
+        cycles += 1  # read-modify-write
+    if mode != "accumulator":
+        cycles += OPERATION_CYCLES.get(mnemonic, 0)
+    return cycles
+
+
+# IDLE LOOPS AND COUNTDOWNS
+
+def code_window(memory, pc, before, after):
+    """
+    The bytes from before pc to after it, clipped to the RAM or ROM that
+    holds pc, as (base address, bytearray); None if pc is in I/O space.
+    """
+    for region in (memory.ram, memory.rom):
+        if region.start <= pc <= region.end:
+            base = max(pc - before, region.start)
+            return base, bytearray(region.view(base, min(pc + after, region.end)))
+    return None
+
+
+IDLE_LOOP_LENGTH = 16  # bytes
+
+# instructions a polling loop may contain: they read memory or set
+# registers and flags but never write memory
+IDLE_MNEMONICS = set([
+    "LDA", "LDX", "LDY", "BIT", "CMP", "CPX", "CPY", "AND", "ORA",
+    "TAX", "TAY", "TXA", "TYA", "TSX", "CLC", "SEC", "CLV", "NOP",
+    "BCC", "BCS", "BEQ", "BMI", "BNE", "BPL", "BVC", "BVS",
+])
+IDLE_MODES = set(["implied", "immediate", "zero_page", "absolute", "relative"])
+
+
+def find_idle_loop(memory, pc):
+    """
+    Find a short loop around pc that ends in a branch back to its start and
+    only reads memory, apart from the keyboard latch at $C000. The loop may
+    open with the monitor KEYIN counter, INC low; BNE +2; INC high, and must
+    then set the flags again. Returns (start, end, counter) where counter is
+    (low, high) or None, or None if there is no such loop.
+    """
+    window = code_window(memory, pc, IDLE_LOOP_LENGTH, IDLE_LOOP_LENGTH)
+    if window is None:
+        return None
+    base, code = window
+    address = pc
+    while address - pc < IDLE_LOOP_LENGTH:
+        info = INSTRUCTIONS.get(code[address - base])
+        if info is None:
+            return None
+        mode = info[1]
+        length = 1 + ADDRESSING_MODES[mode][0]
+        if address + length - base > len(code):
+            return None
+        if mode == "relative":
+            target = address + 2 + signed(code[address + 1 - base])
+            if target <= pc:
+                return idle_loop(code, base, target, address + 2)
+        address += length
+    return None
+
+
+def idle_loop(code, base, start, end):
+    if start < base:
+        return None
+    counter = None
+    address = start
+    prefix = list(code[start - base:start - base + 6])
+    if end - start > 6 and prefix[0::2] == [0xE6, 0xD0, 0xE6] and prefix[3] == 0x02:
+        if (start + 4) >> 8 != (start + 6) >> 8:
+            return None  # a page-crossing branch would change the costs
+        counter = (prefix[1], prefix[5])
+        address = start + 6
+        if INSTRUCTIONS.get(code[address - base], ("",))[0] not in ("LDA", "LDX", "LDY", "BIT"):
+            return None
+    while address < end:
+        info = INSTRUCTIONS.get(code[address - base])
+        if info is None or info[0] not in IDLE_MNEMONICS or info[1] not in IDLE_MODES:
+            return None
+        if info[1] == "absolute":
+            operand = code[address + 1 - base] + (code[address + 2 - base] << 8)
+            if 0xC000 < operand < 0xD000:
+                return None  # other I/O may have side effects or change
+        elif info[1] == "zero_page":
+            operand = code[address + 1 - base]
+        else:
+            operand = None
+        if counter is not None and operand in counter:
+            return None
+        address += 1 + ADDRESSING_MODES[info[1]][0]
+    if address != end:
+        return None
+    return start, end, counter
+
+
+# a register step then BNE back to it
+COUNTDOWN_OPS = {0xCA: "DEX", 0x88: "DEY", 0xE8: "INX", 0xC8: "INY"}
+
+SBC_LOOP = [0xE9, 0x01, 0xD0, 0xFC]  # SBC #$01; BNE *-2
+
+# the monitor WAIT routine ($FCA8) from WAIT2: PHA; SBC #$01; BNE *-2;
+# PLA; SBC #$01; BNE WAIT2
+WAIT_LOOP = [0x48, 0xE9, 0x01, 0xD0, 0xFC, 0x68, 0xE9, 0x01, 0xD0, 0xF6]
+
+
+def find_countdown(memory, pc):
+    """
+    Find a countdown loop at pc, or whose closing branch is at pc. Returns
+    (kind, start, end) where kind is a COUNTDOWN_OPS mnemonic, "SBC" or
+    "WAIT" and end the address after the loop, or None. Loops whose
+    branches cross a page, and so would cost more, are not matched.
+    """
+    window = code_window(memory, pc, 2, len(WAIT_LOOP))
+    if window is None:
+        return None
+    base, code = window
+
+    def match(start, pattern):
+        end = start + len(pattern)
+        return start >= base and list(code[start - base:end - base]) == pattern and start >> 8 == end >> 8
+
+    if match(pc, WAIT_LOOP):
+        return "WAIT", pc, pc + len(WAIT_LOOP)
+    for op, mnemonic in COUNTDOWN_OPS.items():
+        for start in (pc, pc - 1):
+            if match(start, [op, 0xD0, 0xFD]):
+                return mnemonic, start, start + 3
+    for start in (pc, pc - 2):
+        if match(start, SBC_LOOP):
+            return "SBC", start, start + len(SBC_LOOP)
+    return None
+
+
+# ARITHMETIC TABLES
+#
+# ADC and SBC are looked up rather than computed, which costs the same in
+# decimal mode as in binary. Tables are indexed by arithmetic_index and
+# hold (result, carry, overflow, nz) tuples, shared between entries.
+
+
+def arithmetic_index(decimal, carry, a, m):
+    return decimal << 17 | carry << 16 | a << 8 | m
+
+
+def nz_value(n, z):
+    # the nz (see CPU.zero_flag) for the given N and Z
+    return n << 8 if z else n << 7 | 0x01
+
+
+def adc(decimal, carry, a, m):
+    r = a + m + carry
+    if not decimal:
+        return r & 0xFF, r >> 8, ((a ^ r) & (m ^ r) & 0x80) >> 7, r & 0xFF
+    # NMOS: N and V come from the sum after adjusting the low digit only;
+    # Z from the binary sum
+    low = (a & 0x0F) + (m & 0x0F) + carry
+    if low >= 0x0A:
+        low = ((low + 0x06) & 0x0F) + 0x10
+    s = (a & 0xF0) + (m & 0xF0) + low
+    overflow = 0 if -128 <= signed(a & 0xF0) + signed(m & 0xF0) + low <= 127 else 1
+    n = (s >> 7) & 1
+    if s >= 0xA0:
+        s += 0x60
+    return s & 0xFF, 1 if s >= 0x100 else 0, overflow, nz_value(n, 0 if r & 0xFF else 1)
+
+
+def sbc(decimal, carry, a, m):
+    r = a - m - 1 + carry
+    v = r & 0xFF
+    binary = (v, 0 if r < 0 else 1, ((a ^ m) & (a ^ v) & 0x80) >> 7, v)
+    if not decimal:
+        return binary
+    # NMOS: the flags are those of the binary subtraction
+    low = (a & 0x0F) - (m & 0x0F) + carry - 1
+    if low < 0:
+        low = ((low - 0x06) & 0x0F) - 0x10
+    s = (a & 0xF0) - (m & 0xF0) + low
+    if s < 0:
+        s -= 0x60
+    return (s & 0xFF,) + binary[1:]
+
+
+def arithmetic_table(operation):
+    table = [None] * 0x40000
+    entries = {}
+    for decimal in (0, 1):
+        for carry in (0, 1):
+            for a in range(0x100):
+                index = arithmetic_index(decimal, carry, a, 0)
+                for m in range(0x100):
+                    entry = operation(decimal, carry, a, m)
+                    table[index | m] = entries.setdefault(entry, entry)
+    return table
+
+
+ADC_TABLE = arithmetic_table(adc)
+SBC_TABLE = arithmetic_table(sbc)
+
+
+# address computation for each mode; "{lo}" and "{hi}" are the operand bytes
+# and "{word}" the 16-bit operand
+ADDRESS_SOURCE = {
+    "zero_page": "addr = {lo}",
+    "zero_page_x": "addr = ({lo} + cpu.x_index) & 0xFF",
+    "zero_page_y": "addr = ({lo} + cpu.y_index) & 0xFF",
+    "absolute": "addr = {word}",
+    "absolute_x": "addr = {word} + cpu.x_index",
+    "absolute_y": "addr = {word} + cpu.y_index",
+    "indirect": "a = {word}\naddr = read_byte(c, a) + (read_byte(c, (a & 0xFF00) | ((a + 1) & 0xFF)) << 8)",
+    "indirect_x": "z = ({lo} + cpu.x_index) & 0xFF\naddr = read_byte(c, z) + (read_byte(c, (z + 1) & 0xFF) << 8)",
+    "indirect_y": "z = {lo}\naddr = read_byte(c, z) + (read_byte(c, (z + 1) & 0xFF) << 8) + cpu.y_index",
+}
+
+
+# CYCLE-EXACT TIMING
+#
+# The fused handlers above count the base cycles of cycle_notes.txt but not
+# the page crossing penalties; with cycle-exact timing these are added as
+# well: +1 for an indexed read whose index carries into the high byte of
+# the address (writes and read-modify-writes always pay it, in their base
+# cost) and +1 for a taken branch to another page.
+
+PAGE_CROSSING_SOURCE = "if (base ^ addr) & 0xFF00:\n    c += 1\n    cpu.cycles = c"
+
+EXACT_ADDRESS_SOURCE = {
+    "absolute_x": "base = {word}\naddr = base + cpu.x_index\n" + PAGE_CROSSING_SOURCE,
+    "absolute_y": "base = {word}\naddr = base + cpu.y_index\n" + PAGE_CROSSING_SOURCE,
+    "indirect_y": "z = {lo}\nbase = read_byte(c, z) + (read_byte(c, (z + 1) & 0xFF) << 8)\naddr = base + cpu.y_index\n" + PAGE_CROSSING_SOURCE,
+}
+
+EXACT_BRANCH_SOURCE = "if {condition}:\n    t = {target}\n    cpu.cycles = c + (2 if (t ^ ({next})) & 0xFF00 else 1)\n    cpu.program_counter = t"
+
+
+def branch_cycles(next_pc, target, exact):
+    """Cycles a taken branch adds to its base cost."""
+    return 2 if exact and (target ^ next_pc) & 0xFF00 else 1
+
+
+NZ_SOURCE = "cpu.nz = v"
+
+PUSH_SOURCE = "sp = cpu.stack_pointer\nwrite_byte(c, 0x100 + sp, {value})\ncpu.stack_pointer = (sp - 1) & 0xFF"
+
+PULL_SOURCE = "sp = cpu.stack_pointer = (cpu.stack_pointer + 1) & 0xFF\nv = read_byte(c, 0x100 + sp)"
+
+BRANCH_SOURCE = "if {condition}:\n    cpu.cycles = c + 1\n    cpu.program_counter = {target}"
+
+BRANCH_CONDITIONS = {
+    "BCC": "not cpu.carry_flag",
+    "BCS": "cpu.carry_flag",
+    "BEQ": "not cpu.nz & 0xFF",
+    "BNE": "cpu.nz & 0xFF",
+    "BMI": "cpu.nz & 0x180",
+    "BPL": "not cpu.nz & 0x180",
+    "BVC": "not cpu.overflow_flag",
+    "BVS": "cpu.overflow_flag",
+}
+
+ARITHMETIC_SOURCE = "cpu.accumulator, cpu.carry_flag, cpu.overflow_flag, cpu.nz = {table}[cpu.decimal_mode_flag << 17 | cpu.carry_flag << 16 | cpu.accumulator << 8 | {{read}}]"
+
+
+# operation source; "{read}" is the operand value, "{write}" stores v back to
+# the operand, "{next}" is the address of the following instruction and
+# "{target}" a branch destination
+OPERATION_SOURCE = {
+    # LOAD / STORE
+    "LDA": "v = cpu.accumulator = {read}\n{nz}",
+    "LDX": "v = cpu.x_index = {read}\n{nz}",
+    "LDY": "v = cpu.y_index = {read}\n{nz}",
+    "STA": "write_byte(c, addr, cpu.accumulator)",
+    "STX": "write_byte(c, addr, cpu.x_index)",
+    "STY": "write_byte(c, addr, cpu.y_index)",
+
+    # TRANSFER
+    "TAX": "v = cpu.x_index = cpu.accumulator\n{nz}",
+    "TXA": "v = cpu.accumulator = cpu.x_index\n{nz}",
+    "TAY": "v = cpu.y_index = cpu.accumulator\n{nz}",
+    "TYA": "v = cpu.accumulator = cpu.y_index\n{nz}",
+    "TSX": "v = cpu.x_index = cpu.stack_pointer\n{nz}",
+    "TXS": "cpu.stack_pointer = cpu.x_index",
+
+    # SHIFTS / ROTATES
+    "ASL": "v = {read} << 1\ncpu.carry_flag = v >> 8\nv &= 0xFF\n{write}\n{nz}",
+    "ROL": "v = ({read} << 1) | cpu.carry_flag\ncpu.carry_flag = v >> 8\nv &= 0xFF\n{write}\n{nz}",
+    "ROR": "v = {read} | (cpu.carry_flag << 8)\ncpu.carry_flag = v & 1\nv >>= 1\n{write}\n{nz}",
+    "LSR": "v = {read}\ncpu.carry_flag = v & 1\nv >>= 1\n{write}\n{nz}",
+
+    # JUMPS / RETURNS
+    "JMP": "cpu.program_counter = addr",
+    "JSR": PUSH_SOURCE.format(value="({next} - 1) >> 8") + "\n" + PUSH_SOURCE.format(value="({next} - 1) & 0xFF") + "\ncpu.program_counter = addr",
+    "RTS": "sp = cpu.stack_pointer\ncpu.stack_pointer = (sp + 2) & 0xFF\ncpu.program_counter = read_byte(c, 0x100 + ((sp + 1) & 0xFF)) + (read_byte(c, 0x100 + ((sp + 2) & 0xFF)) << 8) + 1",
+
+    # BRANCHES
+    "BCC": BRANCH_SOURCE.format(condition=BRANCH_CONDITIONS["BCC"], target="{target}"),
+    "BCS": BRANCH_SOURCE.format(condition=BRANCH_CONDITIONS["BCS"], target="{target}"),
+    "BEQ": BRANCH_SOURCE.format(condition=BRANCH_CONDITIONS["BEQ"], target="{target}"),
+    "BNE": BRANCH_SOURCE.format(condition=BRANCH_CONDITIONS["BNE"], target="{target}"),
+    "BMI": BRANCH_SOURCE.format(condition=BRANCH_CONDITIONS["BMI"], target="{target}"),
+    "BPL": BRANCH_SOURCE.format(condition=BRANCH_CONDITIONS["BPL"], target="{target}"),
+    "BVC": BRANCH_SOURCE.format(condition=BRANCH_CONDITIONS["BVC"], target="{target}"),
+    "BVS": BRANCH_SOURCE.format(condition=BRANCH_CONDITIONS["BVS"], target="{target}"),
+
+    # SET / CLEAR FLAGS
+    "CLC": "cpu.carry_flag = 0",
+    "CLD": "cpu.decimal_mode_flag = 0",
+    "CLI": "cpu.interrupt_disable_flag = 0",
+    "CLV": "cpu.overflow_flag = 0",
+    "SEC": "cpu.carry_flag = 1",
+    "SED": "cpu.decimal_mode_flag = 1",
+    "SEI": "cpu.interrupt_disable_flag = 1",
+
+    # INCREMENT / DECREMENT
+    "DEC": "v = ({read} - 1) & 0xFF\n{write}\n{nz}",
+    "DEX": "v = cpu.x_index = (cpu.x_index - 1) & 0xFF\n{nz}",
+    "DEY": "v = cpu.y_index = (cpu.y_index - 1) & 0xFF\n{nz}",
+    "INC": "v = ({read} + 1) & 0xFF\n{write}\n{nz}",
+    "INX": "v = cpu.x_index = (cpu.x_index + 1) & 0xFF\n{nz}",
+    "INY": "v = cpu.y_index = (cpu.y_index + 1) & 0xFF\n{nz}",
+
+    # PUSH / PULL
+    "PHA": PUSH_SOURCE.format(value="cpu.accumulator"),
+    "PHP": PUSH_SOURCE.format(value="cpu.status_as_byte() | 0x10"),
+    "PLA": PULL_SOURCE + "\ncpu.accumulator = v\n{nz}",
+    "PLP": PULL_SOURCE + "\ncpu.status_from_byte(v)",
+
+    # LOGIC
+    "AND": "v = cpu.accumulator = cpu.accumulator & {read}\n{nz}",
+    "ORA": "v = cpu.accumulator = cpu.accumulator | {read}\n{nz}",
+    "EOR": "v = cpu.accumulator = cpu.accumulator ^ {read}\n{nz}",
+
+    # ARITHMETIC
+    "ADC": ARITHMETIC_SOURCE.format(table="ADC_TABLE"),
+    "SBC": ARITHMETIC_SOURCE.format(table="SBC_TABLE"),
+
+    # BIT
+    "BIT": "m = {read}\ncpu.overflow_flag = (m >> 6) & 1\ncpu.nz = (m & 0x80) | 0x01 if cpu.accumulator & m else (m & 0x80) << 1",
+
+    # COMPARISON
+    "CMP": "r = cpu.accumulator - {read}\ncpu.carry_flag = 0 if r < 0 else 1\nv = r & 0xFF\n{nz}",
+    "CPX": "r = cpu.x_index - {read}\ncpu.carry_flag = 0 if r < 0 else 1\nv = r & 0xFF\n{nz}",
+    "CPY": "r = cpu.y_index - {read}\ncpu.carry_flag = 0 if r < 0 else 1\nv = r & 0xFF\n{nz}",
+
+    # SYSTEM
+    "NOP": "pass",
+    "BRK": PUSH_SOURCE.format(value="({next} + 1) >> 8") + "\n" + PUSH_SOURCE.format(value="({next} + 1) & 0xFF") + "\n" + PUSH_SOURCE.format(value="cpu.status_as_byte() | 0x10") + "\ncpu.program_counter = read_byte(c, 0xFFFE) + (read_byte(c, 0xFFFF) << 8)\ncpu.break_flag = 1\ncpu.interrupt_disable_flag = 1",
+    "RTI": "sp = cpu.stack_pointer\ncpu.stack_pointer = (sp + 3) & 0xFF\ncpu.status_from_byte(read_byte(c, 0x100 + ((sp + 1) & 0xFF)))\ncpu.program_counter = read_byte(c, 0x100 + ((sp + 2) & 0xFF)) + (read_byte(c, 0x100 + ((sp + 3) & 0xFF)) << 8)",
+}
+
+
+def operation_source(opcode, lo, hi, next_pc, exact=False):
+    """
+    Source lines for the body of one instruction, given source expressions
+    for its operand bytes and for the address of the next instruction.
+    Expects `c` to hold the cycle count after the instruction's base cost.
+    With exact, page crossing penalties are added too.
+    """
+    info = INSTRUCTIONS[opcode]
+    mnemonic, mode = info[:2]
+    lines = []
+    if mode in ADDRESS_SOURCE:
+        address = ADDRESS_SOURCE[mode]
+        if exact and mode in EXACT_ADDRESS_SOURCE and len(info) == 2:
+            address = EXACT_ADDRESS_SOURCE[mode]
+        lines.append(address.format(lo=lo, hi=hi, word="%s + (%s << 8)" % (lo, hi)))
+        read = "read_byte(c, addr)"
+        write = "write_byte(c, addr, v)"
+    elif mode == "immediate":
+        read = lo
+        write = None
+    else:
+        read = "cpu.accumulator"
+        write = "cpu.accumulator = v"
+    target = "%s + ((%s ^ 0x80) - 0x80)" % (next_pc, lo)
+    operation = OPERATION_SOURCE[mnemonic]
+    if exact and mnemonic in BRANCH_CONDITIONS:
+        operation = EXACT_BRANCH_SOURCE.format(condition=BRANCH_CONDITIONS[mnemonic], target="{target}", next="{next}")
+    lines.append(operation.format(
+        read=read, write=write, nz=NZ_SOURCE, next=next_pc, target=target,
+    ))
+    return "\n".join(lines).split("\n")
+
+
+def fused_source(name="build_fused_ops", exact=False):
+    """Source of a function name(cpu) building one nested function per opcode."""
+    lines = [
+        "def %s(cpu):" % name,
+        "    read_byte = cpu.memory.read_byte",
+        "    write_byte = cpu.memory.write_byte",
+        "    ops = [None] * 0x100",
+    ]
+    for opcode in sorted(INSTRUCTIONS):
+        length = ADDRESSING_MODES[INSTRUCTIONS[opcode][1]][0]
+        # the run loop has already fetched the opcode and counted 2 cycles
+        next_pc = "pc + %d" % length if length else "pc"
+        body = operation_source(opcode, "read_byte(c, pc)", "read_byte(c, pc + 1)", next_pc, exact)
+        source = "\n".join(body)
+        lines.append("    def op_%02X():" % opcode)
+        if re.search(r"\bpc\b", source):
+            lines.append("        pc = cpu.program_counter")
+        if length:
+            lines.append("        cpu.program_counter = pc + %d" % length)
+        extra = instruction_cycles(opcode) - 2
+        if extra:
+            lines.append("        c = cpu.cycles = cpu.cycles + %d" % extra)
+        elif re.search(r"\bc\b", source):
+            lines.append("        c = cpu.cycles")
+        lines.extend("        " + line for line in body)
+        lines.append("    ops[0x%02X] = op_%02X" % (opcode, opcode))
+    lines.append("    return ops")
+    return "\n".join(lines) + "\n"
+
+
+_namespace = {"ADC_TABLE": ADC_TABLE, "SBC_TABLE": SBC_TABLE}
+exec compile(fused_source(), "<fused ops>", "exec") in _namespace
+exec compile(fused_source("build_exact_ops", exact=True), "<exact ops>", "exec") in _namespace
+build_fused_ops = _namespace["build_fused_ops"]
+build_exact_ops = _namespace["build_exact_ops"]
+
+
+# BLOCK TRANSLATION
+#
+# An optional engine on top of the fused operation source: straight-line
+# runs of instructions are compiled into one function per entry PC with
+# operands, addresses and cycle counts folded into constants. Writes to a
+# page holding translated code drop every block on that page.
+
+BLOCK_ENDS = set(["JMP", "JSR", "RTS", "RTI", "BRK", "BCC", "BCS", "BEQ", "BNE", "BMI", "BPL", "BVC", "BVS"])
+
+
+class Translator:
+
+    MAX_BLOCK_LENGTH = 32
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.memory = cpu.memory
+        self.memory.translator = self
+        self.blocks = {}
+        self.page_blocks = {}  # page -> entry PCs of blocks with code on it
+        self.page_writers = {}  # page -> write handler replaced while watched
+        self.stops = set()  # addresses at which blocks must end
+
+    def readable(self, address):
+        # never fetch code through the I/O space
+        return address < 0xC000 or 0xD000 <= address <= 0xFFFF
+
+    def decode(self, entry):
+        """List of (pc, opcode, operand bytes) for the block at entry."""
+        instructions = []
+        pc = entry
+        while len(instructions) < self.MAX_BLOCK_LENGTH:
+            if instructions and pc in self.stops:
+                break
+            if not self.readable(pc):
+                break
+            opcode = self.memory.read_byte(self.cpu.cycles, pc)
+            if opcode not in INSTRUCTIONS:
+                break
+            length = ADDRESSING_MODES[INSTRUCTIONS[opcode][1]][0]
+            if not self.readable(pc + length):
+                break
+            operand = [self.memory.read_byte(self.cpu.cycles, pc + 1 + i) for i in range(length)]
+            instructions.append((pc, opcode, operand))
+            pc += 1 + length
+            if INSTRUCTIONS[opcode][0] in BLOCK_ENDS:
+                break
+        return instructions
+
+    def block_source(self, instructions):
+        lines = ["def block():", "    c = cpu.cycles", "    memory.code_written = False"]
+        for pc, opcode, operand in instructions:
+            mnemonic = INSTRUCTIONS[opcode][0]
+            next_pc = pc + 1 + len(operand)
+            operand = operand + [0, 0]
+            body = operation_source(opcode, "0x%02X" % operand[0], "0x%02X" % operand[1], "0x%04X" % next_pc, self.cpu.exact)
+            lines.append("    c += %d" % instruction_cycles(opcode))
+            if mnemonic in BLOCK_ENDS:
+                lines.append("    cpu.cycles = c")
+                lines.append("    cpu.program_counter = 0x%04X" % next_pc)
+                lines.extend("    " + line for line in body)
+                return "\n".join(lines) + "\n"
+            lines.extend("    " + line for line in body)
+            if any("write_byte(" in line for line in body):
+                # the write may have changed code later in this block
+                lines.append("    if memory.code_written:")
+                lines.append("        memory.code_written = False")
+                lines.append("        cpu.cycles = c")
+                lines.append("        cpu.program_counter = 0x%04X" % next_pc)
+                lines.append("        return")
+        lines.append("    cpu.cycles = c")
+        lines.append("    cpu.program_counter = 0x%04X" % next_pc)
+        return "\n".join(lines) + "\n"
+
+    def translate(self, entry):
+        """Compile and cache the block at entry, or None if it can't be translated."""
+        instructions = self.decode(entry)
+        if not instructions:
+            return None
+        namespace = {
+            "cpu": self.cpu,
+            "memory": self.memory,
+            "read_byte": self.memory.read_byte,
+            "write_byte": self.memory.write_byte,
+            "ADC_TABLE": ADC_TABLE,
+            "SBC_TABLE": SBC_TABLE,
+        }
+        exec compile(self.block_source(instructions), "<block %04X>" % entry, "exec") in namespace
+        block = namespace["block"]
+        block.length = len(instructions)
+        self.blocks[entry] = block
+        pc, opcode, operand = instructions[-1]
+        for page in range(entry >> 8, ((pc + len(operand)) >> 8) + 1):
+            self.page_blocks.setdefault(page, set()).add(entry)
+            if page < 0xC0 and page not in self.page_writers:
+                self.watch_page(page)
+        return block
+
+    def watch_page(self, page):
+        # writes to a page holding translated code go through write_code
+        # until the page is invalidated; other pages pay nothing
+        writer = self.memory.write_map[page]
+        self.page_writers[page] = writer
+
+        def write_code(cycle, address, value):
+            writer(cycle, address, value)
+            self.invalidate_page(page)
+
+        self.memory.write_map[page] = write_code
+
+    def invalidate_page(self, page):
+        for entry in self.page_blocks.pop(page, ()):
+            self.blocks.pop(entry, None)
+        if page in self.page_writers:
+            self.memory.write_map[page] = self.page_writers.pop(page)
+        self.memory.code_written = True
+
+    def flush(self):
+        for page in list(self.page_blocks):
+            self.invalidate_page(page)
+
+    def add_stop(self, address):
+        if address not in self.stops:
+            self.stops.add(address)
+            self.flush()
+
+
+# ROM TRAPS
+#
+# A trapped entry point has its first ROM byte replaced by TRAP_OPCODE, an
+# opcode the 6502 does not define, so traps are only looked for where an
+# unknown opcode would otherwise stop the CPU. The handler does the routine's work on memory and
+# registers, charges an estimate of its cycles and returns as RTS would;
+# or it declines, and the routine's own first instruction runs instead.
+
+TRAP_OPCODE = 0x02
+
+# monitor zero page
+WNDLFT, WNDWDTH, WNDTOP, WNDBTM = 0x20, 0x21, 0x22, 0x23
+CH, CV, BASL, BASH, BAS2L, BAS2H = 0x24, 0x25, 0x28, 0x29, 0x2A, 0x2B
+INVFLG, YSAV1, KSWL, KSWH = 0x32, 0x35, 0x38, 0x39
+RNDL, RNDH = 0x4E, 0x4F
+
+KEYIN = 0xFD1B
+
+# estimated cycles, taken from the monitor listing
+COUT_CYCLES = 66  # a character stored with no line change
+LINE_CYCLES = 40  # CR or LF and the VTAB that follows
+ROW_CYCLES = 40  # per window row scrolled or cleared, plus per byte below
+SCROLL_BYTE_CYCLES = 16
+CLEAR_BYTE_CYCLES = 14
+RDKEY_CYCLES = 64
+
+
+def text_base(row):
+    return 0x400 + ((row & 0x07) << 7) + (row >> 3) * 0x28
+
+
+def vtab(cpu, row):
+    base = text_base(row) + cpu.read_byte(WNDLFT)
+    cpu.write_byte(BASL, base & 0xFF)
+    cpu.write_byte(BASH, base >> 8)
+    return base
+
+
+def clear_row(cpu, base, start, width):
+    for column in range(start, width):
+        cpu.write_byte(base + column, 0xA0)
+    return ROW_CYCLES + (width - start) * CLEAR_BYTE_CYCLES
+
+
+def trap_return(cpu, cycles):
+    cpu.cycles += cycles - 2  # the fetch has been counted
+    cpu.program_counter = cpu.pull_word() + 1
+
+
+def trap_cout(cpu):
+    """COUT1 ($FDF0), the screen output COUT reaches through CSW."""
+    a = cpu.accumulator
+    char = a & cpu.read_byte(INVFLG) if a >= 0xA0 else a
+    if char in (0x87, 0x88):
+        return False  # leave the bell and backspace to the ROM
+    cpu.write_byte(YSAV1, cpu.y_index)
+    cycles = COUT_CYCLES
+    width = cpu.read_byte(WNDWDTH)
+    line = char in (0x8A, 0x8D)
+    if not 0x80 <= char < 0xA0:
+        ch = cpu.read_byte(CH)
+        cpu.write_byte((cpu.read_byte(BASL) + (cpu.read_byte(BASH) << 8) + ch) & 0xFFFF, char)
+        cpu.write_byte(CH, (ch + 1) & 0xFF)
+        line = ch + 1 >= width
+        char = 0x8D
+    if line:
+        cycles += LINE_CYCLES
+        if char == 0x8D:
+            cpu.write_byte(CH, 0x00)
+        cv = cpu.read_byte(CV) + 1
+        bottom = cpu.read_byte(WNDBTM)
+        if cv >= bottom:
+            cv -= 1
+            top = cpu.read_byte(WNDTOP)
+            left = cpu.read_byte(WNDLFT)
+            for row in range(top, bottom - 1):
+                to, source = text_base(row) + left, text_base(row + 1) + left
+                for column in range(width):
+                    cpu.write_byte(to + column, cpu.read_byte(source + column))
+                cycles += ROW_CYCLES + width * SCROLL_BYTE_CYCLES
+            base = vtab(cpu, bottom - 1)
+            cpu.write_byte(BAS2L, base & 0xFF)
+            cpu.write_byte(BAS2H, base >> 8)
+            cycles += clear_row(cpu, base, 0, width)
+        cpu.write_byte(CV, cv)
+        vtab(cpu, cv)
+    # A comes back from the stack and Y from YSAV1
+    cpu.nz = cpu.y_index
+    trap_return(cpu, cycles)
+    return True
+
+
+def trap_rdkey(cpu):
+    """RDKEY ($FD0C) when a key is already waiting for KEYIN."""
+    if cpu.read_byte(KSWL) + (cpu.read_byte(KSWH) << 8) != KEYIN:
+        return False
+    key = cpu.read_byte(0xC000)
+    if not key & 0x80:
+        return False  # let KEYIN wait, where it can be fast-forwarded
+    cycles = RDKEY_CYCLES
+    rnd = cpu.read_byte(RNDL) + (cpu.read_byte(RNDH) << 8) + 1
+    cpu.write_byte(RNDL, rnd & 0xFF)
+    if not rnd & 0xFF:
+        cpu.write_byte(RNDH, (rnd >> 8) & 0xFF)
+        cycles += 4
+    cpu.y_index = cpu.read_byte(CH)
+    cpu.accumulator = key
+    strobe = cpu.read_byte(0xC010)  # BIT KBDSTRB
+    cpu.overflow_flag = (strobe >> 6) & 1
+    cpu.nz = (strobe & 0x80) | 0x01 if strobe & key else (strobe & 0x80) << 1
+    trap_return(cpu, cycles)
+    return True
+
+
+def trap_home(cpu):
+    """HOME ($FC58): clear the text window and put the cursor at its top."""
+    top = cpu.read_byte(WNDTOP)
+    bottom = cpu.read_byte(WNDBTM)
+    width = cpu.read_byte(WNDWDTH)
+    left = cpu.read_byte(WNDLFT)
+    cycles = LINE_CYCLES
+    for row in range(top, max(bottom, top + 1)):
+        cycles += clear_row(cpu, text_base(row) + left, 0, width)
+    cpu.write_byte(CV, top)
+    cpu.write_byte(CH, 0x00)
+    cpu.accumulator = vtab(cpu, top) & 0xFF
+    cpu.y_index = 0x00
+    cpu.nz = cpu.accumulator
+    trap_return(cpu, cycles)
+    return True
+
+
+TRAPS = {
+    "COUT": (0xFDF0, trap_cout),
+    "RDKEY": (0xFD0C, trap_rdkey),
+    "HOME": (0xFC58, trap_home),
+}
 
 
 def usage():
@@ -1177,9 +3076,22 @@ def usage():
     print >>sys.stderr, "Usage: cpu6502.py [options]"
     print >>sys.stderr
     print >>sys.stderr, "    -b, --bus      Bus port number"
+    print >>sys.stderr, "    -c, --control  Control port number, 0 for any free one (default %d)" % CONTROL_PORT
+    print >>sys.stderr, "    -e, --exact    Count page crossing cycles (default base cycles only)"
+    print >>sys.stderr, "    -K, --record   File to record key presses to, with their cycles"
+    print >>sys.stderr, "    -k, --replay   File of recorded key presses to replay (ignoring live ones)"
     print >>sys.stderr, "    -p, --pc       Initial PC value"
+    print >>sys.stderr, "    -m, --mhz      Report the emulated speed every few seconds"
+    print >>sys.stderr, "    -n, --native   Trap a ROM routine: COUT, RDKEY or HOME (repeatable)"
+    print >>sys.stderr, "    -P, --profile  Count instructions and cycles per PC and opcode"
+    print >>sys.stderr, "    -L, --restore  Snapshot file to start from (default reset)"
     print >>sys.stderr, "    -R, --rom      ROM file to use (default A2ROM.BIN)"
     print >>sys.stderr, "    -r, --ram      RAM file to load (default none)"
+    print >>sys.stderr, "    -S, --snapshot Snapshot file to save when the core stops"
+    print >>sys.stderr, "    -T, --turbo    Run unthrottled"
+    print >>sys.stderr, "    -t, --translate Translate basic blocks (default interpret)"
+    print >>sys.stderr, "    -v, --video    Shared video RAM file (default bus writes)"
+    print >>sys.stderr, "    -x, --speed    Speed as a multiple of 1.023 MHz (default 1)"
     sys.exit(1)
 
 
@@ -1189,7 +3101,19 @@ def get_options():
             self.rom = "A2ROM.BIN"
             self.ram = None
             self.bus = None
+            self.control = CONTROL_PORT
             self.pc = None
+            self.translate = False
+            self.exact = False
+            self.profile = False
+            self.record = None
+            self.replay = None
+            self.restore = None
+            self.snapshot = None
+            self.video = None
+            self.speed = 1.0
+            self.report = False
+            self.traps = []
 
     options = Options()
     a = 1
@@ -1198,6 +3122,9 @@ def get_options():
             if sys.argv[a] in ("-b", "--bus"):
                 a += 1
                 options.bus = int(sys.argv[a])
+            elif sys.argv[a] in ("-c", "--control"):
+                a += 1
+                options.control = int(sys.argv[a])
             elif sys.argv[a] in ("-p", "--pc"):
                 a += 1
                 options.pc = int(sys.argv[a])
@@ -1207,6 +3134,39 @@ def get_options():
             elif sys.argv[a] in ("-r", "--ram"):
                 a += 1
                 options.ram = sys.argv[a]
+            elif sys.argv[a] in ("-K", "--record"):
+                a += 1
+                options.record = sys.argv[a]
+            elif sys.argv[a] in ("-k", "--replay"):
+                a += 1
+                options.replay = sys.argv[a]
+            elif sys.argv[a] in ("-L", "--restore"):
+                a += 1
+                options.restore = sys.argv[a]
+            elif sys.argv[a] in ("-S", "--snapshot"):
+                a += 1
+                options.snapshot = sys.argv[a]
+            elif sys.argv[a] in ("-t", "--translate"):
+                options.translate = True
+            elif sys.argv[a] in ("-e", "--exact"):
+                options.exact = True
+            elif sys.argv[a] in ("-P", "--profile"):
+                options.profile = True
+            elif sys.argv[a] in ("-m", "--mhz"):
+                options.report = True
+            elif sys.argv[a] in ("-n", "--native"):
+                a += 1
+                if sys.argv[a].upper() not in TRAPS:
+                    usage()
+                options.traps.append(sys.argv[a].upper())
+            elif sys.argv[a] in ("-x", "--speed"):
+                a += 1
+                options.speed = float(sys.argv[a])
+            elif sys.argv[a] in ("-T", "--turbo"):
+                options.speed = None
+            elif sys.argv[a] in ("-v", "--video"):
+                a += 1
+                options.video = sys.argv[a]
             else:
                 usage()
         else:
@@ -1226,4 +3186,4 @@ if __name__ == "__main__":
     mem = Memory(options)
 
     cpu = CPU(options, mem)
-    cpu.run(options.bus)
+    cpu.run(options.bus, options.control)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# ApplePy - an Apple ][ emulator in Python
+# James Tauber / http://jtauber.com/
+# originally written 2001, updated 2011
+
+
+import json
+import os
+import select
+import sys
+import traceback
+
+from cpu6502 import Memory, CPU
+
+
+# Boot one headless emulator, then fork a worker per job from the booted
+# state. Workers share the parent's memory copy-on-write, so a job costs a
+# fork rather than a boot. Each worker types its input script, runs until
+# the script is used up and the program waits for a key (or the cycle
+# limit is reached), and sends its text screen back up a pipe.
+
+KEY_CYCLES = 1000  # between checks that the program has taken the last key
+LIMIT = 50000000  # cycles a job may run, about 50 seconds at 1.023 MHz
+
+
+class Keyboard:
+    """
+    Types a script into the keyboard latch, a key each time the program
+    has cleared the strobe for the last one. Newlines are sent as RETURN.
+    """
+
+    def __init__(self, memory, script):
+        self.memory = memory
+        self.keys = [0x80 | (0x0D if c == "\n" else ord(c) & 0x7F) for c in reversed(script)]
+
+    def schedule(self, scheduler):
+        scheduler.every(KEY_CYCLES, self.type)
+
+    def type(self, cycle):
+        if self.keys and not self.memory.kbd & 0x80:
+            self.memory.bus_input(cycle, 0xC000, self.keys.pop())
+
+    def done(self):
+        return not self.keys and not self.memory.kbd & 0x80
+
+
+def screen(memory):
+    """The text page 1 rows as strings, trailing spaces removed."""
+    rows = []
+    for row in range(24):
+        base = 0x400 + (row & 7) * 0x80 + (row >> 3) * 0x28
+        s = ""
+        for c in memory.ram._mem[base:base + 40]:
+            # adjust for apple character set
+            c &= 0x3F
+            if c < 0x20:
+                c += 0x40
+            s += chr(c)
+        rows.append(s.rstrip())
+    return rows
+
+
+def run(cpu, script, limit, stop=None):
+    """
+    Type script and run for up to limit cycles from now. Given a stop PC,
+    run until the PC reaches it, instruction by instruction; otherwise
+    until the script is used up and the CPU sits in an idle loop. Returns
+    why it stopped: "stop", "idle", "halt" (an unknown opcode) or "limit".
+    """
+    keyboard = Keyboard(cpu.memory, script)
+    keyboard.schedule(cpu.scheduler)
+    scheduler = cpu.scheduler
+    limit += cpu.cycles
+    while cpu.cycles < limit:
+        until = min(scheduler.next_deadline(), limit)
+        if stop is not None:
+            while cpu.cycles < until and cpu.program_counter != stop:
+                if cpu.interrupts:
+                    cpu.interrupt()
+                if not cpu.step():
+                    return "halt"
+            if cpu.program_counter == stop:
+                return "stop"
+        elif cpu.interrupts and cpu.interrupt():
+            cpu.execute(until)
+        elif cpu.skip_idle(until):
+            if keyboard.done():
+                return "idle"
+        elif not cpu.skip_countdown(until):
+            cpu.execute(until)
+        if not cpu.running:
+            return "halt"
+        scheduler.run(cpu.cycles)
+    return "limit"
+
+
+def job(cpu, script, limit, stop=None):
+    start = cpu.cycles
+    stopped = run(cpu, script, limit, stop)
+    return {
+        "cycles": cpu.cycles - start,
+        "stopped": stopped,
+        "registers": dict((x, getattr(cpu, x)) for x in (
+            "accumulator",
+            "x_index",
+            "y_index",
+            "stack_pointer",
+            "program_counter",
+        )),
+        "status": cpu.status_as_byte(),
+        "screen": screen(cpu.memory),
+    }
+
+
+def farm(cpu, scripts, workers, limit=LIMIT):
+    """
+    Run each script in a worker forked from cpu as it stands, at most
+    workers at a time; return their results in order.
+    """
+    results = [None] * len(scripts)
+    pending = list(enumerate(scripts))
+    running = {}  # result pipe -> (index, pid)
+    while pending or running:
+        while pending and len(running) < workers:
+            index, script = pending.pop(0)
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(r)
+                try:
+                    os.write(w, json.dumps(job(cpu, script, limit)))
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    os._exit(0)
+            os.close(w)
+            running[r] = (index, pid)
+        rs, _, _ = select.select(list(running), [], [])
+        for r in rs:
+            index, pid = running.pop(r)
+            with os.fdopen(r) as f:
+                data = f.read()
+            os.waitpid(pid, 0)
+            results[index] = json.loads(data) if data else {"error": "worker failed"}
+    return results
+
+
+def usage():
+    print >>sys.stderr, "ApplePy - an Apple ][ emulator in Python"
+    print >>sys.stderr, "James Tauber / http://jtauber.com/"
+    print >>sys.stderr
+    print >>sys.stderr, "Usage: farm.py [options] SCRIPT..."
+    print >>sys.stderr
+    print >>sys.stderr, "    -c, --cycles   Cycles each job may run (default %d)" % LIMIT
+    print >>sys.stderr, "    -j, --jobs     Workers at a time (default %d)" % os.sysconf("SC_NPROCESSORS_ONLN")
+    print >>sys.stderr, "    -L, --restore  Snapshot file to start from (default boot)"
+    print >>sys.stderr, "    -R, --rom      ROM file to use (default A2ROM.BIN)"
+    print >>sys.stderr, "    -r, --ram      RAM file to load (default none)"
+    print >>sys.stderr, "    -s, --setup    Script typed once before forking (default none)"
+    print >>sys.stderr, "    -t, --translate Translate basic blocks (default interpret)"
+    sys.exit(1)
+
+
+def get_options():
+    class Options:
+        def __init__(self):
+            self.cycles = LIMIT
+            self.jobs = os.sysconf("SC_NPROCESSORS_ONLN")
+            self.restore = None
+            self.rom = "A2ROM.BIN"
+            self.ram = None
+            self.setup = None
+            self.translate = False
+            self.scripts = []
+
+    options = Options()
+    a = 1
+    while a < len(sys.argv):
+        if sys.argv[a].startswith("-"):
+            if sys.argv[a] in ("-c", "--cycles"):
+                a += 1
+                options.cycles = int(sys.argv[a])
+            elif sys.argv[a] in ("-j", "--jobs"):
+                a += 1
+                options.jobs = int(sys.argv[a])
+            elif sys.argv[a] in ("-L", "--restore"):
+                a += 1
+                options.restore = sys.argv[a]
+            elif sys.argv[a] in ("-R", "--rom"):
+                a += 1
+                options.rom = sys.argv[a]
+            elif sys.argv[a] in ("-r", "--ram"):
+                a += 1
+                options.ram = sys.argv[a]
+            elif sys.argv[a] in ("-s", "--setup"):
+                a += 1
+                options.setup = sys.argv[a]
+            elif sys.argv[a] in ("-t", "--translate"):
+                options.translate = True
+            else:
+                usage()
+        else:
+            options.scripts.append(sys.argv[a])
+        a += 1
+
+    if not options.scripts:
+        usage()
+    return options
+
+
+def read_script(path):
+    with open(path) as f:
+        return f.read()
+
+
+def main():
+    options = get_options()
+    memory = Memory(use_bus=False)
+    memory.rom.load_file(0xD000, options.rom)
+    if options.ram:
+        memory.ram.load_file(0x0000, options.ram)
+    cpu = CPU(None, memory)
+    if options.translate:
+        cpu.enable_translation()
+    if options.restore:
+        cpu.load_snapshot(options.restore)
+    run(cpu, read_script(options.setup) if options.setup else "", options.cycles)
+    results = farm(cpu, [read_script(path) for path in options.scripts], options.jobs, options.cycles)
+    for path, result in zip(options.scripts, results):
+        result["script"] = path
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+
+# ApplePy - an Apple ][ emulator in Python
+# James Tauber / http://jtauber.com/
+# originally written 2001, updated 2011
+
+
+import sys
+
+from cpu6502 import INSTRUCTIONS, ADDRESSING_MODES
+
+
+# A ROM image we can ship, for benchmarks and tests that need something
+# to boot. It has nothing of the monitor's but its memory layout: code at
+# the top of the $D000-$FFFF ROM, the vectors, and a text screen at $0400.
+
+ROM_START = 0xD000
+ROM_SIZE = 0x3000
+CODE_START = 0xF800
+
+OPCODES = dict((info[:2], opcode) for opcode, info in INSTRUCTIONS.items())
+
+
+class Assembler:
+    """
+    Assembles one instruction per op() call. Operands are numbers or
+    label names, optionally with an offset ("ROWLO+1"), and are resolved
+    when assemble() is called, so labels may be used before they're set.
+    """
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.code = bytearray()
+        self.labels = {}
+        self.fixups = []  # (offset, mode, operand)
+        self.unique = 0
+
+    def here(self):
+        return self.origin + len(self.code)
+
+    def label(self, name=None):
+        if name is None:
+            self.unique += 1
+            name = "_%d" % self.unique
+        if name in self.labels:
+            raise ValueError("label %s defined twice" % name)
+        self.labels[name] = self.here()
+        return name
+
+    def op(self, mnemonic, mode="implied", operand=None):
+        opcode = OPCODES.get((mnemonic, mode))
+        if opcode is None:
+            raise ValueError("no %s in %s mode" % (mnemonic, mode))
+        self.code.append(opcode)
+        length = ADDRESSING_MODES[mode][0]
+        if length:
+            self.fixups.append((len(self.code), mode, operand))
+            self.code.extend([0x00] * length)
+
+    def data(self, values):
+        self.code.extend(values)
+
+    def text(self, s):
+        """A string in screen codes (high bit set), zero terminated."""
+        self.data([ord(c) | 0x80 for c in s] + [0x00])
+
+    def value(self, operand):
+        if isinstance(operand, int):
+            return operand
+        name, sign, offset = operand.partition("+")
+        if not sign:
+            name, sign, offset = operand.partition("-")
+        if name not in self.labels:
+            raise ValueError("undefined label %s" % name)
+        offset = int(offset) if offset else 0
+        return self.labels[name] + (offset if sign == "+" else -offset)
+
+    def assemble(self):
+        for offset, mode, operand in self.fixups:
+            value = self.value(operand)
+            if mode == "relative":
+                value -= self.origin + offset + 1
+                if not -0x80 <= value < 0x80:
+                    raise ValueError("branch to %s out of range" % operand)
+                self.code[offset] = value & 0xFF
+            elif ADDRESSING_MODES[mode][0] == 1:
+                if not 0 <= value < 0x100:
+                    raise ValueError("operand %s does not fit a byte" % operand)
+                self.code[offset] = value
+            else:
+                self.code[offset] = value & 0xFF
+                self.code[offset + 1] = value >> 8
+        return self.code
+
+
+# zero page
+CH, CV, BASL, BASH, SRCL, SRCH, YSAV = 0x24, 0x25, 0x28, 0x29, 0x2A, 0x2B, 0x2F
+MCAND, MPLIER, PRODL, PRODH = 0xE0, 0xE1, 0xE2, 0xE3
+COUNT, STEP, INDEX = 0xE4, 0xE5, 0xE6
+FIBAL, FIBAH, FIBBL, FIBBH = 0xE7, 0xE8, 0xE9, 0xEA
+IRQ_COUNT, NMI_COUNT = 0xEB, 0xED  # 16-bit and 8-bit
+
+SIEVE = 0x2000  # 256 flags
+FIB_TERMS = 24
+
+
+def print_string(a, name):
+    a.op("LDX", "immediate", 0x00)
+    loop = a.label()
+    a.op("LDA", "absolute_x", name)
+    done = "%s_done" % loop
+    a.op("BEQ", "relative", done)
+    a.op("JSR", "absolute", "COUT")
+    a.op("INX")
+    a.op("BNE", "relative", loop)
+    a.label(done)
+
+
+def print_word(a, high, low):
+    a.op("LDA", "zero_page", high)
+    a.op("JSR", "absolute", "PRBYTE")
+    a.op("LDA", "zero_page", low)
+    a.op("JSR", "absolute", "PRBYTE")
+
+
+def text_routines(a):
+    # HOME: clear $0400-$07FF and put the cursor at the top left
+    a.label("HOME")
+    a.op("LDA", "immediate", 0x00)
+    a.op("STA", "zero_page", BASL)
+    a.op("TAY")
+    a.op("LDX", "immediate", 0x04)
+    a.label("HOME_PAGE")
+    a.op("STX", "zero_page", BASH)
+    a.op("LDA", "immediate", 0xA0)
+    a.label("HOME_BYTE")
+    a.op("STA", "indirect_y", BASL)
+    a.op("INY")
+    a.op("BNE", "relative", "HOME_BYTE")
+    a.op("INX")
+    a.op("CPX", "immediate", 0x08)
+    a.op("BNE", "relative", "HOME_PAGE")
+    a.op("STY", "zero_page", CH)
+    a.op("STY", "zero_page", CV)
+    # fall into VTAB
+
+    # VTAB: point BASL/BASH at row CV
+    a.label("VTAB")
+    a.op("TXA")
+    a.op("PHA")
+    a.op("LDX", "zero_page", CV)
+    a.op("LDA", "absolute_x", "ROWLO")
+    a.op("STA", "zero_page", BASL)
+    a.op("LDA", "absolute_x", "ROWHI")
+    a.op("STA", "zero_page", BASH)
+    a.op("PLA")
+    a.op("TAX")
+    a.op("RTS")
+
+    # COUT: print A at the cursor; $8D starts a new line
+    a.label("COUT")
+    a.op("PHA")
+    a.op("CMP", "immediate", 0x8D)
+    a.op("BEQ", "relative", "COUT_CR")
+    a.op("STY", "zero_page", YSAV)
+    a.op("LDY", "zero_page", CH)
+    a.op("STA", "indirect_y", BASL)
+    a.op("INY")
+    a.op("STY", "zero_page", CH)
+    a.op("LDY", "zero_page", YSAV)
+    a.op("LDA", "zero_page", CH)
+    a.op("CMP", "immediate", 40)
+    a.op("BCC", "relative", "COUT_DONE")
+    a.label("COUT_CR")
+    a.op("LDA", "immediate", 0x00)
+    a.op("STA", "zero_page", CH)
+    a.op("INC", "zero_page", CV)
+    a.op("LDA", "zero_page", CV)
+    a.op("CMP", "immediate", 24)
+    a.op("BCC", "relative", "COUT_LINE")
+    a.op("JSR", "absolute", "SCROLL")
+    a.label("COUT_LINE")
+    a.op("JSR", "absolute", "VTAB")
+    a.label("COUT_DONE")
+    a.op("PLA")
+    a.op("RTS")
+
+    # SCROLL: move rows 1-23 up one, clear row 23 and leave CV there
+    a.label("SCROLL")
+    a.op("TXA")
+    a.op("PHA")
+    a.op("TYA")
+    a.op("PHA")
+    a.op("LDX", "immediate", 0x00)
+    a.label("SCROLL_ROW")
+    a.op("LDA", "absolute_x", "ROWLO")
+    a.op("STA", "zero_page", BASL)
+    a.op("LDA", "absolute_x", "ROWHI")
+    a.op("STA", "zero_page", BASH)
+    a.op("LDA", "absolute_x", "ROWLO+1")
+    a.op("STA", "zero_page", SRCL)
+    a.op("LDA", "absolute_x", "ROWHI+1")
+    a.op("STA", "zero_page", SRCH)
+    a.op("LDY", "immediate", 39)
+    a.label("SCROLL_BYTE")
+    a.op("LDA", "indirect_y", SRCL)
+    a.op("STA", "indirect_y", BASL)
+    a.op("DEY")
+    a.op("BPL", "relative", "SCROLL_BYTE")
+    a.op("INX")
+    a.op("CPX", "immediate", 23)
+    a.op("BCC", "relative", "SCROLL_ROW")
+    a.op("LDA", "immediate", 0xA0)
+    a.op("LDY", "immediate", 39)
+    a.label("SCROLL_CLEAR")
+    a.op("STA", "indirect_y", SRCL)
+    a.op("DEY")
+    a.op("BPL", "relative", "SCROLL_CLEAR")
+    a.op("LDA", "immediate", 23)
+    a.op("STA", "zero_page", CV)
+    a.op("PLA")
+    a.op("TAY")
+    a.op("PLA")
+    a.op("TAX")
+    a.op("RTS")
+
+    # PRBYTE: print A as two hex digits
+    a.label("PRBYTE")
+    a.op("PHA")
+    a.op("LSR", "accumulator")
+    a.op("LSR", "accumulator")
+    a.op("LSR", "accumulator")
+    a.op("LSR", "accumulator")
+    a.op("JSR", "absolute", "PRHEX")
+    a.op("PLA")
+    a.op("AND", "immediate", 0x0F)
+    a.label("PRHEX")
+    a.op("ORA", "immediate", 0xB0)
+    a.op("CMP", "immediate", 0xBA)
+    a.op("BCC", "relative", "PRHEX_DIGIT")
+    a.op("ADC", "immediate", 0x06)
+    a.label("PRHEX_DIGIT")
+    a.op("JMP", "absolute", "COUT")
+
+
+def kernels(a):
+    # PRIMES: count the primes below 256 with a sieve at SIEVE
+    a.label("PRIMES")
+    a.op("LDA", "immediate", 0x00)
+    a.op("TAX")
+    a.label("PRIMES_CLEAR")
+    a.op("STA", "absolute_x", SIEVE)
+    a.op("INX")
+    a.op("BNE", "relative", "PRIMES_CLEAR")
+    a.op("STA", "zero_page", COUNT)
+    a.op("LDX", "immediate", 0x02)
+    a.label("PRIMES_NEXT")
+    a.op("LDA", "absolute_x", SIEVE)
+    a.op("BNE", "relative", "PRIMES_SKIP")
+    a.op("INC", "zero_page", COUNT)
+    a.op("STX", "zero_page", STEP)
+    a.op("TXA")
+    a.op("CLC")
+    a.op("ADC", "zero_page", STEP)
+    a.op("BCS", "relative", "PRIMES_SKIP")
+    a.label("PRIMES_MARK")
+    a.op("TAY")
+    a.op("LDA", "immediate", 0x01)
+    a.op("STA", "absolute_y", SIEVE)
+    a.op("TYA")
+    a.op("CLC")
+    a.op("ADC", "zero_page", STEP)
+    a.op("BCC", "relative", "PRIMES_MARK")
+    a.label("PRIMES_SKIP")
+    a.op("INX")
+    a.op("BNE", "relative", "PRIMES_NEXT")
+    a.op("RTS")
+
+    # FIB: the 16-bit Fibonacci number FIB_TERMS in FIBAH/FIBAL
+    a.label("FIB")
+    a.op("LDA", "immediate", 0x00)
+    a.op("STA", "zero_page", FIBAL)
+    a.op("STA", "zero_page", FIBAH)
+    a.op("STA", "zero_page", FIBBH)
+    a.op("LDA", "immediate", 0x01)
+    a.op("STA", "zero_page", FIBBL)
+    a.op("LDX", "immediate", FIB_TERMS)
+    a.label("FIB_STEP")
+    a.op("CLC")
+    a.op("LDA", "zero_page", FIBAL)
+    a.op("ADC", "zero_page", FIBBL)
+    a.op("TAY")
+    a.op("LDA", "zero_page", FIBAH)
+    a.op("ADC", "zero_page", FIBBH)
+    a.op("PHA")
+    a.op("LDA", "zero_page", FIBBL)
+    a.op("STA", "zero_page", FIBAL)
+    a.op("LDA", "zero_page", FIBBH)
+    a.op("STA", "zero_page", FIBAH)
+    a.op("STY", "zero_page", FIBBL)
+    a.op("PLA")
+    a.op("STA", "zero_page", FIBBH)
+    a.op("DEX")
+    a.op("BNE", "relative", "FIB_STEP")
+    a.op("RTS")
+
+    # SQUARES: the sum of n * n for n < 256, modulo $10000, in PRODH/PRODL
+    # by way of MUL8
+    a.label("SQUARES")
+    a.op("LDA", "immediate", 0x00)
+    a.op("STA", "zero_page", INDEX)
+    a.op("STA", "zero_page", COUNT)
+    a.op("STA", "zero_page", STEP)
+    a.label("SQUARES_NEXT")
+    a.op("LDA", "zero_page", INDEX)
+    a.op("LDX", "zero_page", INDEX)
+    a.op("JSR", "absolute", "MUL8")
+    a.op("CLC")
+    a.op("LDA", "zero_page", PRODL)
+    a.op("ADC", "zero_page", COUNT)
+    a.op("STA", "zero_page", COUNT)
+    a.op("LDA", "zero_page", PRODH)
+    a.op("ADC", "zero_page", STEP)
+    a.op("STA", "zero_page", STEP)
+    a.op("INC", "zero_page", INDEX)
+    a.op("BNE", "relative", "SQUARES_NEXT")
+    a.op("LDA", "zero_page", COUNT)
+    a.op("STA", "zero_page", PRODL)
+    a.op("LDA", "zero_page", STEP)
+    a.op("STA", "zero_page", PRODH)
+    a.op("RTS")
+
+    # MUL8: A * X into PRODH/PRODL, by shift and add
+    a.label("MUL8")
+    a.op("STA", "zero_page", MCAND)
+    a.op("STX", "zero_page", MPLIER)
+    a.op("LDA", "immediate", 0x00)
+    a.op("STA", "zero_page", PRODL)
+    a.op("LDX", "immediate", 0x08)
+    a.label("MUL8_BIT")
+    a.op("LSR", "zero_page", MPLIER)
+    a.op("BCC", "relative", "MUL8_SHIFT")
+    a.op("CLC")
+    a.op("ADC", "zero_page", MCAND)
+    a.label("MUL8_SHIFT")
+    a.op("ROR", "accumulator")
+    a.op("ROR", "zero_page", PRODL)
+    a.op("DEX")
+    a.op("BNE", "relative", "MUL8_BIT")
+    a.op("STA", "zero_page", PRODH)
+    a.op("RTS")
+
+
+def synthetic_rom():
+    """The ROM image for $D000-$FFFF, and its labels."""
+    a = Assembler(CODE_START)
+
+    a.label("RESET")
+    a.op("CLD")
+    a.op("LDX", "immediate", 0xFF)
+    a.op("TXS")
+    a.op("CLI")
+    a.op("JSR", "absolute", "HOME")
+    print_string(a, "BANNER")
+    a.op("JSR", "absolute", "PRIMES")
+    print_string(a, "PRIMES_TEXT")
+    a.op("LDA", "zero_page", COUNT)
+    a.op("JSR", "absolute", "PRBYTE")
+    a.op("JSR", "absolute", "FIB")
+    print_string(a, "FIB_TEXT")
+    print_word(a, FIBAH, FIBAL)
+    a.op("JSR", "absolute", "SQUARES")
+    print_string(a, "SQUARES_TEXT")
+    print_word(a, PRODH, PRODL)
+    print_string(a, "READY_TEXT")
+
+    # echo keys until reset
+    a.label("KEYLOOP")
+    a.op("LDA", "absolute", 0xC000)
+    a.op("BPL", "relative", "KEYLOOP")
+    a.op("BIT", "absolute", 0xC010)
+    a.op("JSR", "absolute", "COUT")
+    a.op("JMP", "absolute", "KEYLOOP")
+
+    # IRQ and BRK count in IRQ_COUNT, NMI in NMI_COUNT
+    a.label("IRQ")
+    a.op("INC", "zero_page", IRQ_COUNT)
+    a.op("BNE", "relative", "IRQ_DONE")
+    a.op("INC", "zero_page", IRQ_COUNT + 1)
+    a.label("IRQ_DONE")
+    a.op("RTI")
+    a.label("NMI")
+    a.op("INC", "zero_page", NMI_COUNT)
+    a.op("RTI")
+
+    text_routines(a)
+    kernels(a)
+
+    a.label("ROWLO")
+    a.data([(0x400 + (row & 7) * 0x80 + (row >> 3) * 0x28) & 0xFF for row in range(24)])
+    a.label("ROWHI")
+    a.data([(0x400 + (row & 7) * 0x80 + (row >> 3) * 0x28) >> 8 for row in range(24)])
+    a.label("BANNER")
+    a.text("APPLEPY SYNTHETIC ROM")
+    a.label("PRIMES_TEXT")
+    a.text("\x8DPRIMES ")
+    a.label("FIB_TEXT")
+    a.text("\x8DFIB ")
+    a.label("SQUARES_TEXT")
+    a.text("\x8DSQUARES ")
+    a.label("READY_TEXT")
+    a.text("\x8DREADY\x8D")
+
+    code = a.assemble()
+    if CODE_START + len(code) > 0xFFFA:
+        raise ValueError("code overlaps the vectors")
+    image = bytearray(ROM_SIZE)
+    image[CODE_START - ROM_START:CODE_START - ROM_START + len(code)] = code
+    for vector, name in ((0xFFFA, "NMI"), (0xFFFC, "RESET"), (0xFFFE, "IRQ")):
+        address = a.labels[name]
+        image[vector - ROM_START] = address & 0xFF
+        image[vector - ROM_START + 1] = address >> 8
+    return image, a.labels
+
+
+def load(memory):
+    """Load the synthetic ROM into memory, returning its labels."""
+    image, labels = synthetic_rom()
+    memory.rom.load(ROM_START, image)
+    return labels
+
+
+def usage():
+    print >>sys.stderr, "ApplePy - an Apple ][ emulator in Python"
+    print >>sys.stderr, "James Tauber / http://jtauber.com/"
+    print >>sys.stderr
+    print >>sys.stderr, "Usage: romgen.py [options]"
+    print >>sys.stderr
+    print >>sys.stderr, "    -o, --output   ROM file to write (default SYNTH.ROM)"
+    print >>sys.stderr, "    -s, --symbols  Print the address of each label"
+    sys.exit(1)
+
+
+def get_options():
+    class Options:
+        def __init__(self):
+            self.output = "SYNTH.ROM"
+            self.symbols = False
+
+    options = Options()
+    a = 1
+    while a < len(sys.argv):
+        if sys.argv[a].startswith("-"):
+            if sys.argv[a] in ("-o", "--output"):
+                a += 1
+                options.output = sys.argv[a]
+            elif sys.argv[a] in ("-s", "--symbols"):
+                options.symbols = True
+            else:
+                usage()
+        else:
+            usage()
+        a += 1
+
+    return options
+
+
+if __name__ == "__main__":
+    options = get_options()
+    image, labels = synthetic_rom()
+    with open(options.output, "wb") as f:
+        f.write(image)
+    if options.symbols:
+        for address, name in sorted((address, name) for name, address in labels.items() if not name.startswith("_")):
+            print "%04X %s" % (address, name)
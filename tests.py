@@ -1,5 +1,18 @@
+import os
+import random
+import re
+import socket
+import tempfile
+import time
 import unittest
-from cpu6502 import Memory, CPU
+from cpu6502 import Memory, CPU, INSTRUCTIONS, ADDRESSING_MODES
+from cpu6502 import Bus, BusReader, BUS_MESSAGE, BUS_READ, BUS_WRITE, bus_frame
+from cpu6502 import SharedVideo, Scheduler, Throttle, CPU_HZ
+from cpu6502 import ADC_TABLE, SBC_TABLE, arithmetic_index
+from cpu6502 import find_idle_loop
+import batch
+import farm
+import romgen
 
 
 class TestMemory(unittest.TestCase):
@@ -21,12 +34,95 @@ class TestMemory(unittest.TestCase):
         self.assertEqual(self.memory.read_byte(None, 0x1001), 0x12)
         self.assertEqual(self.memory.read_byte(None, 0x1002), 0x13)
 
+    def test_view(self):
+        self.memory.load(0x1000, [0x01, 0x02, 0x03])
+        view = self.memory.view(0x1000, 0x1002)
+        self.assertEqual(view.tolist(), [0x01, 0x02, 0x03])
+        self.memory.write_byte(None, 0x1001, 0x22)
+        self.assertEqual(view.tolist(), [0x01, 0x22, 0x03])
+        self.assertEqual(self.memory.view(0xBFFF, 0xC000), None)
+
+    def test_write_range(self):
+        writes = []
+        self.memory.bus_write = lambda cycle, address, value: writes.append((address, value))
+        self.memory.write_range(0x1000, "\x01\x02")
+        self.memory.write_range(0x07FF, "\x03\x04")
+        self.assertEqual(self.memory.view(0x1000, 0x1001).tolist(), [0x01, 0x02])
+        self.assertEqual(self.memory.view(0x07FF, 0x0800).tolist(), [0x03, 0x04])
+        self.assertEqual(writes, [(0x07FF, 0x03)])
+
+    def test_claim(self):
+        writes = []
+        self.memory.claim(0xC080, 0xC08F, read=lambda cycle, address: address & 0xFF, write=lambda cycle, address, value: writes.append((address, value)))
+        self.assertEqual(self.memory.read_byte(None, 0xC085), 0x85)
+        self.assertEqual(self.memory.read_byte(None, 0xC090), 0x00)
+        self.memory.write_byte(None, 0xC08F, 0x12)
+        self.memory.write_byte(None, 0xC07F, 0x34)
+        self.assertEqual(writes, [(0xC08F, 0x12)])
+
+    def test_claim_pages(self):
+        self.memory.claim(0x1000, 0x1FFF, read=lambda cycle, address: 0x42)
+        self.assertEqual(self.memory.read_byte(None, 0x1234), 0x42)
+        self.memory.write_byte(None, 0x1234, 0x11)
+        self.assertEqual(self.memory.read_byte(None, 0x1234), 0x42)
+        self.assertEqual(self.memory.ram._mem[0x1234], 0x11)
+
+
+class TestSoftSwitches(unittest.TestCase):
+
+    def setUp(self):
+        self.memory = Memory(use_bus=False)
+        self.notified = []
+        self.memory.bus_write = lambda cycle, address, value: self.notified.append(address)
+
+    def test_keyboard(self):
+        self.assertEqual(self.memory.read_byte(None, 0xC000), 0x00)
+        self.memory.bus_input(None, 0xC000, 0xC1)
+        self.assertEqual(self.memory.read_byte(None, 0xC000), 0xC1)
+        self.memory.read_byte(None, 0xC010)
+        self.assertEqual(self.memory.read_byte(None, 0xC000), 0x41)
+
+    def test_display_switches(self):
+        for address in (0xC051, 0xC050, 0xC050, 0xC057, 0xC054):
+            self.memory.read_byte(None, address)
+        self.assertEqual(self.memory.switches, [0, 0, 0, 1])
+        self.assertEqual(self.notified, [0xC050, 0xC057])
+
+
+class TestSharedVideo(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.memory = Memory(use_bus=False)
+        self.memory.load(0x400, [0xC1])
+        self.memory.share_video(SharedVideo(self.path, create=True))
+        self.display = SharedVideo(self.path)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_initial_contents(self):
+        self.assertEqual(len(self.display.dirty_pages()), 0x44)
+        self.assertEqual(self.display.read_page(0x04)[0], "\xC1")
+
+    def test_dirty_pages(self):
+        self.display.dirty_pages()
+        self.memory.write_byte(None, 0x0300, 0x11)
+        self.memory.write_byte(None, 0x0401, 0x22)
+        self.memory.write_byte(None, 0x2000, 0x33)
+        self.assertEqual(self.memory.read_byte(None, 0x0401), 0x22)
+        self.assertEqual(self.display.dirty_pages(), [0x04, 0x20])
+        self.assertEqual(self.display.dirty_pages(), [])
+        self.assertEqual(self.display.read_page(0x04)[1], "\x22")
+        self.assertEqual(self.display.read_page(0x20)[0], "\x33")
+
 
 class TestLoadStoreOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
         self.memory.load(0x1000, [0x00, 0x01, 0x7F, 0x80, 0xFF])
 
     def test_LDA(self):
@@ -115,7 +211,7 @@ class TestRegisterTransferOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_TAX(self):
         self.cpu.accumulator = 0x00
@@ -190,7 +286,7 @@ class TestStackOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_TSX(self):
         s = self.cpu.stack_pointer
@@ -238,7 +334,7 @@ class TestLogicalOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_AND(self):
         self.memory.write_byte(None, 0x1000, 0x37)
@@ -326,7 +422,7 @@ class TestArithmeticOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_ADC_without_BCD(self):
 
@@ -541,11 +637,76 @@ class TestArithmeticOperations(unittest.TestCase):
         self.assertEqual(self.cpu.carry_flag, 0)
 
 
+class TestArithmeticTables(unittest.TestCase):
+
+    def flags(self, entry):
+        # (result, carry, overflow, zero, sign) from a table entry
+        result, carry, overflow, nz = entry
+        return result, carry, overflow, 0 if nz & 0xFF else 1, 1 if nz & 0x180 else 0
+
+    def bcd(self, n):
+        return (n // 10) << 4 | n % 10
+
+    def test_binary(self):
+        for carry in (0, 1):
+            for a in range(0x100):
+                for m in range(0x100):
+                    index = arithmetic_index(0, carry, a, m)
+                    r = a + m + carry
+                    s = (a ^ 0x80) - 0x80 + (m ^ 0x80) - 0x80 + carry
+                    self.assertEqual(self.flags(ADC_TABLE[index]), (
+                        r & 0xFF, r >> 8, 0 if -128 <= s <= 127 else 1,
+                        0 if r & 0xFF else 1, (r >> 7) & 1))
+                    r = a - m - 1 + carry
+                    s = (a ^ 0x80) - 0x80 - ((m ^ 0x80) - 0x80) - 1 + carry
+                    self.assertEqual(self.flags(SBC_TABLE[index]), (
+                        r & 0xFF, 0 if r < 0 else 1, 0 if -128 <= s <= 127 else 1,
+                        0 if r & 0xFF else 1, (r >> 7) & 1))
+
+    def test_decimal(self):
+        for carry in (0, 1):
+            for a in range(0x100):
+                for m in range(0x100):
+                    binary = arithmetic_index(0, carry, a, m)
+                    decimal = arithmetic_index(1, carry, a, m)
+                    # NMOS: Z is always from the binary result, and SBC
+                    # sets all its flags as in binary
+                    self.assertEqual(self.flags(ADC_TABLE[decimal])[3], self.flags(ADC_TABLE[binary])[3])
+                    self.assertEqual(SBC_TABLE[decimal][1:], SBC_TABLE[binary][1:])
+        for carry in (0, 1):
+            for a in range(100):
+                for m in range(100):
+                    index = arithmetic_index(1, carry, self.bcd(a), self.bcd(m))
+                    r = a + m + carry
+                    self.assertEqual(ADC_TABLE[index][:2], (self.bcd(r % 100), r // 100))
+                    r = a - m - 1 + carry
+                    self.assertEqual(SBC_TABLE[index][:2], (self.bcd(r % 100), 0 if r < 0 else 1))
+
+    def test_decimal_examples(self):
+        # NMOS results from http://www.6502.org/tutorials/decimal_mode.html
+        self.assertEqual(self.flags(ADC_TABLE[arithmetic_index(1, 0, 0x99, 0x01)]), (0x00, 1, 0, 0, 1))
+        self.assertEqual(self.flags(ADC_TABLE[arithmetic_index(1, 1, 0x79, 0x00)]), (0x80, 0, 1, 0, 1))
+        self.assertEqual(self.flags(ADC_TABLE[arithmetic_index(1, 0, 0x24, 0x56)]), (0x80, 0, 1, 0, 1))
+        self.assertEqual(self.flags(ADC_TABLE[arithmetic_index(1, 0, 0x93, 0x82)]), (0x75, 1, 1, 0, 0))
+        self.assertEqual(self.flags(ADC_TABLE[arithmetic_index(1, 0, 0x89, 0x76)]), (0x65, 1, 0, 0, 0))
+        self.assertEqual(self.flags(ADC_TABLE[arithmetic_index(1, 0, 0x00, 0x0F)])[0], 0x15)
+        self.assertEqual(self.flags(SBC_TABLE[arithmetic_index(1, 1, 0x00, 0x01)]), (0x99, 0, 0, 0, 1))
+
+    def test_decimal_instructions(self):
+        memory = Memory(use_bus=False)
+        memory.load(0x1000, [0xF8, 0x18, 0xA9, 0x19, 0x69, 0x28, 0x38, 0xE9, 0x49])  # SED; CLC; LDA #$19; ADC #$28; SEC; SBC #$49
+        cpu = CPU(None, memory)
+        cpu.test_run(0x1000, 0x1006)
+        self.assertEqual((cpu.accumulator, cpu.carry_flag), (0x47, 0))
+        cpu.test_run(0x1006, 0x1009)
+        self.assertEqual((cpu.accumulator, cpu.carry_flag), (0x98, 0))
+
+
 class TestIncrementDecrementOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_INC(self):
         self.memory.write_byte(None, 0x1000, 0x00)
@@ -654,7 +815,7 @@ class TestShiftOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_ASL(self):
         self.cpu.accumulator = 0x01
@@ -761,7 +922,7 @@ class TestJumpCallOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_JMP(self):
         self.cpu.JMP(0x1000)
@@ -793,7 +954,7 @@ class TestBranchOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_BCC(self):
         self.cpu.program_counter = 0x1000
@@ -880,7 +1041,7 @@ class TestStatusFlagOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_CLC(self):
         self.cpu.carry_flag = 1
@@ -917,12 +1078,29 @@ class TestStatusFlagOperations(unittest.TestCase):
         self.cpu.SEI()
         self.assertEqual(self.cpu.interrupt_disable_flag, 1)
 
+    def test_status_byte(self):
+        for status in range(0x100):
+            self.cpu.status_from_byte(status)
+            self.assertEqual(self.cpu.status_as_byte(), status | 0x20)
+            self.assertEqual(self.cpu.zero_flag, (status >> 1) & 1)
+            self.assertEqual(self.cpu.sign_flag, status >> 7)
+
+    def test_zero_and_sign_flags(self):
+        for zero in (0, 1):
+            for sign in (0, 1):
+                self.cpu.zero_flag = zero
+                self.cpu.sign_flag = sign
+                self.assertEqual((self.cpu.zero_flag, self.cpu.sign_flag), (zero, sign))
+                self.cpu.sign_flag = sign
+                self.cpu.zero_flag = zero
+                self.assertEqual((self.cpu.zero_flag, self.cpu.sign_flag), (zero, sign))
+
 
 class TestSystemFunctionOperations(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_BRK(self):
         self.cpu.program_counter = 0x1000
@@ -948,11 +1126,71 @@ class TestSystemFunctionOperations(unittest.TestCase):
         self.cpu.NOP()
 
 
+class TestInterrupts(unittest.TestCase):
+
+    def setUp(self):
+        self.memory = Memory(use_bus=False)
+        self.memory.load(0x1000, [0x58, 0x4C, 0x01, 0x10])  # CLI; JMP *
+        self.memory.load(0x2000, [0x4C, 0x00, 0x20])  # IRQ: JMP *
+        self.memory.load(0x3000, [0x4C, 0x00, 0x30])  # NMI: JMP *
+        self.memory.rom.load(0xFFFA, [0x00, 0x30, 0x00, 0x10, 0x00, 0x20])
+        self.cpu = CPU(None, self.memory)
+        self.cpu.interrupt_disable_flag = 1
+
+    def test_irq(self):
+        self.cpu.raise_irq("timer")
+        self.cpu.execute(1)  # CLI
+        self.cpu.execute(3)  # the IRQ and the handler's JMP
+        self.assertEqual(self.cpu.cycles, 2 + 7 + 3)
+        self.assertEqual(self.cpu.program_counter, 0x2000)
+        self.assertEqual(self.cpu.interrupt_disable_flag, 1)
+        self.assertEqual(self.memory.read_byte(None, 0x1FF), 0x10)
+        self.assertEqual(self.memory.read_byte(None, 0x1FE), 0x01)
+        self.assertEqual(self.memory.read_byte(None, 0x1FD) & 0x14, 0x00)  # B and I clear
+        self.memory.load(0x2000, [0x40])  # RTI
+        self.cpu.lower_irq("timer")
+        self.cpu.execute(self.cpu.cycles + 1)
+        self.assertEqual(self.cpu.program_counter, 0x1001)
+        self.assertEqual(self.cpu.interrupt_disable_flag, 0)
+        self.assertFalse(self.cpu.interrupts)
+
+    def test_irq_masked(self):
+        self.cpu.program_counter = 0x1001
+        self.cpu.raise_irq("timer")
+        self.cpu.execute(100)
+        self.assertEqual(self.cpu.program_counter, 0x1001)
+
+    def test_nmi(self):
+        self.cpu.program_counter = 0x1001
+        self.cpu.raise_nmi()
+        self.cpu.execute(1)
+        self.assertEqual(self.cpu.program_counter, 0x3000)
+        self.memory.load(0x3000, [0x40])  # RTI
+        self.cpu.execute(100)
+        self.assertEqual(self.cpu.program_counter, 0x1001)
+        self.assertFalse(self.cpu.interrupts)
+
+    def test_scheduled(self):
+        self.cpu.enable_translation()
+        self.cpu.schedule_irq(100, "timer")
+        self.cpu.execute(self.cpu.scheduler.next_deadline())
+        self.cpu.scheduler.run(self.cpu.cycles)
+        self.assertEqual(self.cpu.program_counter, 0x1001)
+        self.cpu.execute(self.cpu.cycles + 1)
+        self.assertEqual(self.cpu.program_counter, 0x2000)
+
+    def test_brk_is_not_irq(self):
+        self.memory.load(0x1000, [0x00])
+        self.cpu.step()
+        self.assertEqual(self.cpu.program_counter, 0x2000)
+        self.assertEqual(self.memory.read_byte(None, 0x1FD) & 0x10, 0x10)
+
+
 class Test6502Bugs(unittest.TestCase):
 
     def setUp(self):
         self.memory = Memory(use_bus=False)
-        self.cpu = CPU(self.memory)
+        self.cpu = CPU(None, self.memory)
 
     def test_zero_page_x(self):
         self.cpu.x_index = 0x01
@@ -997,5 +1235,835 @@ class Test6502Bugs(unittest.TestCase):
         self.assertEqual(self.cpu.indirect_mode(), 0xF000)
 
 
+class TestFusedOps(unittest.TestCase):
+
+    REGISTERS = (
+        "accumulator",
+        "x_index",
+        "y_index",
+        "stack_pointer",
+        "program_counter",
+        "cycles",
+        "sign_flag",
+        "overflow_flag",
+        "break_flag",
+        "decimal_mode_flag",
+        "interrupt_disable_flag",
+        "zero_flag",
+        "carry_flag",
+    )
+
+    def setUp(self):
+        self.random = random.Random(6502)
+
+    def make_cpu(self, ram, state):
+        memory = Memory(use_bus=False)
+        memory.ram._mem[:] = ram
+        cpu = CPU(None, memory)
+        for name, value in zip(self.REGISTERS, state):
+            setattr(cpu, name, value)
+        return cpu
+
+    def step(self, cpu):
+        try:
+            cpu.cycles += 2
+            cpu.ops[cpu.read_pc_byte()]()
+        except (AssertionError, IndexError) as e:
+            return type(e).__name__
+        return [getattr(cpu, name) for name in self.REGISTERS], cpu.memory.ram._mem[:]
+
+    def candidate_step(self, cpu):
+        return self.step(cpu)
+
+    def test_against_method_ops(self):
+        ram = [self.random.randrange(0x100) for i in range(0xC000)]
+        for opcode in sorted(INSTRUCTIONS):
+            for trial in range(20):
+                # fresh zero page, stack and operand bytes for each trial
+                for a in range(0x200) + [0x1001, 0x1002]:
+                    ram[a] = self.random.randrange(0x100)
+                ram[0x1000] = opcode
+                state = [self.random.randrange(0x100) for i in range(4)]
+                state += [0x1000, 0]
+                state += [self.random.randrange(2) for i in range(7)]
+                reference = self.make_cpu(ram, state)
+                reference.setup_reference_ops()
+                candidate = self.make_cpu(ram, state)
+                self.assertEqual(self.candidate_step(candidate), self.step(reference), "opcode %02X" % opcode)
+
+    def test_bus_cycle(self):
+        # fused handlers stamp every access of an instruction with the
+        # cycle count at the end of that instruction
+        writes = []
+        memory = Memory(use_bus=False)
+        memory.bus_write = lambda cycle, address, value: writes.append((cycle, address, value))
+        memory.load(0x1000, [0xA9, 0x41, 0x8D, 0x00, 0x04, 0x9D, 0x00, 0x04])  # LDA #$41; STA $0400; STA $0400,X
+        cpu = CPU(None, memory)
+        cpu.test_run(0x1000, 0x1005)
+        self.assertEqual(writes, [(6, 0x0400, 0x41)])
+        cpu.test_run(0x1005, 0x1008)
+        self.assertEqual(writes[1], (13, 0x0400, 0x41))
+
+
+class TestTranslator(TestFusedOps):
+
+    def candidate_step(self, cpu):
+        cpu.enable_translation()
+        opcode = cpu.read_byte(cpu.program_counter)
+        cpu.translator.add_stop(cpu.program_counter + 1 + ADDRESSING_MODES[INSTRUCTIONS[opcode][1]][0])
+        try:
+            cpu.translator.translate(cpu.program_counter)()
+        except (AssertionError, IndexError) as e:
+            return type(e).__name__
+        return [getattr(cpu, name) for name in self.REGISTERS], cpu.memory.ram._mem[:]
+
+    def run_program(self, program, translate):
+        memory = Memory(use_bus=False)
+        memory.load(0x1000, program)
+        cpu = CPU(None, memory)
+        if translate:
+            cpu.enable_translation()
+        cpu.test_run(0x1000, 0x1000 + len(program))
+        return [getattr(cpu, name) for name in self.REGISTERS], memory.ram._mem[:]
+
+    def test_loop(self):
+        program = [
+            0xA0, 0x00,  # LDY #$00
+            0xA2, 0x00,  # LDX #$00
+            0xBD, 0x00, 0x20,  # LDA $2000,X
+            0x69, 0x03,  # ADC #$03
+            0x9D, 0x00, 0x21,  # STA $2100,X
+            0xE8,  # INX
+            0xD0, 0xF5,  # BNE $1004
+            0xC8,  # INY
+            0xC0, 0x04,  # CPY #$04
+            0xD0, 0xEE,  # BNE $1004
+        ]
+        self.assertEqual(self.run_program(program, True), self.run_program(program, False))
+
+    def test_self_modifying_code(self):
+        program = [
+            0xA2, 0x00,  # LDX #$00
+            0xA9, 0x00,  # LDA #$00 (operand incremented below)
+            0x9D, 0x00, 0x20,  # STA $2000,X
+            0xEE, 0x03, 0x10,  # INC $1003
+            0xE8,  # INX
+            0xD0, 0xF5,  # BNE $1002
+        ]
+        result = self.run_program(program, True)
+        self.assertEqual(result, self.run_program(program, False))
+        self.assertEqual(list(result[1][0x2000:0x2100]), range(0x100))
+
+
+class TestCycleTimes(unittest.TestCase):
+
+    MODES = {"implied": ("implied", "accumulator")}
+
+    def cycle_notes(self):
+        """(mnemonic, mode, cycles, note) for each class table in cycle_notes.txt."""
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cycle_notes.txt")) as f:
+            text = f.read()
+        text = text[:text.index("This seems a possible implementation")]
+        rows = []
+        for table in re.findall(r"\(followed by ([^)]*)\)\n\n((?:.+\n)+)", text):
+            mnemonics = table[0].replace("\n", " ").replace(",", " ").split()
+            for line in table[1].splitlines():
+                mode, cycles, note = re.match(r"(\S.*?)\s{2,}(\d+)\s*(.*)", line).groups()
+                for mnemonic in mnemonics:
+                    rows.append((mnemonic, mode, int(cycles), note))
+        return rows
+
+    def opcodes(self, mnemonic, mode):
+        modes = self.MODES.get(mode, (mode.replace(", ", "_").replace(" ", "_"),))
+        return [opcode for opcode, info in INSTRUCTIONS.items() if info[:2] in [(mnemonic, m) for m in modes]]
+
+    def cycles(self, opcode, crossed, exact, translate, taken=True):
+        memory = Memory(use_bus=False)
+        pc = 0x10F0 if crossed else 0x1000
+        memory.load(pc, [opcode, 0xF0, 0x20] if opcode & 0x1F != 0x10 else [opcode, 0x20])
+        memory.load(0xF0, [0xF0, 0x20])  # ($F0),Y
+        cpu = CPU(None, memory)
+        if exact:
+            cpu.enable_exact_cycles()
+        cpu.x_index = cpu.y_index = 0x20 if crossed else 0x08
+        flag = taken if opcode & 0x20 else not taken
+        cpu.carry_flag = cpu.overflow_flag = 1 if flag else 0
+        cpu.zero_flag = cpu.sign_flag = 1 if flag else 0
+        cpu.program_counter = pc
+        if translate:
+            cpu.enable_translation()
+            cpu.translator.add_stop(pc + 1 + ADDRESSING_MODES[INSTRUCTIONS[opcode][1]][0])
+            cpu.translator.translate(pc)()
+            return cpu.cycles
+        cpu.step()
+        return cpu.cycles
+
+    def test_covers_instructions(self):
+        covered = set()
+        for mnemonic, mode, cycles, note in self.cycle_notes():
+            covered.update(self.opcodes(mnemonic, mode.replace("branch not taken", "relative").replace("branch taken", "relative")))
+        self.assertEqual(covered, set(INSTRUCTIONS))
+
+    def test_against_cycle_notes(self):
+        for mnemonic, mode, cycles, note in self.cycle_notes():
+            taken = mode != "branch not taken"
+            if mode.startswith("branch"):
+                mode = "relative"
+            for opcode in self.opcodes(mnemonic, mode):
+                writing = len(INSTRUCTIONS[opcode]) > 2
+                for crossed in (False, True):
+                    base = cycles + (1 if "page crossed" in note and writing else 0)
+                    exact = base + (1 if "page crossed" in note and crossed and not writing else 0)
+                    if mode == "relative" and not taken:
+                        exact = base
+                    for translate in (False, True):
+                        label = (mnemonic, mode, crossed, translate)
+                        self.assertEqual(self.cycles(opcode, crossed, False, translate, taken), base, label)
+                        self.assertEqual(self.cycles(opcode, crossed, True, translate, taken), exact, label)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.calls = []
+
+    def event(self, name):
+        return lambda cycle: self.calls.append((name, cycle))
+
+    def test_order(self):
+        self.scheduler.add(30, self.event("c"))
+        self.scheduler.add(10, self.event("a"))
+        self.scheduler.add(10, self.event("b"))
+        self.assertEqual(self.scheduler.next_deadline(), 10)
+        self.scheduler.run(25)
+        self.assertEqual(self.calls, [("a", 25), ("b", 25)])
+        self.assertEqual(self.scheduler.next_deadline(), 30)
+
+    def test_every(self):
+        self.scheduler.every(100, self.event("tick"))
+        self.scheduler.run(99)
+        self.scheduler.run(250)
+        self.assertEqual(self.calls, [("tick", 250), ("tick", 250)])
+        self.assertEqual(self.scheduler.next_deadline(), 300)
+
+    def test_execute_to_deadline(self):
+        memory = Memory(use_bus=False)
+        memory.load(0x1000, [0xEA] * 0x100)  # NOP
+        cpu = CPU(None, memory)
+        cpu.program_counter = 0x1000
+        cpu.execute(101)
+        self.assertEqual(cpu.cycles, 102)
+        self.assertEqual(cpu.program_counter, 0x1033)
+
+
+class TestThrottle(unittest.TestCase):
+
+    def test_sleeps_when_ahead(self):
+        throttle = Throttle(speed=2.0)
+        throttle.pace(0)
+        start = time.time()
+        throttle.pace(CPU_HZ // 20)  # 25ms at double speed
+        self.assertTrue(time.time() - start >= 0.02)
+
+    def test_turbo(self):
+        throttle = Throttle(speed=None)
+        throttle.pace(0)
+        start = time.time()
+        throttle.pace(CPU_HZ)
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_lag(self):
+        throttle = Throttle()
+        throttle.pace(0)
+        throttle.base_time -= 1.0
+        throttle.pace(CPU_HZ // 100)
+        self.assertEqual(throttle.base_cycle, CPU_HZ // 100)
+
+
+class TestIdleLoops(unittest.TestCase):
+
+    KEYIN = [0xE6, 0x4E, 0xD0, 0x02, 0xE6, 0x4F, 0x2C, 0x00, 0xC0, 0x10, 0xF5]
+
+    def make_cpu(self, program, rnd=(0x00, 0x00)):
+        memory = Memory(use_bus=False)
+        memory.load(0x1000, program)
+        memory.load(0x4E, rnd)
+        cpu = CPU(None, memory)
+        cpu.program_counter = 0x1000
+        cpu.accumulator = 0x80
+        return cpu
+
+    def state(self, cpu):
+        return (cpu.cycles, cpu.program_counter, cpu.idle_state(), cpu.read_byte(0x4E), cpu.read_byte(0x4F))
+
+    def test_find(self):
+        memory = self.make_cpu(self.KEYIN).memory
+        self.assertEqual(find_idle_loop(memory, 0x1006), (0x1000, 0x100B, (0x4E, 0x4F)))
+        memory.load(0x1006, [0x2C, 0x30, 0xC0])  # BIT $C030, the speaker
+        self.assertEqual(find_idle_loop(memory, 0x1006), None)
+        memory.load(0x1000, [0xAD, 0x00, 0xC0, 0x10, 0xFB])  # LDA $C000; BPL
+        self.assertEqual(find_idle_loop(memory, 0x1003), (0x1000, 0x1005, None))
+        memory.load(0x1000, [0x8D, 0x00, 0x04, 0x10, 0xFB])  # STA $0400; BPL
+        self.assertEqual(find_idle_loop(memory, 0x1003), None)
+
+    def test_keyin_matches_interpreter(self):
+        for rnd in ((0x00, 0x00), (0xF0, 0x12), (0xFF, 0xFF)):
+            for until in (50, 4096, 100000):
+                interpreted = self.make_cpu(self.KEYIN, rnd)
+                skipped = self.make_cpu(self.KEYIN, rnd)
+                interpreted.execute(7)
+                skipped.execute(7)
+                self.assertTrue(skipped.skip_idle(until))
+                self.assertTrue(skipped.cycles >= until)
+                while interpreted.cycles < skipped.cycles:
+                    interpreted.step()
+                self.assertEqual(self.state(interpreted), self.state(skipped))
+
+    def test_key_waiting(self):
+        cpu = self.make_cpu(self.KEYIN)
+        cpu.memory.bus_input(None, 0xC000, 0xC1)
+        self.assertFalse(cpu.skip_idle(100000))
+        self.assertEqual(cpu.program_counter, 0x100B)
+
+    def test_poll_loop(self):
+        cpu = self.make_cpu([0xAD, 0x00, 0xC0, 0x10, 0xFB])
+        self.assertTrue(cpu.skip_idle(100000))
+        interpreted = self.make_cpu([0xAD, 0x00, 0xC0, 0x10, 0xFB])
+        while interpreted.cycles < cpu.cycles:
+            interpreted.step()
+        self.assertEqual(self.state(interpreted), self.state(cpu))
+
+
+class TestCountdowns(unittest.TestCase):
+
+    PROGRAMS = {
+        "DEX": [0xCA, 0xD0, 0xFD, 0xEA],
+        "DEY": [0x88, 0xD0, 0xFD, 0xEA],
+        "INX": [0xE8, 0xD0, 0xFD, 0xEA],
+        "INY": [0xC8, 0xD0, 0xFD, 0xEA],
+        "SBC": [0x38, 0xE9, 0x01, 0xD0, 0xFC, 0xEA],
+        "WAIT": [0x38, 0x48, 0xE9, 0x01, 0xD0, 0xFC, 0x68, 0xE9, 0x01, 0xD0, 0xF6, 0x60],
+    }
+
+    def make_cpu(self, program, a, x, y):
+        memory = Memory(use_bus=False)
+        memory.load(0x1000, program)
+        cpu = CPU(None, memory)
+        cpu.program_counter = 0x1000
+        cpu.accumulator, cpu.x_index, cpu.y_index = a, x, y
+        cpu.stack_pointer = 0xF0
+        return cpu
+
+    def state(self, cpu):
+        return (cpu.cycles, cpu.program_counter, cpu.idle_state(), cpu.read_byte(0x1F0))
+
+    def test_against_interpreter(self):
+        rng = random.Random(6502)
+        for name, program in sorted(self.PROGRAMS.items()):
+            skipped = 0
+            for trial in range(50):
+                a, x, y = rng.randrange(0x100), rng.randrange(0x100), rng.randrange(0x100)
+                steps = rng.randrange(6)
+                until = rng.randrange(200000)
+                interpreted = self.make_cpu(program, a, x, y)
+                fast = self.make_cpu(program, a, x, y)
+                for i in range(steps):
+                    interpreted.step()
+                    fast.step()
+                if fast.skip_countdown(until):
+                    skipped += 1
+                    self.assertTrue(fast.cycles <= until)
+                while interpreted.cycles < fast.cycles:
+                    interpreted.step()
+                self.assertEqual(self.state(interpreted), self.state(fast), (name, a, x, y, steps, until))
+            self.assertTrue(skipped > 25, name)
+
+    def test_decimal_mode_not_skipped(self):
+        cpu = self.make_cpu(self.PROGRAMS["SBC"], 0x10, 0, 0)
+        cpu.step()
+        cpu.decimal_mode_flag = 1
+        self.assertFalse(cpu.skip_countdown(100000))
+
+
+class TestTraps(unittest.TestCase):
+
+    def setUp(self):
+        self.memory = Memory(use_bus=False)
+        self.memory.rom.load(0xFDF0, [0xC9, 0xA0])  # COUT1: CMP #$A0
+        self.memory.load(0x20, [0x00, 0x28, 0x00, 0x18, 0x00, 0x00])  # full window
+        self.memory.load(0x28, [0x00, 0x04])
+        self.memory.load(0x32, [0xFF])
+        self.memory.load(0x38, [0x1B, 0xFD])
+        self.cpu = CPU(None, self.memory)
+        for name in ("COUT", "RDKEY", "HOME"):
+            self.cpu.enable_trap(name)
+
+    def call(self, address, a=0x00):
+        self.memory.load(0x1000, [0x20, address & 0xFF, address >> 8])
+        self.cpu.accumulator = a
+        self.cpu.test_run(0x1000, 0x1003)
+
+    def test_cout(self):
+        self.memory.load(0x24, [0x05])
+        self.cpu.y_index = 0x33
+        self.call(0xFDF0, 0xC1)
+        self.assertEqual(self.memory.read_byte(None, 0x405), 0xC1)
+        self.assertEqual(self.memory.read_byte(None, 0x24), 0x06)
+        self.assertEqual(self.cpu.accumulator, 0xC1)
+        self.assertEqual(self.cpu.y_index, 0x33)
+        self.assertEqual(self.memory.read_byte(None, 0x35), 0x33)
+        self.assertEqual(self.cpu.stack_pointer, 0xFF)
+
+    def test_cout_inverse(self):
+        self.memory.load(0x32, [0x3F])
+        self.call(0xFDF0, 0xC1)
+        self.assertEqual(self.memory.read_byte(None, 0x400), 0x01)
+
+    def test_cout_wraps(self):
+        self.memory.load(0x24, [0x27])
+        self.call(0xFDF0, 0xC1)
+        self.assertEqual(self.memory.read_byte(None, 0x427), 0xC1)
+        self.assertEqual(self.memory.read_byte(None, 0x24), 0x00)
+        self.assertEqual(self.memory.read_byte(None, 0x25), 0x01)
+        self.assertEqual(self.memory.read_byte(None, 0x28), 0x80)
+
+    def test_cout_scrolls(self):
+        self.memory.load(0x24, [0x03, 0x17])
+        self.memory.load(0x28, [0xD0, 0x07])
+        self.memory.load(0x480, [0xC2])  # row 1
+        self.memory.load(0x7D0, [0xC3])  # row 23
+        self.call(0xFDF0, 0x8D)
+        self.assertEqual(self.memory.read_byte(None, 0x400), 0xC2)
+        self.assertEqual(self.memory.read_byte(None, 0x750), 0xC3)  # row 22
+        self.assertEqual(self.memory.read_byte(None, 0x7D0), 0xA0)
+        self.assertEqual(self.memory.read_byte(None, 0x24), 0x00)
+        self.assertEqual(self.memory.read_byte(None, 0x25), 0x17)
+
+    def test_cout_bell_runs_rom(self):
+        self.memory.load(0x1000, [0x20, 0xF0, 0xFD])
+        self.cpu.program_counter = 0x1000
+        self.cpu.accumulator = 0x87
+        self.cpu.step()
+        self.cpu.step()
+        self.assertEqual(self.cpu.program_counter, 0xFDF2)
+        self.assertEqual(self.cpu.carry_flag, 0)
+
+    def test_rdkey(self):
+        self.memory.load(0x24, [0x07])
+        self.memory.bus_input(None, 0xC000, 0xC1)
+        self.call(0xFD0C)
+        self.assertEqual(self.cpu.accumulator, 0xC1)
+        self.assertEqual(self.cpu.y_index, 0x07)
+        self.assertEqual(self.memory.read_byte(None, 0x4E), 0x01)
+        self.assertEqual(self.memory.read_byte(None, 0xC000), 0x41)
+
+    def test_home(self):
+        self.memory.load(0x22, [0x02, 0x04, 0x09, 0x03])
+        self.memory.load(0x480, [0xC1])  # row 1, above the window
+        self.memory.load(0x500, [0xC1])  # row 2
+        self.memory.load(0x580, [0xC1])  # row 3
+        self.memory.load(0x600, [0xC1])  # row 4, below the window
+        self.call(0xFC58)
+        self.assertEqual(self.memory.read_byte(None, 0x480), 0xC1)
+        self.assertEqual(self.memory.read_byte(None, 0x500), 0xA0)
+        self.assertEqual(self.memory.read_byte(None, 0x580), 0xA0)
+        self.assertEqual(self.memory.read_byte(None, 0x600), 0xC1)
+        self.assertEqual(self.memory.read_byte(None, 0x24), 0x00)
+        self.assertEqual(self.memory.read_byte(None, 0x25), 0x02)
+        self.assertEqual(self.memory.read_byte(None, 0x28), 0x00)
+        self.assertEqual(self.memory.read_byte(None, 0x29), 0x05)
+
+    def test_disable(self):
+        self.cpu.disable_trap("COUT")
+        self.assertEqual(self.memory.read_byte(None, 0xFDF0), 0xC9)
+        self.cpu.program_counter = 0xFDF0
+        self.cpu.accumulator = 0xC1
+        self.cpu.step()
+        self.assertEqual(self.cpu.program_counter, 0xFDF2)
+        self.assertEqual(self.cpu.carry_flag, 1)
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.memory = Memory(use_bus=False)
+        # LDX #$05; DEX; BNE $1002; JMP $1005
+        self.memory.load(0x1000, [0xA2, 0x05, 0xCA, 0xD0, 0xFD, 0x4C, 0x05, 0x10])
+        self.cpu = CPU(None, self.memory)
+        self.cpu.program_counter = 0x1000
+
+    def test_counts(self):
+        self.cpu.enable_profile()
+        self.cpu.execute(100)
+        profile = self.cpu.profile
+        self.assertEqual(profile.pc_count[0x1000], 1)
+        self.assertEqual(profile.pc_count[0x1002], 5)
+        self.assertEqual(profile.pc_count[0x1003], 5)
+        self.assertEqual(profile.op_count[0xCA], 5)
+        self.assertEqual(profile.pc_cycles[0x1002], 10)
+        self.assertEqual(sum(profile.pc_cycles), self.cpu.cycles)
+        self.assertEqual(sum(profile.op_cycles), self.cpu.cycles)
+        self.assertEqual(profile.hot(1)[0][0], 0x1005)
+        self.assertEqual([op for op, count, cycles in profile.opcodes()], [0x4C, 0xD0, 0xCA, 0xA2])
+
+    def test_same_as_unprofiled(self):
+        self.cpu.enable_profile()
+        self.cpu.enable_translation()
+        self.cpu.execute(100)
+        other = CPU(None, self.memory)
+        other.program_counter = 0x1000
+        other.execute(100)
+        self.assertEqual((self.cpu.cycles, self.cpu.program_counter), (other.cycles, other.program_counter))
+
+    def test_clear(self):
+        self.cpu.enable_profile()
+        self.cpu.execute(100)
+        self.cpu.profile.clear()
+        self.assertEqual(self.cpu.profile.hot(10), [])
+        self.cpu.disable_profile()
+        self.cpu.execute(200)
+        self.assertEqual(self.cpu.profile, None)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def boot(self):
+        memory = Memory(use_bus=False)
+        labels = romgen.load(memory)
+        cpu = CPU(None, memory)
+        return cpu, labels
+
+    def state(self, cpu):
+        return (
+            cpu.cycles, cpu.accumulator, cpu.x_index, cpu.y_index, cpu.stack_pointer, cpu.program_counter,
+            cpu.status_as_byte(), cpu.memory.kbd, cpu.memory.switches, str(cpu.memory.ram._mem),
+        )
+
+    def test_round_trip(self):
+        cpu, labels = self.boot()
+        cpu.execute(20000)
+        cpu.memory.kbd = 0xC1
+        cpu.memory.switches = [0, 1, 0, 1]
+        data = cpu.snapshot()
+        cpu.execute(60000)
+        expected = self.state(cpu)
+
+        other, labels = self.boot()
+        other.enable_translation()
+        other.execute(1000)
+        other.restore(data)
+        self.assertEqual(other.memory.kbd, 0xC1)
+        self.assertEqual(other.memory.switches, [0, 1, 0, 1])
+        other.execute(60000)
+        self.assertEqual(self.state(other), expected)
+
+    def test_file(self):
+        cpu, labels = self.boot()
+        cpu.test_run(labels["RESET"], labels["KEYLOOP"])
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cpu.save_snapshot(path)
+            other, labels = self.boot()
+            other.load_snapshot(path)
+        finally:
+            os.unlink(path)
+        self.assertEqual(self.state(other), self.state(cpu))
+
+    def test_scheduler(self):
+        cpu, labels = self.boot()
+        cpu.execute(20000)
+        data = cpu.snapshot()
+        other, labels = self.boot()
+        fired = []
+        other.scheduler.add(100, fired.append)
+        other.restore(data)
+        other.scheduler.run(other.cycles + 99)
+        self.assertEqual(fired, [])
+        other.scheduler.run(other.cycles + 100)
+        self.assertEqual(fired, [other.cycles + 100])
+
+    def test_interrupts(self):
+        cpu, labels = self.boot()
+        cpu.raise_nmi()
+        data = cpu.snapshot()
+        cpu.raise_irq("test")
+        cpu.restore(data)
+        self.assertEqual(cpu.irq_sources, set())
+        self.assertTrue(cpu.nmi_pending)
+        self.assertTrue(cpu.interrupts)
+
+    def test_unsupported(self):
+        cpu, labels = self.boot()
+        data = cpu.snapshot()
+        self.assertRaises(IOError, cpu.restore, data[:-1])
+        self.assertRaises(IOError, cpu.restore, data[:4] + chr(0x63) + data[5:])
+
+
+class TestFarm(unittest.TestCase):
+
+    def setUp(self):
+        memory = Memory(use_bus=False)
+        romgen.load(memory)
+        self.cpu = CPU(None, memory)
+        self.assertEqual(farm.run(self.cpu, "", 1000000), "idle")
+
+    def test_run(self):
+        self.assertEqual(farm.screen(self.cpu.memory)[4], "READY")
+        self.assertEqual(farm.run(self.cpu, "HELLO\nWORLD", 1000000), "idle")
+        self.assertEqual(farm.screen(self.cpu.memory)[5:7], ["HELLO", "WORLD"])
+
+    def test_limit(self):
+        self.assertEqual(farm.run(self.cpu, "HELLO", 1000), "limit")
+
+    def test_stop(self):
+        cout = romgen.synthetic_rom()[1]["COUT"]
+        self.assertEqual(farm.run(self.cpu, "HELLO", 1000000, cout), "stop")
+        self.assertEqual(self.cpu.program_counter, cout)
+        self.assertEqual(self.cpu.accumulator, ord("H") | 0x80)
+
+    def test_farm(self):
+        results = farm.farm(self.cpu, ["ONE", "TWO\nTHREE", "FOUR"], 2)
+        self.assertEqual([result["screen"][5:7] for result in results], [["ONE", ""], ["TWO", "THREE"], ["FOUR", ""]])
+        self.assertEqual([result["stopped"] for result in results], ["idle"] * 3)
+        # the parent is left as it was
+        self.assertEqual(farm.screen(self.cpu.memory)[5], "")
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, str(romgen.synthetic_rom()[0]))
+        os.close(fd)
+        batch.init(self.path, False)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_boot(self):
+        result = batch.run_job((1, '{"input": "HI"}'))
+        self.assertEqual(result["id"], 1)
+        self.assertEqual(result["stopped"], "idle")
+        self.assertEqual(result["screen"][4:6], ["READY", "HI"])
+        self.assertEqual(len(result["screen"]), 24)
+
+    def test_program(self):
+        # LDA #$C1; STA $0400; LDX #$07; BRK
+        result = batch.run_job((2, '{"id": "a", "data": "a9c18d0004a20700", "load": 768, "pc": 768, "stop": 775}'))
+        self.assertEqual(result["id"], "a")
+        self.assertEqual(result["stopped"], "stop")
+        self.assertEqual(result["screen"][0], "A" + "@" * 39)  # zeroed RAM shows as @
+        self.assertEqual(result["registers"]["x_index"], 0x07)
+        self.assertEqual(result["registers"]["program_counter"], 775)
+        self.assertEqual(result["cycles"], 8)
+
+    def test_limit(self):
+        result = batch.run_job((3, '{"data": "4c0003", "load": 768, "pc": 768, "cycles": 300}'))
+        self.assertEqual(result["stopped"], "limit")
+        self.assertEqual(result["cycles"], 300)
+
+    def test_errors(self):
+        self.assertEqual(batch.run_job((4, '{"data": "zz"}'))["id"], 4)
+        self.assertTrue("error" in batch.run_job((4, '{"data": "zz"}')))
+        self.assertTrue("error" in batch.run_job((5, 'nonsense')))
+        self.assertTrue("error" in batch.run_job((6, '{"file": "/nonexistent"}')))
+
+
+class TestRecordReplay(unittest.TestCase):
+
+    END = 400000
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def session(self, record=None, replay=None, translate=False, keys=()):
+        class Options:
+            pc = None
+            exact = False
+            profile = False
+            translate = False
+            traps = []
+            speed = None
+            report = False
+            restore = None
+            snapshot = None
+        options = Options()
+        options.record = record
+        options.replay = replay
+        options.translate = translate
+        memory = Memory(use_bus=False)
+        romgen.load(memory)
+        cpu = CPU(options, memory)
+        for cycle, key in keys:
+            cpu.scheduler.add(cycle, lambda cycle, key=key: cpu.input(cycle, 0xC000, key))
+        cpu.scheduler.add(self.END, lambda cycle: setattr(cpu, "quit", True))
+        cpu.loop()
+        if cpu.record_file is not None:
+            cpu.record_file.close()
+        return cpu.cycles, cpu.program_counter, str(memory.ram._mem)
+
+    def test_replay(self):
+        keys = [(100003, 0xC8), (150001, 0xC9), (250007, 0x8D), (250008, 0xC1)]
+        recorded = self.session(record=self.path, keys=keys)
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 4)
+        self.assertEqual(self.session(replay=self.path), recorded)
+        # translated blocks run past the final deadline, but the output is
+        # the same and so is every translated run
+        translated = self.session(replay=self.path, translate=True)
+        self.assertEqual(translated[2], recorded[2])
+        self.assertEqual(self.session(replay=self.path, translate=True), translated)
+        # live input is ignored while replaying
+        self.assertEqual(self.session(replay=self.path, keys=[(120000, 0xDA)]), recorded)
+
+
+class TestSyntheticROM(unittest.TestCase):
+
+    def setUp(self):
+        self.memory = Memory(use_bus=False)
+        self.labels = romgen.load(self.memory)
+        self.cpu = CPU(None, self.memory)
+        self.cpu.test_run(self.labels["RESET"], self.labels["KEYLOOP"])
+
+    def row(self, row):
+        base = 0x400 + (row & 7) * 0x80 + (row >> 3) * 0x28
+        return "".join(chr(self.memory.read_byte(None, base + i) & 0x7F) for i in range(40)).rstrip()
+
+    def test_boot(self):
+        self.assertEqual([self.row(row) for row in range(6)], [
+            "APPLEPY SYNTHETIC ROM",
+            "PRIMES 36",
+            "FIB B520",
+            "SQUARES %04X" % (sum(n * n for n in range(256)) & 0xFFFF),
+            "READY",
+            "",
+        ])
+
+    def test_keyboard(self):
+        self.memory.bus_input(None, 0xC000, 0xC1)
+        self.cpu.execute(self.cpu.cycles + 200)
+        self.assertEqual(self.row(5), "A")
+        self.assertEqual(self.memory.read_byte(None, 0xC000), 0x41)
+
+    def test_scroll(self):
+        self.memory.load(0x1000, [0xA9, 0x8D, 0x20, self.labels["COUT"] & 0xFF, self.labels["COUT"] >> 8] * 19)
+        self.cpu.test_run(0x1000, 0x1000 + 5 * 19)
+        self.assertEqual(self.row(0), "PRIMES 36")
+        self.assertEqual(self.row(3), "READY")
+        self.assertEqual(self.row(23), "")
+
+    def test_interrupts(self):
+        self.cpu.raise_nmi()
+        self.cpu.execute(self.cpu.cycles + 20)
+        self.assertEqual(self.memory.read_byte(None, romgen.NMI_COUNT), 1)
+        self.cpu.raise_irq("test")
+        self.cpu.execute(self.cpu.cycles + 1)
+        self.cpu.lower_irq("test")
+        self.cpu.execute(self.cpu.cycles + 20)
+        self.assertEqual(self.memory.read_byte(None, romgen.IRQ_COUNT), 1)
+
+    def test_branch_range(self):
+        a = romgen.Assembler(0x1000)
+        a.label("START")
+        a.data([0xEA] * 0x80)
+        a.op("BNE", "relative", "START")
+        self.assertRaises(ValueError, a.assemble)
+
+
+class TestBus(unittest.TestCase):
+
+    def setUp(self):
+        self.core, self.display = socket.socketpair()
+        self.inputs = []
+        self.bus = Bus(self.core, lambda *message: self.inputs.append(message))
+        self.reader = BusReader(self.display)
+
+    def tearDown(self):
+        self.core.close()
+        self.display.close()
+
+    def test_batched_writes(self):
+        self.bus.write(0x100000000, 0x400, 0xC1)
+        self.bus.write(0x100000004, 0x401, 0xC2)
+        self.assertEqual(self.reader.receive(), [])  # only the hello so far
+        self.bus.flush()
+        self.assertEqual(self.reader.receive(), [
+            (0x100000000, BUS_WRITE, 0x400, 0xC1),
+            (0x100000004, BUS_WRITE, 0x401, 0xC2),
+        ])
+
+    def test_cycle_threshold(self):
+        self.bus.write(0, 0x400, 0x00)
+        self.bus.write(Bus.FLUSH_CYCLES, 0x401, 0x00)
+        self.assertEqual(len(self.reader.receive()), 2)
+
+    def test_read_flushes_writes(self):
+        self.display.sendall(bus_frame(BUS_MESSAGE.pack(12, BUS_READ, 0xC000, 0xC1)))
+        self.bus.write(10, 0x400, 0xA0)
+        self.assertEqual(self.bus.read(12, 0xC000), 0xC1)
+        self.assertEqual(self.reader.receive(), [
+            (10, BUS_WRITE, 0x400, 0xA0),
+            (12, BUS_READ, 0xC000, 0x00),
+        ])
+
+    def test_input(self):
+        self.bus.poll()
+        self.assertEqual(self.inputs, [])
+        self.display.sendall(bus_frame(BUS_MESSAGE.pack(5, BUS_WRITE, 0xC000, 0xC1)))
+        self.bus.poll()
+        self.assertEqual(self.inputs, [(5, 0xC000, 0xC1)])
+
+    def test_input_during_read(self):
+        self.display.sendall(bus_frame(
+            BUS_MESSAGE.pack(5, BUS_WRITE, 0xC000, 0xC1) +
+            BUS_MESSAGE.pack(12, BUS_READ, 0xC030, 0x00)))
+        self.assertEqual(self.bus.read(12, 0xC030), 0x00)
+        self.assertEqual(self.inputs, [(5, 0xC000, 0xC1)])
+
+    def test_hello(self):
+        self.assertEqual(self.reader.control_port, None)
+        self.assertEqual(self.reader.receive(), [])
+        self.assertEqual(self.reader.control_port, 0)
+        core, display = socket.socketpair()
+        Bus(core, control_port=6600)
+        reader = BusReader(display)
+        reader.receive()
+        self.assertEqual(reader.control_port, 6600)
+        core.close()
+        display.close()
+
+    def test_memory_buses(self):
+        core, display = socket.socketpair()
+        first = Memory()
+        first.bus = self.bus
+        second = Memory()
+        second.bus = Bus(core)
+        reader = BusReader(display)
+        self.reader.receive()
+        reader.receive()
+        first.write_byte(1, 0x400, 0xC1)
+        second.write_byte(2, 0x400, 0xC2)
+        first.bus_flush()
+        second.bus_flush()
+        self.assertEqual(self.reader.receive(), [(1, BUS_WRITE, 0x400, 0xC1)])
+        self.assertEqual(reader.receive(), [(2, BUS_WRITE, 0x400, 0xC2)])
+        core.close()
+        display.close()
+
+    def test_partial_frames(self):
+        data = bus_frame(BUS_MESSAGE.pack(1, BUS_WRITE, 0x400, 0x01))
+        reader = BusReader(self.core, hello=False)
+        self.display.sendall(data[:5])
+        self.assertEqual(reader.receive(), [])
+        self.display.sendall(data[5:])
+        self.assertEqual(reader.receive(), [(1, BUS_WRITE, 0x400, 0x01)])
+
+
 if __name__ == "__main__":
     unittest.main()